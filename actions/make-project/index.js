@@ -4,6 +4,8 @@ const path = require('path');
 const fs = require('node:fs')
 const { procSuccess, procFail, findTargetDirectory } = require('../common');
 
+const BUILD_CACHE = path.join(__dirname, '..', '..', 'shell-scripts', 'build_cache.py');
+
 const cleanProject = function (projectPath, distclean, suppress) {
     let cleanOpt = distclean ? 'distclean' : 'clean';
     
@@ -36,7 +38,7 @@ const cleanProject = function (projectPath, distclean, suppress) {
 
 }
 
-const makeProject = async function (projectPath, distclean, build_flags, board="", suppress=true, logfile=null) {
+const makeProject = async function (projectPath, distclean, build_flags, board="", suppress=true, logfile=null, cacheDir="") {
     let makeArgs = ['-j', '-C', projectPath];
     makeArgs.push(...build_flags);
     
@@ -44,14 +46,26 @@ const makeProject = async function (projectPath, distclean, build_flags, board="
     {
         makeArgs.push(`BOARD=${board}`)
     }
+    let makeCmdName = 'make';
     let retVal = 0;
-    await cleanProject(projectPath, distclean, suppress).then(
-        (success) => procSuccess(success, 'Clean'),
-        (error) => {
-            retVal--;
-            procFail(error, 'Clean', false);
-        }
-    );
+    if (cacheDir !== "") {
+        // The cache cleans and builds only if the sources or flags changed
+        makeCmdName = 'python3';
+        makeArgs = [
+            BUILD_CACHE, '-c', cacheDir, '-C', projectPath,
+            '-o', path.join(projectPath, 'build'),
+            '--clean', distclean ? 'distclean' : 'clean',
+            '--', '-j', ...makeArgs.slice(3)
+        ];
+    } else {
+        await cleanProject(projectPath, distclean, suppress).then(
+            (success) => procSuccess(success, 'Clean'),
+            (error) => {
+                retVal--;
+                procFail(error, 'Clean', false);
+            }
+        );
+    }
 
     let logOut = '';
     let dumpOut = '';
@@ -59,7 +73,7 @@ const makeProject = async function (projectPath, distclean, build_flags, board="
         if (retVal < 0) {
             reject(retVal);
         }
-        const makeCmd = spawn('make', makeArgs);
+        const makeCmd = spawn(makeCmdName, makeArgs);
         if (suppress) {
             makeCmd.stdout.on('data', data => { dumpOut = `${dumpOut}${data.toString()}` });
             makeCmd.stderr.on('data', data => { dumpOut = `${dumpOut}${data.toString()}` });
@@ -102,6 +116,7 @@ const main = async function () {
     const BUILD_FLAGS = Core.getMultilineInput('build_flags', { required: false });
     const SUPPRESS_FLAG = Core.getBooleanInput('suppress_output', { required: false });
     const USE_LOGFILE = Core.getBooleanInput('create_buildlog', { required: false });
+    const CACHE_DIR = Core.getInput('cache_dir', { required: false });
     let build_flags = [];
     let retVal = 0;
     let logDir = "";
@@ -124,7 +139,7 @@ const main = async function () {
                 logPath = path.join(logDir, `build-log-${i}.txt`)
             }
             let buildPath = PROJECT_DIRS[i];
-            await makeProject(buildPath, DISTCLEAN_FLAG, build_flags, board="", suppress=SUPPRESS_FLAG, logfile=logPath).then(
+            await makeProject(buildPath, DISTCLEAN_FLAG, build_flags, board="", suppress=SUPPRESS_FLAG, logfile=logPath, cacheDir=CACHE_DIR).then(
                 (success) => procSuccess(success, "Build"),
                 (error) => {
                     retVal --;
@@ -154,7 +169,7 @@ const main = async function () {
                 logPath = path.join(logDir, `build-log-${i}.txt`)
             }
             let buildPath = findTargetDirectory(path.join(MSDK_PATH, "Examples", TARGETS[i]), PROJECT_DIRS[i])
-            await makeProject(buildPath, DISTCLEAN_FLAG, build_flags, board="", suppress=SUPPRESS_FLAG, logfile=logPath).then(
+            await makeProject(buildPath, DISTCLEAN_FLAG, build_flags, board="", suppress=SUPPRESS_FLAG, logfile=logPath, cacheDir=CACHE_DIR).then(
                 (success) => procSuccess(success, "Build"),
                 (error) => {
                     retVal--;
@@ -0,0 +1,477 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+build_cache.py
+
+Description: Run make through a content addressed cache of build artifacts
+
+"""
+import argparse
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "btm_ci", "builds"
+)
+# Entries kept after storing a new one, least recently used are removed
+DEFAULT_MAX_ENTRIES = 50
+# Files restored on a hit, everything else in the output folders is rebuilt
+DEFAULT_PATTERNS = ("*.elf", "*.bin", "*.hex", "*.map", "*.a")
+# Compiler whose version is part of the key
+DEFAULT_COMPILER = "arm-none-eabi-gcc"
+# Folders never hashed when a source tree is not a git checkout
+SKIP_DIRS = (".git",)
+
+MANIFEST = "manifest.json"
+
+
+def _git(root: str, *args: str) -> Optional[bytes]:
+    try:
+        proc = subprocess.run(
+            ["git", "-C", root, *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    except OSError:
+        return None
+
+    return proc.stdout if proc.returncode == 0 else None
+
+
+def file_hash(path: str) -> str:
+    """SHA-256 of a file, or "deleted" if it does not exist"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as source_file:
+            for chunk in iter(lambda: source_file.read(1 << 16), b""):
+                digest.update(chunk)
+    except OSError:
+        return "deleted"
+
+    return digest.hexdigest()
+
+
+def _paths(output: Optional[bytes]) -> List[bytes]:
+    return [path for path in (output or b"").split(b"\0") if path]
+
+
+def _gitlinks(index: bytes) -> List[bytes]:
+    """Submodule paths of ``ls-files -s -z`` output"""
+    # Entries are "<mode> <object> <stage>\t<path>"
+    return [
+        entry.partition(b"\t")[2]
+        for entry in _paths(index)
+        if entry.startswith(b"160000 ")
+    ]
+
+
+def _excluded(
+    path: str, exclude: Sequence[str], artifacts: Sequence[str]
+) -> bool:
+    """True if a file is build output, given its absolute path"""
+    if any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in artifacts):
+        return True
+
+    return any(
+        path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+        for folder in exclude
+    )
+
+
+def tree_hash(
+    root: str, exclude: Sequence[str] = (), artifacts: Sequence[str] = ()
+) -> str:
+    """Hash of the contents of a source tree
+
+    A git checkout is hashed from the blob ids in its index, so only files
+    modified in the work tree or untracked are read. Ignored files do not
+    change the hash, and neither do untracked files in ``exclude`` or
+    matching ``artifacts``, as they are build output. Submodules and other
+    nested checkouts are hashed the same way from their own index. Other
+    trees are read completely, skipping ``SKIP_DIRS``, ``exclude`` and files
+    matching ``artifacts``.
+
+    Parameters
+    ----------
+    root : str
+        Top folder of the tree
+    exclude : Sequence[str], optional
+        Absolute paths of the folders the build writes to
+    artifacts : Sequence[str], optional
+        File name patterns of build artifacts
+
+    Returns
+    -------
+    str
+        Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+
+    index = _git(root, "ls-files", "-s", "-z")
+    if index is not None:
+        digest.update(index)
+        submodules = _gitlinks(index)
+
+        dirty = set(_paths(_git(root, "ls-files", "-z", "-m")))
+        for path in _paths(_git(root, "ls-files", "-z", "-o", "--exclude-standard")):
+            if path.endswith(b"/"):
+                # Only nested checkouts are listed as folders
+                submodules.append(path.rstrip(b"/"))
+            elif not _excluded(
+                os.path.join(root, os.fsdecode(path)), exclude, artifacts
+            ):
+                dirty.add(path)
+
+        for path in sorted(dirty - set(submodules)):
+            digest.update(path)
+            digest.update(file_hash(os.path.join(root, os.fsdecode(path))).encode())
+
+        # The checked out commit and local changes, not the commit in the index.
+        # Submodules that are not checked out are empty folders of this tree
+        for path in submodules:
+            submodule = os.path.join(root, os.fsdecode(path))
+            if os.path.exists(os.path.join(submodule, ".git")):
+                digest.update(path)
+                digest.update(tree_hash(submodule, exclude, artifacts).encode())
+
+        return digest.hexdigest()
+
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(
+            name
+            for name in dirs
+            if name not in SKIP_DIRS
+            and not _excluded(os.path.join(folder, name), exclude, ())
+        )
+        for name in sorted(files):
+            path = os.path.join(folder, name)
+            if _excluded(path, exclude, artifacts):
+                continue
+            digest.update(os.path.relpath(path, root).encode("utf-8"))
+            digest.update(file_hash(path).encode())
+
+    return digest.hexdigest()
+
+
+def compiler_version(compiler: str) -> str:
+    """First line of ``compiler --version``, empty if it can not be run"""
+    try:
+        proc = subprocess.run(
+            [compiler, "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    except OSError:
+        return ""
+
+    return proc.stdout.decode("utf-8", "replace").partition("\n")[0]
+
+
+class BuildCache:
+    """Build artifacts stored by the hash of everything the build depends on
+
+    Each entry holds the files matching ``patterns`` found in the output
+    folders after a successful build, relative to the make folder. Builds
+    with the same key, e.g. tester and DUT of the same target, share one
+    entry, and concurrent builds of one key wait for each other.
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIR,
+        patterns=DEFAULT_PATTERNS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ) -> None:
+        self.directory = directory
+        self.patterns = list(patterns)
+        self.max_entries = max_entries
+
+    def key(
+        self,
+        make_dir: str,
+        make_args: List[str],
+        sources: List[str],
+        target: str = "",
+        compiler: str = DEFAULT_COMPILER,
+        outputs: Sequence[str] = (),
+    ) -> Dict[str, str]:
+        """Everything a build depends on, and its hash under "key"
+
+        Parameters
+        ----------
+        make_dir : str
+            Folder make runs in
+        make_args : List[str]
+            Make goals and variables. ``-j`` options do not change the
+            output and are left out
+        sources : List[str]
+            Source trees the build reads
+        target : str, optional
+            Target the build is for
+        compiler : str, optional
+            Compiler whose version is part of the key
+        outputs : Sequence[str], optional
+            Folders the build writes to, untracked files in them are not
+            hashed. Untracked files matching ``patterns`` never are
+        """
+        make_dir = os.path.abspath(make_dir)
+        inputs = {
+            "target": target,
+            # Relative so checkouts in different places share entries
+            "make_dir": os.path.relpath(make_dir, os.path.abspath(sources[0])),
+            "make_args": " ".join(arg for arg in make_args if not arg.startswith("-j")),
+            "compiler": compiler_version(compiler),
+        }
+        for index, source in enumerate(sources):
+            inputs[f"source{index}"] = tree_hash(
+                os.path.abspath(source),
+                [os.path.abspath(path) for path in outputs],
+                self.patterns,
+            )
+
+        inputs["key"] = hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        return inputs
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def lock(self, key: str):
+        """Open and lock the lock file of a key, close it to unlock"""
+        lock_dir = os.path.join(self.directory, "locks")
+        os.makedirs(lock_dir, exist_ok=True)
+
+        lock_file = open(  # pylint: disable=consider-using-with
+            os.path.join(lock_dir, f"{key}.lock"), "w", encoding="utf-8"
+        )
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        return lock_file
+
+    def restore(self, key: str, make_dir: str) -> bool:
+        """Copy the artifacts of an entry into the make folder
+
+        Returns
+        -------
+        bool
+            True if the entry exists and was restored
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, MANIFEST), "r", encoding="utf-8") as manifest:
+                files = json.load(manifest)["files"]
+        except (OSError, ValueError, KeyError):
+            return False
+
+        for index, rel_path in enumerate(files):
+            dest = os.path.normpath(os.path.join(make_dir, rel_path))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copy2(os.path.join(entry, "files", str(index)), dest)
+
+        # Least recently used entries are pruned first
+        os.utime(os.path.join(entry, MANIFEST))
+        return True
+
+    def artifacts(self, make_dir: str, outputs: List[str]) -> List[str]:
+        """Build artifacts in the output folders, relative to the make folder"""
+        found = set()
+        for output in outputs:
+            for folder, _, files in os.walk(output):
+                for name in files:
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns):
+                        path = os.path.join(folder, name)
+                        found.add(os.path.relpath(path, make_dir))
+
+        return sorted(found)
+
+    def store(self, inputs: Dict[str, str], make_dir: str, outputs: List[str]) -> int:
+        """Store the artifacts of a successful build
+
+        Returns
+        -------
+        int
+            Number of files stored
+        """
+        entry = self._entry(inputs["key"])
+        files = self.artifacts(make_dir, outputs)
+
+        # Artifacts are stored by index, paths may leave the make folder
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(os.path.join(tmp_entry, "files"))
+        for index, rel_path in enumerate(files):
+            shutil.copy2(
+                os.path.join(make_dir, rel_path),
+                os.path.join(tmp_entry, "files", str(index)),
+            )
+
+        with open(os.path.join(tmp_entry, MANIFEST), "w", encoding="utf-8") as manifest:
+            json.dump({"inputs": inputs, "files": files}, manifest, indent=4)
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+
+        self.prune()
+        return len(files)
+
+    def prune(self):
+        """Remove the least recently used entries over ``max_entries``"""
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if prefix == "locks" or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                manifest = os.path.join(prefix_dir, key, MANIFEST)
+                if os.path.isfile(manifest):
+                    entries.append((os.path.getmtime(manifest), prefix_dir, key))
+
+        entries.sort(reverse=True)
+        for _, prefix_dir, key in entries[self.max_entries :]:
+            shutil.rmtree(os.path.join(prefix_dir, key), ignore_errors=True)
+
+
+def _git_toplevel(path: str) -> str:
+    toplevel = _git(path, "rev-parse", "--show-toplevel")
+    return toplevel.decode("utf-8").strip() if toplevel else path
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Run make, restoring the build artifacts from a cache if the "
+        "sources, target and make variables are unchanged",
+        epilog="Make goals and variables follow --, e.g. -- -j BOARD=EvKit_V1",
+    )
+    parser.add_argument("-C", "--make-dir", required=True, help="Folder to run make in")
+    parser.add_argument(
+        "-s",
+        "--source",
+        action="append",
+        default=[],
+        help="Source tree the build reads, may be given more than once. "
+        "Defaults to the git checkout holding the make folder",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="append",
+        default=[],
+        help="Folder the build writes artifacts to. Untracked files in it are not "
+        "hashed. Defaults to the make folder, of which only the build folder is "
+        "not hashed",
+    )
+    parser.add_argument("-t", "--target", default="", help="Target being built")
+    parser.add_argument(
+        "-p",
+        "--pattern",
+        action="append",
+        help=f"Artifact file pattern. Defaults to {' '.join(DEFAULT_PATTERNS)}",
+    )
+    parser.add_argument(
+        "-c", "--cache-dir", default=DEFAULT_CACHE_DIR, help="Cache folder"
+    )
+    parser.add_argument(
+        "--max-entries",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="Entries kept in the cache",
+    )
+    parser.add_argument(
+        "--clean",
+        choices=("clean", "distclean"),
+        help="Make goal run before building when the cache misses",
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Always build")
+    parser.add_argument("make_args", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.make_args[:1] == ["--"]:
+        args.make_args = args.make_args[1:]
+
+    return args
+
+
+def main():
+    args = config_cli()
+
+    make_dir = os.path.abspath(args.make_dir)
+    sources = args.source or [_git_toplevel(make_dir)]
+    outputs = [os.path.abspath(output) for output in args.output] or [make_dir]
+    cache = BuildCache(
+        args.cache_dir, args.pattern or DEFAULT_PATTERNS, args.max_entries
+    )
+
+    def _make(*goals: str) -> int:
+        return subprocess.run(["make", "-C", make_dir, *goals], check=False).returncode
+
+    if args.no_cache:
+        sys.exit(_make(*args.make_args))
+
+    start = time.monotonic()
+    # The make folder may hold new sources, so by default only its build
+    # folder, where MSDK projects write to, is skipped besides artifacts
+    inputs = cache.key(
+        make_dir,
+        args.make_args,
+        sources,
+        args.target,
+        outputs=[os.path.abspath(output) for output in args.output]
+        or [os.path.join(make_dir, "build")],
+    )
+    key = inputs["key"]
+
+    # Held until exit, so a concurrent build of the same key waits and hits
+    lock_file = cache.lock(key)
+
+    if cache.restore(key, make_dir):
+        print(
+            f"BUILD_CACHE: hit {key[:12]} for {make_dir} "
+            f"({time.monotonic() - start:.1f} s)"
+        )
+        return
+
+    print(f"BUILD_CACHE: miss {key[:12]} for {make_dir}")
+    if args.clean:
+        code = _make(args.clean)
+        if code:
+            sys.exit(code)
+
+    code = _make(*args.make_args)
+    if code:
+        sys.exit(code)
+
+    count = cache.store(inputs, make_dir, outputs)
+    print(f"BUILD_CACHE: stored {count} files as {key[:12]}")
+    lock_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,68 @@ function upper() {
     echo ${val^^}
 }
 
+# Directory of this script, exported so the functions find ocd_params.py
+export FLASH_UTILS_DIR=$(dirname $(realpath ${BASH_SOURCE[0]}))
+
+function ocdparams() {
+    # Sets current_owner, target, dapsn, dap_interface, gdbport, telnetport
+    # and tclport for board $1 with a single resource manager lookup
+    local name=$1
+    local params
+    params=$(python3 $FLASH_UTILS_DIR/ocd_params.py $name)
+    case $? in
+        0)
+            eval "$params"
+            return 0
+            ;;
+        3)
+            # No target or dap_sn, ocd_params.py printed why
+            return -1
+            ;;
+    esac
+
+    echo "OCDPARAMS: Batched lookup failed, querying items one at a time"
+    current_owner=$(resource_manager --get-owner $name)
+    target=$(resource_manager -g $name.target)
+    dapsn=$(resource_manager -g $name.dap_sn)
+    dap_interface=$(resource_manager -g $name.dap_interface)
+    gdbport=$(resource_manager -g $name.ocdports.gdb)
+    telnetport=$(resource_manager -g $name.ocdports.telnet)
+    tclport=$(resource_manager -g $name.ocdports.tcl)
+
+    if [[ -z "${dap_interface}" ]]; then
+        dap_interface="cmsis-dap"
+    fi
+
+    if [[ -z "${target}" || -z "${dapsn}" ]]; then
+        echo "OCD_PARAMS: $name: Board config has no target or dap_sn" >&2
+        return -1
+    fi
+}
+
+function ocdserver() {
+    # Runs OpenOCD commands $3... on the running persistent server of board
+    # $1 for owner $2. Returns 2 if the board has no server running, the
+    # caller then starts its own OpenOCD
+    local board=$1
+    local lock_owner=$2
+    shift 2
+
+    local commands=()
+    for command in "$@"; do
+        commands+=(-c "$command")
+    done
+
+    local output
+    output=$(python3 $FLASH_UTILS_DIR/ocd_server.py run $board -o "$lock_owner" "${commands[@]}")
+    local code=$?
+    if [[ $code -ne 2 ]]; then
+        echo "$output"
+    fi
+
+    return $code
+}
+
 function ocdflash() {
     if [[ "$1" == "--help" || $1 == "-h" ]]; then
         printf "flash --> flash a board\n"
@@ -29,7 +91,7 @@ function ocdflash() {
     name=$1
     elfFile=$2
     owner=$3
-    current_owner=$(resource_manager --get-owner $name)
+    ocdparams $name || return -1
 
     if [[ -n $current_owner && $owner != $current_owner ]]; then
         echo Owner $owner does not match current owner $current_owner
@@ -37,16 +99,13 @@ function ocdflash() {
         return -1
     fi
 
-    target=$(resource_manager -g $name.target)
-    dapsn=$(resource_manager -g $name.dap_sn)
-    dap_interface=$(resource_manager -g $name.dap_interface)
-    gdbport=$(resource_manager -g $name.ocdports.gdb)
-    telnetport=$(resource_manager -g $name.ocdports.telnet)
-    tclport=$(resource_manager -g $name.ocdports.tcl)
-
-    if [[ -z "${dap_interface}" ]]; then
-        dap_interface="cmsis-dap"
-    fi
+    # A running server holds the adapter and ports, program through it
+    ocdserver $name "$owner" "program $elfFile verify reset"
+    case $? in
+        0) return 0 ;;
+        2) ;;
+        *) return -1 ;;
+    esac
 
     openocd -s $OPENOCD_PATH \
     -f interface/${dap_interface}.cfg -f target/$(lower $target).cfg -c "adapter serial $dapsn" \
@@ -80,7 +139,7 @@ function ocderase() {
 
     name=$1
     owner=$2
-    current_owner=$(resource_manager --get-owner $name)
+    ocdparams $name || return -1
 
     if [[ -n $current_owner && $owner != $current_owner ]]; then
         echo Owner $owner does not match current owner $current_owner
@@ -88,16 +147,16 @@ function ocderase() {
         return -1
     fi
 
-    target=$(resource_manager -g $name.target)
-    dapsn=$(resource_manager -g $name.dap_sn)
-    dap_interface=$(resource_manager -g $name.dap_interface)
-    gdbport=$(resource_manager -g $name.ocdports.gdb)
-    telnetport=$(resource_manager -g $name.ocdports.telnet)
-    tclport=$(resource_manager -g $name.ocdports.tcl)
-
-    if [[ -z "${dap_interface}" ]]; then
-        dap_interface="cmsis-dap"
+    local banks=("max32xxx mass_erase 0")
+    if [[ "$target" != "MAX32655" ]]; then
+        banks+=("max32xxx mass_erase 1")
     fi
+    ocdserver $name "$owner" "reset halt" "${banks[@]}"
+    case $? in
+        0) return 0 ;;
+        2) ;;
+        *) return -1 ;;
+    esac
 
     openocd -s $OPENOCD_PATH \
     -f interface/${dap_interface}.cfg -f target/$(lower $target).cfg -c "adapter serial $dapsn" \
@@ -131,7 +190,7 @@ function ocdreset() {
 
     name=$1
     owner=$2
-    current_owner=$(resource_manager --get-owner $name)
+    ocdparams $name || return -1
 
     if [[ -n $current_owner && $owner != $current_owner ]]; then
         echo Owner $owner does not match current owner $current_owner
@@ -139,16 +198,12 @@ function ocdreset() {
         return -1
     fi
 
-    target=$(resource_manager -g $name.target)
-    dapsn=$(resource_manager -g $name.dap_sn)
-    dap_interface=$(resource_manager -g $name.dap_interface)
-    gdbport=$(resource_manager -g $name.ocdports.gdb)
-    telnetport=$(resource_manager -g $name.ocdports.telnet)
-    tclport=$(resource_manager -g $name.ocdports.tcl)
-
-    if [[ -z "${dap_interface}" ]]; then
-        dap_interface="cmsis-dap"
-    fi
+    ocdserver $name "$owner" "reset run"
+    case $? in
+        0) return 0 ;;
+        2) ;;
+        *) return -1 ;;
+    esac
 
     openocd -s $OPENOCD_PATH \
         -f interface/${dap_interface}.cfg -f target/$(lower $target).cfg -c "adapter serial $dapsn" \
@@ -174,22 +229,16 @@ function ocdopen() {
 
     name=$1
     owner=$2
-    current_owner=$(resource_manager --get-owner $name)
+    ocdparams $name || return -1
 
     if [[ -n $current_owner && $owner != $current_owner ]]; then
         echo Owner $owner does not match current owner $current_owner
         return -1
     fi
 
-    target=$(resource_manager -g $name.target)
-    dapsn=$(resource_manager -g $name.dap_sn)
-    dap_interface=$(resource_manager -g $name.dap_interface)
-    gdbport=$(resource_manager -g $name.ocdports.gdb)
-    telnetport=$(resource_manager -g $name.ocdports.telnet)
-    tclport=$(resource_manager -g $name.ocdports.tcl)
-
-    if [[ -z "${dap_interface}" ]]; then
-        dap_interface="cmsis-dap"
+    if python3 $FLASH_UTILS_DIR/ocd_server.py run $name -o "$owner" > /dev/null; then
+        echo "OCDOPEN: $name has a persistent server, use ports $gdbport/$telnetport/$tclport"
+        return 0
     fi
 
     openocd -s $OPENOCD_PATH \
@@ -202,6 +251,8 @@ function ocdopen() {
 
 export -f lower
 export -f upper
+export -f ocdparams
+export -f ocdserver
 export -f ocdflash
 export -f ocderase
 export -f ocdreset
@@ -0,0 +1,610 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+ocd_flash.py
+
+Description: Flash or erase many boards concurrently with OpenOCD
+
+"""
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# pylint: disable=import-error,wrong-import-position
+from resource_manager import ResourceManager
+
+from ocd_params import missing_params, ocd_params, openocd_args
+from ocd_server import OcdServerPool, TclError
+
+# pylint: enable=import-error,wrong-import-position
+
+# Seconds one OpenOCD run may take before it is killed
+DEFAULT_TIMEOUT = 120
+# Runs after the first failed one, and the delay before the first of them
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 2.0
+# Boards flashed at once behind one USB hub
+DEFAULT_PER_HUB = 4
+# Lines of OpenOCD output kept in each result
+LOG_TAIL_LINES = 20
+
+# Board config item naming the hub a board is behind, overrides detection
+USB_HUB_ITEM = "usb_hub"
+USB_DEVICES = "/sys/bus/usb/devices"
+
+# Targets with a single flash bank
+SINGLE_BANK_TARGETS = ("MAX32655",)
+
+# Hash of the image last programmed through each debug adapter
+DEFAULT_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "ocd_flash", "images.json"
+)
+
+
+@dataclass
+class FlashJob:
+    """One board to program, or to erase if there is no ELF"""
+
+    board: str
+    elf: Optional[str] = None
+
+    @property
+    def action(self) -> str:
+        return "program" if self.elf else "erase"
+
+
+@dataclass
+class FlashResult:
+    """Outcome of one job"""
+
+    board: str
+    action: str
+    success: bool
+    attempts: int = 0
+    duration: float = 0.0
+    returncode: Optional[int] = None
+    error: str = ""
+    # Programming was skipped because the board already holds the image
+    skipped: bool = False
+    log: List[str] = field(default_factory=list)
+
+
+def image_hash(elf: str) -> str:
+    """SHA-256 of an image file"""
+    digest = hashlib.sha256()
+    with open(elf, "rb") as elf_file:
+        for chunk in iter(lambda: elf_file.read(1 << 16), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class FlashCache:
+    """Hash of the image last programmed on each board, keyed by ``dap_sn``
+
+    The cache is only a hint, boards may be flashed by other tools. A hit is
+    confirmed with ``verify_image`` on the target before programming is
+    skipped. The file is shared by every process on the host and is locked
+    for each update.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE) -> None:
+        self.path = path
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _update(self, dap_sn: str, entry: Optional[Dict[str, str]]):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        with open(f"{self.path}.lock", "w", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            images = self._load()
+            if entry is None:
+                images.pop(dap_sn, None)
+            else:
+                images[dap_sn] = entry
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                json.dump(images, cache_file, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def get(self, dap_sn: str) -> str:
+        """Hash of the image last programmed through an adapter, empty if none"""
+        return self._load().get(dap_sn, {}).get("sha256", "")
+
+    def store(self, dap_sn: str, digest: str, elf: str):
+        """Record an image as programmed"""
+        self._update(dap_sn, {"sha256": digest, "elf": elf})
+
+    def forget(self, dap_sn: str):
+        """Drop an adapter whose board contents are no longer known"""
+        self._update(dap_sn, None)
+
+
+def usb_hub(dap_sn: str) -> str:
+    """USB hub a debug adapter is connected through
+
+    Parameters
+    ----------
+    dap_sn : str
+        Adapter serial number
+
+    Returns
+    -------
+    str
+        sysfs path of the parent hub, e.g. ``1-2``, or "" if not found
+    """
+    for serial_path in glob.glob(os.path.join(USB_DEVICES, "*", "serial")):
+        try:
+            with open(serial_path, "r", encoding="utf-8") as serial_file:
+                serial = serial_file.read().strip()
+        except OSError:
+            continue
+
+        if serial == dap_sn:
+            # 1-2.3 is port 3 of hub 1-2, a root port 1-2 has no parent hub
+            device = os.path.basename(os.path.dirname(serial_path))
+            return device.rsplit(".", 1)[0] if "." in device else device
+
+    return ""
+
+
+def openocd_command(params: Dict[str, str], commands: str) -> List[str]:
+    """OpenOCD command line running ``commands`` on a board
+
+    Parameters
+    ----------
+    params : Dict[str, str]
+        Board parameters from ``ocd_params``
+    commands : str
+        OpenOCD commands to run
+    """
+    return openocd_args(params) + ["-c", commands]
+
+
+def verify_commands(elf: str) -> str:
+    """OpenOCD commands checking a board holds an image
+
+    ``verify_image`` compares a CRC of each section computed on the target,
+    which is much faster than programming.
+    """
+    return f"init; reset halt; verify_image {elf}; reset; exit"
+
+
+def job_commands(job: FlashJob, target: str) -> List[str]:
+    """OpenOCD runs needed for a job, in order"""
+    if job.elf:
+        return [f"program {job.elf} verify; reset; exit"]
+
+    return [
+        f"init; reset halt; max32xxx mass_erase {bank}; exit"
+        for bank in job_banks(target)
+    ]
+
+
+def job_banks(target: str) -> List[int]:
+    """Flash banks to mass erase on a target"""
+    return [0] if target.upper() in SINGLE_BANK_TARGETS else [0, 1]
+
+
+class FlashEngine:
+    """Run flash and erase jobs concurrently
+
+    Each board is flashed in its own thread, but at most ``per_hub`` boards
+    behind the same USB hub at once. A failed OpenOCD run is retried with
+    exponential backoff. With a cache, boards already holding the image are
+    only verified. Boards with a persistent OpenOCD server in ``pool`` are
+    driven through it instead of a new OpenOCD process per run.
+    """
+
+    def __init__(
+        self,
+        resource_manager: ResourceManager,
+        owner: str = "",
+        timeout: float = DEFAULT_TIMEOUT,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        per_hub: int = DEFAULT_PER_HUB,
+        cache: Optional[FlashCache] = None,
+        pool: Optional[OcdServerPool] = None,
+    ) -> None:
+        """Create an engine
+
+        Parameters
+        ----------
+        resource_manager : ResourceManager
+            Resource manager to look the boards up in
+        owner : str, optional
+            Owner the boards must be locked by, if locked at all
+        timeout : float, optional
+            Seconds one OpenOCD run may take
+        retries : int, optional
+            Runs after the first failed one
+        backoff : float, optional
+            Seconds before the first retry, doubled for every further one
+        per_hub : int, optional
+            Boards flashed at once behind one USB hub
+        cache : Optional[FlashCache], optional
+            Cache of programmed images, None to always program
+        pool : Optional[OcdServerPool], optional
+            Persistent OpenOCD servers, None to start OpenOCD for every run
+        """
+        self.resource_manager = resource_manager
+        self.owner = owner
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.per_hub = per_hub
+        self.cache = cache
+        self.pool = pool
+
+        self._hubs: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _hub_slot(self, hub: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if hub not in self._hubs:
+                self._hubs[hub] = threading.BoundedSemaphore(self.per_hub)
+            return self._hubs[hub]
+
+    def _run(self, command: List[str], result: FlashResult) -> bool:
+        try:
+            proc = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=self.timeout,
+                check=False,
+            )
+        except subprocess.TimeoutExpired as err:
+            output = err.output or b""
+            result.returncode = None
+            result.error = f"Timed out after {self.timeout} s"
+        except OSError as err:
+            output = b""
+            result.returncode = None
+            result.error = str(err)
+        else:
+            output = proc.stdout
+            result.returncode = proc.returncode
+            result.error = "" if proc.returncode == 0 else "OpenOCD failed"
+
+        lines = output.decode("utf-8", "replace").splitlines()
+        result.log = lines[-LOG_TAIL_LINES:]
+
+        return not result.error
+
+    def _check(self, job: FlashJob, params: Dict[str, str]) -> str:
+        if params["owner"] and params["owner"] != self.owner:
+            return f"Owner {self.owner} does not match owner {params['owner']}"
+        missing = missing_params(params)
+        if missing:
+            return missing
+        if job.elf and not os.path.isfile(job.elf):
+            return f"{job.elf} does not exist"
+
+        return ""
+
+    def _rpc(
+        self, job: FlashJob, target: str, result: FlashResult, verify: bool
+    ) -> bool:
+        try:
+            with self.pool.client(job.board, self.timeout) as client:
+                if verify:
+                    client.verify_image(job.elf)
+                elif job.elf:
+                    client.program(job.elf)
+                else:
+                    client.reset("halt")
+                    for bank in job_banks(target):
+                        client.mass_erase(bank)
+        except (OSError, RuntimeError, TclError) as err:
+            result.error = str(err)
+            result.log = str(err).splitlines()[-LOG_TAIL_LINES:]
+            return False
+
+        result.error = ""
+        result.returncode = 0
+        return True
+
+    def _execute(
+        self,
+        job: FlashJob,
+        params: Dict[str, str],
+        hub: str,
+        result: FlashResult,
+        verify: bool = False,
+    ) -> bool:
+        with self._hub_slot(hub):
+            if self.pool is not None and self.pool.available(job.board, params):
+                return self._rpc(job, params["target"], result, verify)
+
+            if verify:
+                runs = [verify_commands(job.elf)]
+            else:
+                runs = job_commands(job, params["target"])
+
+            return all(
+                self._run(openocd_command(params, commands), result)
+                for commands in runs
+            )
+
+    def run_job(self, job: FlashJob, params: Dict[str, str], hub: str) -> FlashResult:
+        """Run one job with retries
+
+        Parameters
+        ----------
+        job : FlashJob
+            Board and image
+        params : Dict[str, str]
+            Board parameters from ``ocd_params``
+        hub : str
+            USB hub the board's adapter is behind
+
+        Returns
+        -------
+        FlashResult
+            Result of the last attempt
+        """
+        result = FlashResult(job.board, job.action, success=False)
+        result.error = self._check(job, params)
+        if result.error:
+            return result
+
+        start = time.monotonic()
+        dap_sn = params["dap_sn"]
+        digest = image_hash(job.elf) if job.elf and self.cache is not None else ""
+
+        if digest and self.cache.get(dap_sn) == digest:
+            if self._execute(job, params, hub, result, verify=True):
+                result.success = result.skipped = True
+                result.duration = round(time.monotonic() - start, 2)
+                return result
+
+        # Contents are unknown until programming or erasing succeeds
+        if self.cache is not None:
+            self.cache.forget(dap_sn)
+
+        delay = self.backoff
+        for attempt in range(1, self.retries + 2):
+            result.attempts = attempt
+            result.success = self._execute(job, params, hub, result)
+            if result.success or attempt > self.retries:
+                break
+
+            time.sleep(delay)
+            delay *= 2
+
+        if result.success and digest:
+            self.cache.store(dap_sn, digest, job.elf)
+
+        result.duration = round(time.monotonic() - start, 2)
+        return result
+
+    def run(
+        self, jobs: List[FlashJob], workers: Optional[int] = None
+    ) -> List[FlashResult]:
+        """Run all jobs concurrently
+
+        Parameters
+        ----------
+        jobs : List[FlashJob]
+            Jobs, at most one per board
+        workers : Optional[int], optional
+            Boards flashed at once overall. Defaults to all of them
+
+        Returns
+        -------
+        List[FlashResult]
+            Result of each job in the order of ``jobs``
+        """
+        params = {
+            job.board: ocd_params(self.resource_manager, job.board) for job in jobs
+        }
+
+        def _ports(board: str) -> List[Tuple[str, str]]:
+            # Unset ports are left to OpenOCD and can not clash
+            return [
+                (name, params[board][name])
+                for name in ("gdb_port", "telnet_port", "tcl_port")
+                if params[board].get(name)
+            ]
+
+        # Two OpenOCD instances can not listen on the same port
+        ports = Counter(port for job in jobs for port in _ports(job.board))
+        hubs = {}
+        for job in jobs:
+            hubs[job.board] = self.resource_manager.get_item_value(
+                f"{job.board}.{USB_HUB_ITEM}", default=""
+            ) or usb_hub(params[job.board]["dap_sn"])
+
+        def _job(job: FlashJob) -> FlashResult:
+            clashes = [
+                f"{name} {value}"
+                for name, value in _ports(job.board)
+                if ports[(name, value)] > 1
+            ]
+            if clashes:
+                return FlashResult(
+                    job.board,
+                    job.action,
+                    success=False,
+                    error=f"Ports shared with another board: {', '.join(clashes)}",
+                )
+
+            return self.run_job(job, params[job.board], hubs[job.board])
+
+        with ThreadPoolExecutor(max_workers=workers or max(len(jobs), 1)) as pool:
+            return list(pool.map(_job, jobs))
+
+
+def _job_arg(value: str) -> FlashJob:
+    board, sep, elf = value.partition(":")
+    if not board or (sep and not elf):
+        raise argparse.ArgumentTypeError(f"Expected BOARD:ELF or BOARD, got {value}")
+
+    return FlashJob(board, os.path.abspath(elf) if elf else None)
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Flash or erase several boards concurrently",
+    )
+    parser.add_argument(
+        "jobs",
+        nargs="+",
+        type=_job_arg,
+        metavar="BOARD[:ELF]",
+        help="Board to program with ELF, or to mass erase if no ELF is given",
+    )
+    parser.add_argument("-o", "--owner", default="", help="Owner of the board locks")
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Seconds one OpenOCD run may take",
+    )
+    parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Retries of a failed OpenOCD run",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=DEFAULT_BACKOFF,
+        help="Seconds before the first retry, doubled for every further one",
+    )
+    parser.add_argument(
+        "--per-hub",
+        type=int,
+        default=DEFAULT_PER_HUB,
+        help="Boards flashed at once behind one USB hub",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        dest="workers",
+        help="Boards flashed at once overall",
+    )
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--cache",
+        default=DEFAULT_CACHE,
+        help="File recording the image last programmed on each board",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Start an OpenOCD server for boards without one, stopped again on "
+        "exit. Boards with a running server always use it",
+    )
+    parser.add_argument(
+        "--keep-servers",
+        action="store_true",
+        help="Leave the servers started by --server running. Resets that start "
+        "their own OpenOCD, e.g. resource_manager, fail while they run",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always program, even if the board already holds the image",
+    )
+
+    return parser.parse_args()
+
+
+def _status(result: FlashResult) -> str:
+    if result.skipped:
+        return "Same"
+
+    return "Pass" if result.success else "Fail"
+
+
+def main():
+    args = config_cli()
+
+    boards = [job.board for job in args.jobs]
+    if len(boards) != len(set(boards)):
+        print("OCD_FLASH: Every board may only be given once")
+        sys.exit(-1)
+
+    resource_manager = ResourceManager()
+    pool = OcdServerPool(resource_manager, start=args.server)
+    engine = FlashEngine(
+        resource_manager,
+        owner=args.owner,
+        timeout=args.timeout,
+        retries=args.retries,
+        backoff=args.backoff,
+        per_hub=args.per_hub,
+        cache=None if args.no_cache else FlashCache(args.cache),
+        pool=pool,
+    )
+    try:
+        results = engine.run(args.jobs, workers=args.workers)
+    finally:
+        # A running server holds the adapter and ports of its board
+        if not args.keep_servers:
+            pool.stop_started()
+
+    print(f"{'BOARD':<20} {'ACTION':<8} {'RESULT':<7} {'TRIES':<6} {'TIME':<8} ERROR")
+    for result in results:
+        if not result.success and result.log:
+            print("\n".join(result.log))
+        print(
+            f"{result.board:<20} {result.action:<8} "
+            f"{_status(result):<7} {result.attempts:<6} "
+            f"{result.duration:<8} {result.error}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump([asdict(result) for result in results], json_file, indent=4)
+
+    if not all(result.success for result in results):
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+ocd_params.py
+
+Description: Print every OpenOCD parameter of one or more boards in one lookup
+
+"""
+import argparse
+import json
+import os
+import shlex
+import sys
+from typing import Dict, List
+
+# pylint: disable=import-error
+from resource_manager import ResourceManager
+
+# pylint: enable=import-error
+
+DEFAULT_DAP_INTERFACE = "cmsis-dap"
+# Exit code of the sh format when OpenOCD can not be run on the board
+MISSING_PARAMS_EXIT = 3
+
+# Shell variable name of each parameter, as used by flash-utils.sh
+SHELL_NAMES = {
+    "owner": "current_owner",
+    "target": "target",
+    "dap_sn": "dapsn",
+    "dap_interface": "dap_interface",
+    "gdb_port": "gdbport",
+    "telnet_port": "telnetport",
+    "tcl_port": "tclport",
+}
+
+
+def ocd_params(resource_manager: ResourceManager, board: str) -> Dict[str, str]:
+    """Look up everything needed to run OpenOCD on a board
+
+    Parameters
+    ----------
+    resource_manager : ResourceManager
+        Resource manager holding the parsed board config
+    board : str
+        Board name as shown in the resource manager
+
+    Returns
+    -------
+    Dict[str, str]
+        Owner, target, DAP serial number and interface, and OpenOCD ports
+    """
+
+    def _get(item: str, default: str = "") -> str:
+        value = resource_manager.get_item_value(f"{board}.{item}", default=default)
+        return "" if value is None else str(value)
+
+    return {
+        "owner": resource_manager.get_owner(board) or "",
+        "target": _get("target"),
+        "dap_sn": _get("dap_sn"),
+        "dap_interface": _get("dap_interface") or DEFAULT_DAP_INTERFACE,
+        "gdb_port": _get("ocdports.gdb"),
+        "telnet_port": _get("ocdports.telnet"),
+        "tcl_port": _get("ocdports.tcl"),
+    }
+
+
+def missing_params(params: Dict[str, str]) -> str:
+    """Error if OpenOCD can not be run on a board, empty if it can"""
+    if not params["target"] or not params["dap_sn"]:
+        return "Board config has no target or dap_sn"
+
+    return ""
+
+
+def openocd_args(params: Dict[str, str]) -> List[str]:
+    """OpenOCD command line selecting a board, same as ``flash-utils.sh``
+
+    Parameters
+    ----------
+    params : Dict[str, str]
+        Board parameters from ``ocd_params``
+
+    Returns
+    -------
+    List[str]
+        Arguments up to, but not including, the commands to run
+    """
+    return [
+        "openocd",
+        "-s",
+        os.environ.get("OPENOCD_PATH", ""),
+        "-f",
+        f"interface/{params['dap_interface']}.cfg",
+        "-f",
+        f"target/{params['target'].lower()}.cfg",
+        "-c",
+        f"adapter serial {params['dap_sn']}",
+        "-c",
+        f"gdb_port {params['gdb_port']}",
+        "-c",
+        f"telnet_port {params['telnet_port']}",
+        "-c",
+        f"tcl_port {params['tcl_port']}",
+    ]
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Print the OpenOCD parameters of boards in one resource "
+        "manager lookup",
+    )
+    parser.add_argument(
+        "boards", nargs="+", help="Board names as shown in the resource manager"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("sh", "json"),
+        default="sh",
+        help="sh prints variable assignments for eval, one board only, and "
+        f"exits with {MISSING_PARAMS_EXIT} if it has no target or dap_sn. "
+        "json prints an object keyed by board",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = config_cli()
+
+    if args.format == "sh" and len(args.boards) != 1:
+        print("OCD_PARAMS: sh format takes exactly one board", file=sys.stderr)
+        sys.exit(-1)
+
+    resource_manager = ResourceManager()
+    params = {board: ocd_params(resource_manager, board) for board in args.boards}
+
+    if args.format == "json":
+        print(json.dumps(params, indent=4))
+        return
+
+    board = args.boards[0]
+    error = missing_params(params[board])
+    if error:
+        print(f"OCD_PARAMS: {board}: {error}", file=sys.stderr)
+        sys.exit(MISSING_PARAMS_EXIT)
+
+    for name, value in params[board].items():
+        print(f"{SHELL_NAMES[name]}={shlex.quote(value)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+ocd_server.py
+
+Description: Keep one OpenOCD server running per board and drive it over
+the TCL RPC port
+
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+# pylint: disable=import-error,wrong-import-position
+from resource_manager import ResourceManager
+
+from ocd_params import ocd_params, openocd_args
+
+# pylint: enable=import-error,wrong-import-position
+
+# OpenOCD ends every TCL RPC command and reply with this byte
+TCL_TERMINATOR = b"\x1a"
+TCL_HOST = "localhost"
+# Seconds one TCL RPC command may take
+DEFAULT_TCL_TIMEOUT = 120
+# Seconds a new server may take to open its TCL port
+START_TIMEOUT = 10
+# Seconds a server may take to exit after a shutdown command
+STOP_TIMEOUT = 5
+# Exit code of the run action when a board has no server running
+NO_SERVER_EXIT = 2
+
+# Pid and log files of the servers
+SERVER_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ocd_flash", "servers")
+
+
+class TclError(Exception):
+    """A command failed on the OpenOCD server"""
+
+
+def _is_openocd(pid: int) -> bool:
+    """True if a live process with this pid is OpenOCD, the pid may be reused"""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as cmdline:
+            return b"openocd" in cmdline.read()
+    except OSError:
+        return False
+
+
+class TclClient:
+    """Client of the OpenOCD TCL RPC server
+
+    Use as a context manager so the connection is closed afterwards. The
+    server itself keeps running.
+    """
+
+    def __init__(
+        self, port: int, host: str = TCL_HOST, timeout: float = DEFAULT_TCL_TIMEOUT
+    ) -> None:
+        self.port = int(port)
+        self.host = host
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+        self._buffer = b""
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def connect(self):
+        """Connect to the server, raises OSError if it is not listening"""
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, command: str) -> str:
+        """Send one command and return the reply as is"""
+        self.sock.sendall(command.encode("utf-8") + TCL_TERMINATOR)
+
+        while TCL_TERMINATOR not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("OpenOCD closed the TCL connection")
+            self._buffer += data
+
+        reply, _, self._buffer = self._buffer.partition(TCL_TERMINATOR)
+        return reply.decode("utf-8", "replace")
+
+    def run(self, command: str) -> str:
+        """Run a command, capturing its log output
+
+        Parameters
+        ----------
+        command : str
+            OpenOCD command, e.g. ``reset run``
+
+        Returns
+        -------
+        str
+            Output of the command
+
+        Raises
+        ------
+        TclError
+            If the command failed, with its output as the message
+        """
+        reply = self.send(
+            f'format "%d %s" [catch {{capture {{{command}}}}} _ocd_out] $_ocd_out'
+        )
+        code, _, output = reply.partition(" ")
+        if code != "0":
+            raise TclError(output.strip() or f"{command} failed")
+
+        return output
+
+    def program(self, elf: str, verify: bool = True):
+        """Program an image and let the target run"""
+        self.run(f"program {elf}{' verify' if verify else ''} reset")
+
+    def verify_image(self, elf: str):
+        """Check the target holds an image, raises TclError if not"""
+        self.run("reset halt")
+        self.run(f"verify_image {elf}")
+        self.run("reset run")
+
+    def reset(self, mode: str = "run"):
+        """Reset the target, mode is run, halt or init"""
+        self.run(f"reset {mode}")
+
+    def mass_erase(self, bank: int):
+        """Mass erase one flash bank, the target must be halted"""
+        self.run(f"max32xxx mass_erase {bank}")
+
+
+class OcdServer:
+    """OpenOCD server of one board
+
+    The server runs detached from this process, so later scripts reuse it
+    and skip probe enumeration and target setup. Its pid and log are kept
+    in ``directory``.
+    """
+
+    def __init__(self, board: str, params: Dict[str, str], directory: str = SERVER_DIR):
+        self.board = board
+        self.params = params
+        self.pid_path = os.path.join(directory, f"{board}.pid")
+        self.log_path = os.path.join(directory, f"{board}.log")
+
+    @property
+    def port(self) -> int:
+        return int(self.params["tcl_port"])
+
+    def client(self, timeout: float = DEFAULT_TCL_TIMEOUT) -> TclClient:
+        return TclClient(self.port, timeout=timeout)
+
+    @property
+    def configured(self) -> bool:
+        """True if the board has a TCL port for a server to listen on"""
+        return bool(self.params.get("tcl_port"))
+
+    def running(self) -> bool:
+        """True if the server answers on its TCL port"""
+        if not self.configured:
+            return False
+
+        try:
+            with self.client(timeout=1) as client:
+                client.send("version")
+        except OSError:
+            return False
+
+        return True
+
+    def _pid(self) -> Optional[int]:
+        try:
+            with open(self.pid_path, "r", encoding="utf-8") as pid_file:
+                return int(pid_file.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def start(self) -> bool:
+        """Start the server unless it is already running
+
+        Returns
+        -------
+        bool
+            True if a new server was started
+
+        Raises
+        ------
+        RuntimeError
+            If the board has no TCL port, or OpenOCD exits or does not open
+            its TCL port in time
+        """
+        if not self.configured:
+            raise RuntimeError(f"{self.board} has no OpenOCD TCL port configured")
+        if self.running():
+            return False
+
+        os.makedirs(os.path.dirname(self.pid_path), exist_ok=True)
+        with open(self.log_path, "w", encoding="utf-8") as log_file:
+            proc = subprocess.Popen(
+                openocd_args(self.params) + ["-c", "init"],
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        with open(self.pid_path, "w", encoding="utf-8") as pid_file:
+            pid_file.write(str(proc.pid))
+
+        deadline = time.monotonic() + START_TIMEOUT
+        while not self.running():
+            if proc.poll() is not None:
+                raise RuntimeError(
+                    f"OpenOCD for {self.board} exited, see {self.log_path}"
+                )
+            if time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError(
+                    f"OpenOCD for {self.board} did not start, see {self.log_path}"
+                )
+            time.sleep(0.1)
+
+        return True
+
+    def stop(self):
+        """Shut the server down
+
+        The saved pid is only signalled if it is still OpenOCD after the
+        shutdown command, e.g. when the server hung and did not answer.
+        """
+        shut_down = False
+        if self.running():
+            try:
+                with self.client(timeout=STOP_TIMEOUT) as client:
+                    client.send("shutdown")
+                shut_down = True
+            except OSError:
+                pass
+
+        pid = self._pid()
+        try:
+            if pid is None:
+                return
+
+            deadline = time.monotonic() + (STOP_TIMEOUT if shut_down else 0)
+            while _is_openocd(pid) and time.monotonic() < deadline:
+                time.sleep(0.1)
+
+            if _is_openocd(pid):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        finally:
+            try:
+                os.remove(self.pid_path)
+            except FileNotFoundError:
+                pass
+
+
+class OcdServerPool:
+    """OpenOCD servers of all boards used by a script"""
+
+    def __init__(
+        self,
+        resource_manager: ResourceManager,
+        start: bool = True,
+        directory: str = SERVER_DIR,
+    ) -> None:
+        """Create a pool
+
+        Parameters
+        ----------
+        resource_manager : ResourceManager
+            Resource manager to look the boards up in
+        start : bool, optional
+            Start servers that are not running yet, otherwise only running
+            servers are used
+        directory : str, optional
+            Directory of the server pid and log files
+        """
+        self.resource_manager = resource_manager
+        self.start = start
+        self.directory = directory
+        self._servers: Dict[str, OcdServer] = {}
+        # Boards whose server this pool started
+        self.started: List[str] = []
+        self._lock = threading.Lock()
+
+    def server(self, board: str, params: Optional[Dict[str, str]] = None) -> OcdServer:
+        """Server of a board, not necessarily running"""
+        if board not in self._servers:
+            if params is None:
+                params = ocd_params(self.resource_manager, board)
+            self._servers[board] = OcdServer(board, params, self.directory)
+
+        return self._servers[board]
+
+    def available(self, board: str, params: Optional[Dict[str, str]] = None) -> bool:
+        """True if commands for a board can go through its server"""
+        server = self.server(board, params)
+        if not server.configured:
+            return False
+
+        return self.start or server.running()
+
+    def client(self, board: str, timeout: float = DEFAULT_TCL_TIMEOUT) -> TclClient:
+        """Client of a board's server, starting the server if allowed"""
+        server = self.server(board)
+        if self.start and server.start():
+            with self._lock:
+                self.started.append(board)
+
+        return server.client(timeout)
+
+    def stop_started(self):
+        """Stop the servers this pool started, others keep running"""
+        for board in self.started:
+            self._servers[board].stop()
+        self.started.clear()
+
+    def stop_all(self):
+        for server in self._servers.values():
+            server.stop()
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Start, stop or use the persistent OpenOCD server of boards",
+    )
+    parser.add_argument(
+        "action",
+        choices=("start", "stop", "status", "reset", "run"),
+        help="reset resets the target through its server, starting it if needed. "
+        "run runs the --command options on a running server, exiting with "
+        f"{NO_SERVER_EXIT} if a board has none",
+    )
+    parser.add_argument(
+        "boards", nargs="+", help="Board names as shown in the resource manager"
+    )
+    parser.add_argument("-o", "--owner", default="", help="Owner of the board locks")
+    parser.add_argument(
+        "-c",
+        "--command",
+        action="append",
+        default=[],
+        help="OpenOCD command for run, may be given more than once",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = config_cli()
+
+    pool = OcdServerPool(ResourceManager())
+    failed: List[str] = []
+    missing: List[str] = []
+
+    for board in args.boards:
+        server = pool.server(board)
+        owner = server.params["owner"]
+
+        if args.action == "run" and not server.running():
+            print(f"{board}: No OpenOCD server running")
+            missing.append(board)
+            continue
+
+        if args.action in ("start", "reset", "run") and owner and owner != args.owner:
+            print(f"{board}: Owner {args.owner} does not match owner {owner}")
+            failed.append(board)
+            continue
+
+        try:
+            if args.action == "start":
+                server.start()
+            elif args.action == "stop":
+                server.stop()
+            elif args.action == "reset":
+                with pool.client(board) as client:
+                    client.reset()
+            elif args.action == "run":
+                with server.client() as client:
+                    for command in args.command:
+                        output = client.run(command).rstrip("\n")
+                        if output:
+                            print(output)
+        except (OSError, RuntimeError, TclError) as err:
+            print(f"{board}: {err}")
+            failed.append(board)
+            continue
+
+        state = "running" if server.running() else "stopped"
+        print(f"{board:<20} tcl {server.params['tcl_port'] or '-':<6} {state}")
+
+    if failed:
+        sys.exit(-1)
+    if missing:
+        sys.exit(NO_SERVER_EXIT)
+
+
+if __name__ == "__main__":
+    main()
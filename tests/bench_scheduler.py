@@ -0,0 +1,471 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+bench_scheduler.py
+
+Description: Run a board pair test suite across the whole bench in parallel
+
+"""
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# pylint: disable=import-error,wrong-import-position
+from resource_manager import ResourceManager
+
+# pylint: enable=import-error,wrong-import-position
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class Suite:
+    """Test script run once per board pair"""
+
+    directory: str
+    script: str
+    uses_rf_switch: bool
+    # Supports --no-report/--report-only so the report is built unlocked
+    deferred_report: bool = False
+    # Option selecting the results directory, the working directory is used if None
+    results_option: Optional[str] = None
+    # Option selecting the attenuator, RF pairs share the calibrated one if None
+    attenuator_option: Optional[str] = None
+
+
+SUITES = {
+    "dats": Suite("dats", "datsc_connected.py", uses_rf_switch=False),
+    "otas": Suite("otas", "otas_connected.py", uses_rf_switch=False),
+    "per_heatmap": Suite(
+        "per",
+        "per_heatmap.py",
+        uses_rf_switch=True,
+        results_option="--results",
+        attenuator_option="--attenuator",
+    ),
+    "per_connection": Suite(
+        "per", "per_connection.py", uses_rf_switch=True, results_option="-d"
+    ),
+    "connection_stability": Suite(
+        "per",
+        "connection_stability.py",
+        uses_rf_switch=True,
+        deferred_report=True,
+        results_option="-d",
+    ),
+}
+
+
+@dataclass
+class PairResult:
+    """Outcome of one suite run on a board pair"""
+
+    pair: Tuple[str, str]
+    returncode: int
+    log_path: str
+    duration: float
+    report_returncode: Optional[int] = None
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Run a test suite concurrently on every compatible board pair",
+        epilog="Arguments after -- are passed to the suite. {first} and {second} "
+        "are replaced with the pair's board names. Each pair runs in, and writes "
+        "its results to, LOGS/FIRST_SECOND.",
+    )
+
+    parser.add_argument("suite", choices=sorted(SUITES), help="Test suite to run")
+    parser.add_argument(
+        "-b", "--boards", nargs="+", default=[], help="Boards to use. Default all"
+    )
+    parser.add_argument("--target", default="", help="Only use boards of this target")
+    parser.add_argument(
+        "--testers",
+        nargs="+",
+        default=[],
+        help="Boards that must take the first role of each pair (e.g. nRF testers)",
+    )
+    parser.add_argument(
+        "-o", "--owner", default="bench_scheduler", help="Lock owner name"
+    )
+    parser.add_argument(
+        "--lock-timeout", default=3600, type=int, help="Lock timeout in seconds"
+    )
+    parser.add_argument(
+        "-l", "--logs", default="bench_logs", help="Directory for per pair logs"
+    )
+    parser.add_argument(
+        "--attenuators",
+        nargs="+",
+        default=[],
+        help="Attenuator serial numbers, one per RF pair running at once. Only "
+        "for suites selecting their attenuator (per_heatmap). Otherwise RF suites "
+        "run one pair at a time on the calibrated attenuator",
+    )
+    parser.add_argument(
+        "--report-jobs",
+        default=os.cpu_count(),
+        type=int,
+        help="Reports built at once after the boards are released",
+    )
+    parser.add_argument("suite_args", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.suite_args and args.suite_args[0] == "--":
+        args.suite_args = args.suite_args[1:]
+
+    return args
+
+
+def get_inventory(
+    resource_manager: ResourceManager, boards: List[str], target: str
+) -> Dict[str, Optional[str]]:
+    """Get the switch each usable board is routed through
+
+    Parameters
+    ----------
+    resource_manager : ResourceManager
+        Resource manager holding the board config
+    boards : List[str]
+        Boards to consider. All boards in the config if empty
+    target : str
+        Only keep boards of this target if not empty
+
+    Returns
+    -------
+    Dict[str, Optional[str]]
+        Board name to RF switch model. None if the board has no switch
+    """
+    if not boards:
+        boards = sorted(resource_manager.resources.keys())
+
+    inventory = {}
+    for board in boards:
+        board_target = resource_manager.get_item_value(f"{board}.target", default="")
+        if not board_target:
+            # Not a board (e.g. bench equipment entries)
+            continue
+        if target and board_target.upper() != target.upper():
+            continue
+
+        sw_model, sw_port = resource_manager.get_switch_config(board)
+        inventory[board] = sw_model if sw_model and sw_port else None
+
+    return inventory
+
+
+def pair_boards(
+    inventory: Dict[str, Optional[str]], testers: List[str]
+) -> List[Tuple[str, str]]:
+    """Build the largest set of disjoint compatible board pairs
+
+    Boards of a pair must sit on different RF switches, as asserted by
+    ``utils.config_switches``.
+
+    Parameters
+    ----------
+    inventory : Dict[str, Optional[str]]
+        Board name to RF switch model
+    testers : List[str]
+        Boards that must take the first role. Any board may if empty
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        Disjoint board pairs
+    """
+
+    def compatible(first, second):
+        sw_first, sw_second = inventory[first], inventory[second]
+        return sw_first is None or sw_second is None or sw_first != sw_second
+
+    if testers:
+        # Bipartite tester/DUT matching with augmenting paths
+        duts = [board for board in inventory if board not in testers]
+        matched: Dict[str, str] = {}
+
+        def augment(tester, seen):
+            for dut in duts:
+                if dut in seen or not compatible(tester, dut):
+                    continue
+                seen.add(dut)
+                if dut not in matched or augment(matched[dut], seen):
+                    matched[dut] = tester
+                    return True
+            return False
+
+        for tester in testers:
+            if tester in inventory:
+                augment(tester, set())
+
+        return sorted((tester, dut) for dut, tester in matched.items())
+
+    # Any two boards on different switches are compatible, so repeatedly
+    # pairing from the two largest switch groups gives a maximum matching
+    groups = defaultdict(list)
+    for board, sw_model in inventory.items():
+        groups[sw_model if sw_model is not None else board].append(board)
+
+    pairs = []
+    while True:
+        ranked = sorted(groups.values(), key=len, reverse=True)
+        if len(ranked) < 2 or not ranked[1]:
+            break
+        pairs.append((ranked[0].pop(0), ranked[1].pop(0)))
+
+    return pairs
+
+
+def _lock(command: str, boards: List[str], owner: str, timeout: int) -> bool:
+    result = subprocess.run(
+        ["resource_manager", command, *boards, "--owner", owner, "--timeout", f"{timeout}"],
+        check=False,
+    )
+    return result.returncode == 0
+
+
+class BenchScheduler:
+    """Run a suite on many board pairs at once
+
+    Boards of a pair are locked for the duration of its run. Suites that
+    route through the RF switches also hold both switches so no two running
+    pairs reconfigure the same switch, and take an attenuator from a pool so
+    no two running pairs set the same attenuator. Without ``attenuators``
+    the pool holds only the calibrated attenuator of the bench.
+
+    Each pair runs in its own folder under ``log_dir``, so the results and
+    console logs of concurrent pairs do not overwrite each other.
+
+    Suites with a deferred report only measure while locked. Their reports
+    are built after the boards are unlocked, at most ``report_jobs`` at once.
+    """
+
+    def __init__(
+        self,
+        suite: Suite,
+        suite_args: List[str],
+        inventory: Dict[str, Optional[str]],
+        owner: str,
+        lock_timeout: int,
+        log_dir: str,
+        report_jobs: int = 1,
+        attenuators: Optional[List[str]] = None,
+    ) -> None:
+        self.suite = suite
+        self.suite_args = suite_args
+        self.inventory = inventory
+        self.owner = owner
+        self.lock_timeout = lock_timeout
+        self.log_dir = log_dir
+        self.switch_locks = defaultdict(threading.Lock)
+        self.attenuators: "queue.Queue[Optional[str]]" = queue.Queue()
+        for attenuator in attenuators or [None]:
+            self.attenuators.put(attenuator)
+        self.report_slots = threading.BoundedSemaphore(max(report_jobs, 1))
+        self.results: List[PairResult] = []
+        self.results_lock = threading.Lock()
+
+    def _switches(self, pair: Tuple[str, str]) -> List[str]:
+        if not self.suite.uses_rf_switch:
+            return []
+
+        return sorted(
+            {self.inventory[board] for board in pair if self.inventory[board] is not None}
+        )
+
+    def _run_pair(self, pair: Tuple[str, str]):
+        first, second = pair
+        log_path = os.path.join(
+            self.log_dir, f"{os.path.splitext(self.suite.script)[0]}_{first}_{second}.log"
+        )
+        args = [arg.format(first=first, second=second) for arg in self.suite_args]
+
+        # Suites write to relative folders by default, keep pairs apart
+        cwd = os.path.abspath(os.path.join(self.log_dir, f"{first}_{second}"))
+        os.makedirs(cwd, exist_ok=True)
+        script = os.path.join(TESTS_DIR, self.suite.directory, self.suite.script)
+        command = [sys.executable, script, first, second, *args]
+        if self.suite.results_option:
+            command += [self.suite.results_option, os.path.join(cwd, "results")]
+
+        # Taken before the switches, a pair waiting for an attenuator holds none
+        attenuator = self.attenuators.get() if self.suite.uses_rf_switch else None
+        if attenuator is not None:
+            command += [self.suite.attenuator_option, attenuator]
+
+        # Acquire in sorted order so two pairs can never deadlock
+        switch_locks = [self.switch_locks[sw] for sw in self._switches(pair)]
+        for lock in switch_locks:
+            lock.acquire()
+
+        start = datetime.now()
+        returncode = -1
+        report_returncode = None
+        try:
+            try:
+                if not _lock("-l", list(pair), self.owner, self.lock_timeout):
+                    print(f"Failed to lock {first} and {second}")
+                    return
+
+                try:
+                    print(f"Starting {self.suite.script} on {first} {second}")
+                    measure = command + (
+                        ["--no-report"] if self.suite.deferred_report else []
+                    )
+                    with open(log_path, "w", encoding="utf-8") as log_file:
+                        returncode = subprocess.run(
+                            measure,
+                            cwd=cwd,
+                            stdout=log_file,
+                            stderr=subprocess.STDOUT,
+                            check=False,
+                        ).returncode
+                finally:
+                    _lock("-u", list(pair), self.owner, self.lock_timeout)
+            finally:
+                for lock in reversed(switch_locks):
+                    lock.release()
+                if self.suite.uses_rf_switch:
+                    self.attenuators.put(attenuator)
+
+            # The boards are free for the next run while the report renders
+            if self.suite.deferred_report and returncode == 0:
+                with self.report_slots, open(log_path, "a", encoding="utf-8") as log_file:
+                    print(f"Building {self.suite.script} report for {first} {second}")
+                    report_returncode = subprocess.run(
+                        [*command, "--report-only"],
+                        cwd=cwd,
+                        stdout=log_file,
+                        stderr=subprocess.STDOUT,
+                        check=False,
+                    ).returncode
+        finally:
+            with self.results_lock:
+                self.results.append(
+                    PairResult(
+                        pair=pair,
+                        returncode=returncode,
+                        log_path=log_path,
+                        duration=(datetime.now() - start).total_seconds(),
+                        report_returncode=report_returncode,
+                    )
+                )
+
+    def run(self, pairs: List[Tuple[str, str]]) -> List[PairResult]:
+        """Run the suite on all pairs and wait for them to finish
+
+        Parameters
+        ----------
+        pairs : List[Tuple[str, str]]
+            Disjoint board pairs
+
+        Returns
+        -------
+        List[PairResult]
+            One result per pair
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        threads = [
+            threading.Thread(target=self._run_pair, args=(pair,), name="-".join(pair))
+            for pair in pairs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.results
+
+
+def _print_results(suite_name, results: List[PairResult]):
+    overall = True
+
+    print(f"{suite_name} RESULTS")
+    print(f"{'PAIR':<40} {'Time (s)':<10} Result")
+    for result in sorted(results, key=lambda res: res.pair):
+        print("-" * 60)
+        passed = result.returncode == 0 and result.report_returncode in (None, 0)
+        print(
+            f"{' / '.join(result.pair):<40} {int(result.duration):<10} "
+            f"{'Pass' if passed else 'Fail'}"
+        )
+
+        if not passed:
+            overall = False
+            print(f"  log: {result.log_path}")
+
+    print("-" * 60, "\n")
+
+    return overall
+
+
+def main():
+    args = config_cli()
+    suite = SUITES[args.suite]
+
+    resource_manager = ResourceManager()
+    inventory = get_inventory(resource_manager, args.boards, args.target)
+    if args.testers:
+        inventory.update(get_inventory(resource_manager, args.testers, ""))
+
+    if suite.uses_rf_switch:
+        unswitched = [board for board, sw_model in inventory.items() if sw_model is None]
+        for board in unswitched:
+            print(f"Skipping {board}, it has no RF switch configured")
+            del inventory[board]
+
+    if args.attenuators and not suite.attenuator_option:
+        print(f"{args.suite} does not select an attenuator, drop --attenuators")
+        sys.exit(-1)
+
+    pairs = pair_boards(inventory, args.testers)
+    if not pairs:
+        print("No compatible board pairs found!")
+        sys.exit(-1)
+
+    for first, second in pairs:
+        print(f"Pair {first} <-> {second}")
+
+    scheduler = BenchScheduler(
+        suite=suite,
+        suite_args=args.suite_args,
+        inventory=inventory,
+        owner=args.owner,
+        lock_timeout=args.lock_timeout,
+        log_dir=args.logs,
+        report_jobs=args.report_jobs,
+        attenuators=args.attenuators,
+    )
+    results = scheduler.run(pairs)
+
+    if not _print_results(args.suite.upper(), results):
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+async_console.py
+
+Description: asyncio console harness driving many boards from one event loop
+
+"""
+import asyncio
+import inspect
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+import serial
+
+from console_sequences import RETRY_INTERVAL, ConsoleStep, PairingStep
+from serial_expect import (
+    CONSOLE_RING_SIZE,
+    ECHO_TIMEOUT,
+    MATCH_OVERLAP,
+    PACED_BYTE_DELAY,
+    ConsoleLog,
+    Deadline,
+    Expectation,
+    Pattern,
+    StreamMatcher,
+)
+
+
+async def _resolve(value):
+    # Callbacks and retry actions may be plain functions or coroutines
+    if inspect.isawaitable(value):
+        return await value
+
+    return value
+
+
+class AsyncConsole:
+    """Wait on a serial console for one of several patterns without a thread
+
+    The port is watched by the event loop, so any number of consoles can
+    wait at once and a wait is cancelled like any other task. Uses
+    ``loop.add_reader`` and so needs a POSIX serial port.
+    """
+
+    def __init__(
+        self,
+        serial_port: serial.Serial,
+        on_data: Optional[Callable[[str], None]] = None,
+        overlap: int = MATCH_OVERLAP,
+    ) -> None:
+        self.serial_port = serial_port
+        self.on_data = on_data
+        self.overlap = overlap
+        # Received text not yet consumed by a wait, only the last
+        # CONSOLE_RING_SIZE characters are kept
+        self.pending = ""
+
+        self._data = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._error: Optional[BaseException] = None
+
+    def open(self):
+        """Start watching the port on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.serial_port.fileno(), self._on_readable)
+
+    def close(self):
+        """Stop watching the port"""
+        if self._loop is not None:
+            self._loop.remove_reader(self.serial_port.fileno())
+            self._loop = None
+
+    def _on_readable(self):
+        try:
+            data = self.serial_port.read(self.serial_port.in_waiting or 1)
+        except serial.SerialException as err:
+            # Wake the waiter so it raises instead of timing out
+            self._error = err
+            self.close()
+            self._data.set()
+            return
+
+        if not data:
+            return
+
+        text = data.decode("utf-8", "replace")
+        if self.on_data is not None:
+            self.on_data(text)
+
+        self.pending = (self.pending + text)[-CONSOLE_RING_SIZE:]
+        self._data.set()
+
+    def _take(self) -> str:
+        if self._error is not None:
+            raise self._error
+
+        text, self.pending = self.pending, ""
+        return text
+
+    async def _wait_data(self, timeout: float):
+        if self.pending or self._error is not None:
+            return
+
+        self._data.clear()
+        try:
+            await asyncio.wait_for(self._data.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def write(
+        self,
+        data: bytes,
+        echo: Optional[Pattern] = None,
+        timeout: float = ECHO_TIMEOUT,
+        byte_delay: float = 0.0,
+    ) -> bool:
+        """Write a console command and wait for the target to respond
+
+        Same as ``ConsoleExpect.write``, except paced bytes are spaced with
+        ``asyncio.sleep`` so other consoles keep running.
+
+        Returns
+        -------
+        bool
+            True if the echo was seen before the timeout
+        """
+        if byte_delay:
+            for byte in data:
+                self.serial_port.write(bytes([byte]))
+                await asyncio.sleep(byte_delay)
+        else:
+            self.serial_port.write(data)
+
+        if echo is None:
+            echo = data.decode("utf-8", "replace").strip()
+        if not echo:
+            return True
+
+        result = await self.expect(
+            [(echo, lambda _: True)], timeout=timeout, consume_before=False
+        )
+
+        return result is not None
+
+    async def expect(
+        self,
+        expectations: List[Expectation],
+        timeout: Union[float, Deadline],
+        retry: Optional[Callable[[], object]] = None,
+        retry_interval: float = 1.0,
+        consume_before: bool = True,
+    ):
+        """Wait for the first of several patterns
+
+        Same as ``ConsoleExpect.expect``. Callbacks and the retry action may
+        also be coroutine functions.
+
+        Returns
+        -------
+        object
+            Callback result, or None on timeout
+        """
+        deadline = timeout if isinstance(timeout, Deadline) else Deadline(timeout)
+        matcher = StreamMatcher(expectations, self.overlap)
+
+        matcher.feed(self._take())
+        next_retry = time.monotonic() + retry_interval
+
+        if retry is not None:
+            await _resolve(retry())
+            matcher.feed(self._take())
+
+        while True:
+            found = matcher.next_match()
+
+            if found is not None:
+                match, callback = found
+                result = await _resolve(
+                    callback(match) if callback is not None else match
+                )
+                if result is not None:
+                    # Text received while the callback ran follows the remainder
+                    unconsumed = matcher.remainder()
+                    if not consume_before:
+                        unconsumed = matcher.before + unconsumed
+                    self.pending = unconsumed + self.pending
+                    return result
+                matcher.feed(self._take())
+                continue
+
+            if deadline.expired():
+                self.pending = matcher.remainder() + self.pending
+                return None
+
+            wait = deadline.remaining()
+            if retry is not None:
+                if time.monotonic() >= next_retry:
+                    await _resolve(retry())
+                    matcher.feed(self._take())
+                    next_retry = time.monotonic() + retry_interval
+                wait = min(wait, max(0.0, next_retry - time.monotonic()))
+
+            await self._wait_data(wait)
+            matcher.feed(self._take())
+
+
+class AsyncTester:
+    """Board console with the ``BasicTester`` API for use in an event loop
+
+    Use as an async context manager so the port and log are closed when the
+    test finishes, fails or is cancelled.
+    """
+
+    def __init__(
+        self,
+        portname: str,
+        name: str = "",
+        paced: bool = False,
+        log_path: Optional[str] = None,
+        echo: bool = False,
+    ) -> None:
+        """Open a board console
+
+        Parameters
+        ----------
+        portname : str
+            Console serial port
+        name : str, optional
+            Board name used to prefix echoed output
+        paced : bool, optional
+            Write console commands one byte at a time
+        log_path : Optional[str], optional
+            File the console is streamed to
+        echo : bool, optional
+            Print the console output as it arrives
+        """
+        self.portname = portname
+        self.name = name or portname
+        self.byte_delay = PACED_BYTE_DELAY if paced else 0.0
+        self.echo = echo
+        self.console_log = ConsoleLog(log_path)
+        self.console_log.watch("TIMEOUT")
+        self.serial_port = serial.Serial(portname, baudrate=115200, timeout=0)
+        self.serial_port.flush()
+        self.console = AsyncConsole(self.serial_port, on_data=self._log_output)
+
+    async def __aenter__(self):
+        self.console.open()
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+    def close(self):
+        """Stop watching the console and close the port and log"""
+        self.console.close()
+        self.serial_port.close()
+        self.console_log.close()
+
+    @property
+    def console_output(self) -> str:
+        return self.console_log.text()
+
+    def _log_output(self, text: str):
+        self.console_log.append(text)
+        if self.echo:
+            for line in text.splitlines():
+                print(f"[{self.name}] {line}")
+
+    async def slow_write(self, data: bytes):
+        """Write a console command and wait for the target to echo it"""
+        await self.console.write(data, byte_delay=self.byte_delay)
+
+    async def press_btn(self, btn_num: int, method: str):
+        """Press button via console
+
+        Parameters
+        ----------
+        btn_num : int
+            Button number (1/2)
+        method : str
+            Button method (s/m/l/x)
+        """
+        command = f"btn {btn_num} {method}\r".encode("utf-8")
+        await self.console.write(command, byte_delay=self.byte_delay)
+
+    async def expect(self, expectations: List[Expectation], timeout, **kwargs):
+        """Wait for the first of several patterns, see ``AsyncConsole.expect``"""
+        return await self.console.expect(expectations, timeout, **kwargs)
+
+    def test_stable_connection(self) -> bool:
+        return "TIMEOUT" not in self.console_log
+
+    def save_console_output(self, path: str):
+        """Close the console log and store it as ``path``"""
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        if self.console_log.path is not None:
+            self.console_log.move(path)
+            return
+
+        with open(path, "w", encoding="utf-8") as console_out_file:
+            console_out_file.write(self.console_output)
+
+
+async def run_step(console: AsyncConsole, step: ConsoleStep, byte_delay: float = 0.0):
+    """Run one step on a console, see ``console_sequences.run_step``"""
+
+    async def _send():
+        for command in step.commands:
+            await console.write(command.encode("utf-8"), byte_delay=byte_delay)
+
+    if step.repeat and step.commands:
+        found = await console.expect(
+            step.expectations(),
+            timeout=step.timeout,
+            retry=_send,
+            retry_interval=RETRY_INTERVAL,
+        )
+    else:
+        await _send()
+        found = await console.expect(step.expectations(), timeout=step.timeout)
+
+    if found is None and step.second_try_after:
+        await asyncio.sleep(step.second_try_after)
+        return await run_step(console, step.last_try(), byte_delay)
+
+    return found
+
+
+async def run_steps(console: AsyncConsole, steps, byte_delay: float = 0.0):
+    """Run the steps of one test, see ``console_sequences.run_steps``"""
+    found = None
+    for step in steps:
+        found = await run_step(console, step, byte_delay)
+        if found is None:
+            print(f"\nTIMEOUT: {step.name}")
+            return None
+
+    return found
+
+
+async def run_pairing(
+    console: AsyncConsole, step: PairingStep, byte_delay: float = 0.0
+) -> bool:
+    """Pair, see ``console_sequences.run_pairing``"""
+    deadline = Deadline(step.timeout)
+
+    async def _send_pin(_):
+        await asyncio.sleep(step.pin_delay)
+        await console.write(step.pin_command.encode("utf-8"), byte_delay=byte_delay)
+        deadline.restart()
+
+    result = await console.expect(
+        [(step.prompt, _send_pin)]
+        + [(pattern, lambda _: True) for pattern in step.passed]
+        + [(step.failed, lambda _: False)],
+        timeout=deadline,
+    )
+
+    if result is None:
+        print(f"\nTIMEOUT: {step.name}")
+        return False
+
+    return result
+
+
+@dataclass
+class BoardJob:
+    """Test sequence of one board or pair run by ``run_jobs``"""
+
+    name: str
+    run: Callable[[], Awaitable[Dict[str, bool]]]
+    # Seconds before the sequence is cancelled
+    timeout: float
+
+
+async def with_timeout(
+    name: str, coro: Awaitable[Dict[str, bool]], timeout: float
+) -> Dict[str, bool]:
+    """Run a test sequence, cancelling it once ``timeout`` passes
+
+    A sequence that times out or raises fails without affecting the
+    others. Only cancellation of the caller is passed on.
+
+    Returns
+    -------
+    Dict[str, bool]
+        Results of the sequence, or a single failed "timeout" or "error"
+    """
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        print(f"\nTIMEOUT: {name} did not finish within {timeout} s")
+        return {"timeout": False}
+    except Exception as err:  # pylint: disable=broad-except
+        print(f"\nERROR: {name}: {type(err).__name__}: {err}")
+        return {"error": False}
+
+
+async def run_jobs(jobs: List[BoardJob]) -> Dict[str, Dict[str, bool]]:
+    """Run all test sequences concurrently on the current event loop
+
+    Parameters
+    ----------
+    jobs : List[BoardJob]
+        Sequences to run
+
+    Returns
+    -------
+    Dict[str, Dict[str, bool]]
+        Results of each sequence by name
+    """
+    results = await asyncio.gather(
+        *(with_timeout(job.name, job.run(), job.timeout) for job in jobs)
+    )
+
+    return {job.name: result for job, result in zip(jobs, results)}
@@ -0,0 +1,243 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+console_sequences.py
+
+Description: Console test sequences of the DATS/DATC and OTAS/OTAC examples,
+shared by the threaded testers and the asyncio rack
+
+"""
+import dataclasses
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from serial_expect import ConsoleExpect, Deadline, Pattern
+
+# Seconds between repeated console commands while waiting for a response
+RETRY_INTERVAL = 1.0
+
+
+@dataclass(frozen=True)
+class ConsoleStep:
+    """Console commands sent until one of the patterns shows up"""
+
+    # Shown when the step times out
+    name: str
+    # Any of them passes the step
+    patterns: Tuple[Pattern, ...]
+    # Written in order, again every RETRY_INTERVAL if ``repeat``
+    commands: Tuple[str, ...] = ()
+    timeout: float = 10
+    repeat: bool = True
+    # Seconds before the step is tried once more after a timeout, 0 for never
+    second_try_after: float = 0
+
+    def expectations(self):
+        return [(pattern, lambda match: match) for pattern in self.patterns]
+
+    def last_try(self) -> "ConsoleStep":
+        return dataclasses.replace(self, second_try_after=0)
+
+
+@dataclass(frozen=True)
+class PairingStep:
+    """Secure pairing, entering the pin whenever a passkey is asked for"""
+
+    name: str
+    prompt: Pattern
+    pin_command: str
+    passed: Tuple[Pattern, ...]
+    failed: Pattern
+    # Restarted every time the pin is entered
+    timeout: float = 10
+    # Seconds between the prompt and entering the pin
+    pin_delay: float = 1
+
+
+BTN2_CONSOLE = "btn 2 {}\n"
+BTN2_PRESS = "btn 2 {}\r"
+
+PAIRING = PairingStep(
+    name="Secure connection test",
+    prompt="passkey",
+    pin_command="pin 1 1234\n",
+    passed=("Pairing completed successfully", "Connection encrypted"),
+    failed="Pairing failed",
+)
+
+# DATC tests run after pairing, in order
+DATC_TESTS: Dict[str, Tuple[ConsoleStep, ...]] = {
+    "write characteristic": (
+        ConsoleStep("Write Char Test", ("hello",), (BTN2_CONSOLE.format("l"),)),
+    ),
+    "speed": (
+        ConsoleStep(
+            "Speed test",
+            ("bps",),
+            (BTN2_CONSOLE.format("x"), BTN2_CONSOLE.format("m")),
+            timeout=20,
+        ),
+    ),
+    "write secure": (
+        ConsoleStep(
+            "Write Secure char test",
+            ("Secure data received!",),
+            (BTN2_CONSOLE.format("l"), BTN2_CONSOLE.format("m")),
+        ),
+    ),
+    "phy switch": (
+        ConsoleStep(
+            "PHY switch test",
+            ("PHY Requested", "DM_PHY_UPDATE_IND"),
+            (BTN2_CONSOLE.format("s"),),
+        ),
+    ),
+}
+
+VERSION_PATTERN = re.compile(r"FW_VERSION:\s*(.+)")
+
+OTAS_TESTS: Dict[str, Tuple[ConsoleStep, ...]] = {
+    "versioning": (
+        ConsoleStep("Version test", (VERSION_PATTERN,), (BTN2_PRESS.format("m"),)),
+    ),
+}
+
+OTAC_TESTS: Dict[str, Tuple[ConsoleStep, ...]] = {
+    "filespace": (
+        ConsoleStep(
+            "File discovery",
+            ("File discovery complete",),
+            (BTN2_PRESS.format("s"),),
+            second_try_after=5,
+        ),
+    ),
+    "update": (
+        ConsoleStep(
+            "Start file transfer",
+            ("Starting file transfer",),
+            (BTN2_PRESS.format("m"),),
+        ),
+        ConsoleStep("File transfer", ("transfer complete",), timeout=30),
+    ),
+    "verify": (
+        ConsoleStep(
+            "Verify transfer",
+            (re.compile(r"Verify complete status:\s*(.+)"),),
+            (BTN2_PRESS.format("l"),),
+            repeat=False,
+        ),
+    ),
+}
+
+
+def run_step(console: ConsoleExpect, step: ConsoleStep, byte_delay: float = 0.0):
+    """Run one step on a console
+
+    Parameters
+    ----------
+    console : ConsoleExpect
+        Console of the board
+    step : ConsoleStep
+        Step to run
+    byte_delay : float, optional
+        Delay between command bytes for paced boards
+
+    Returns
+    -------
+    re.Match
+        Match of the pattern seen, or None on timeout
+    """
+
+    def _send():
+        for command in step.commands:
+            console.write(command.encode("utf-8"), byte_delay=byte_delay)
+
+    if step.repeat and step.commands:
+        found = console.expect(
+            step.expectations(),
+            timeout=step.timeout,
+            retry=_send,
+            retry_interval=RETRY_INTERVAL,
+        )
+    else:
+        _send()
+        found = console.expect(step.expectations(), timeout=step.timeout)
+
+    if found is None and step.second_try_after:
+        time.sleep(step.second_try_after)
+        return run_step(console, step.last_try(), byte_delay)
+
+    return found
+
+
+def run_steps(
+    console: ConsoleExpect, steps: Tuple[ConsoleStep, ...], byte_delay: float = 0.0
+):
+    """Run the steps of one test in order, stopping at the first timeout
+
+    Returns
+    -------
+    re.Match
+        Match of the last step, or None if a step timed out
+    """
+    found = None
+    for step in steps:
+        found = run_step(console, step, byte_delay)
+        if found is None:
+            print(f"\nTIMEOUT: {step.name}")
+            return None
+
+    return found
+
+
+def run_pairing(
+    console: ConsoleExpect, step: PairingStep, byte_delay: float = 0.0
+) -> bool:
+    """Pair, entering the pin when asked for a passkey
+
+    Returns
+    -------
+    bool
+        True if pairing completed
+    """
+    deadline = Deadline(step.timeout)
+
+    def _send_pin(_):
+        time.sleep(step.pin_delay)
+        console.write(step.pin_command.encode("utf-8"), byte_delay=byte_delay)
+        deadline.restart()
+
+    result = console.expect(
+        [(step.prompt, _send_pin)]
+        + [(pattern, lambda _: True) for pattern in step.passed]
+        + [(step.failed, lambda _: False)],
+        timeout=deadline,
+    )
+
+    if result is None:
+        print(f"\nTIMEOUT: {step.name}")
+        return False
+
+    return result
+
+
+def version(found: Optional["re.Match"]) -> str:
+    """Firmware version from the match of the OTAS versioning test"""
+    return found.group(1) if found is not None else ""
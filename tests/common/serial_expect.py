@@ -0,0 +1,495 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+serial_expect.py
+
+Description: Blocking expect engine shared by the console based tests
+
+"""
+import os
+import re
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+import serial
+
+# Longest time a single blocking read may wait before the deadline and
+# retry timers are checked again
+READ_SLICE = 0.5
+
+# Longest time to wait for the target to echo a command
+ECHO_TIMEOUT = 0.5
+
+# Delay after each byte for targets that need paced console writes
+PACED_BYTE_DELAY = 0.1
+
+# Board config item flagging targets that need paced console writes
+CONSOLE_PACED_ITEM = "console_paced"
+
+# Characters kept between reads so regex matches may span read chunks
+MATCH_OVERLAP = 256
+
+# Characters of recent console output kept in memory, both by the console
+# log and by a wait that has not matched yet
+CONSOLE_RING_SIZE = 64 * 1024
+
+# Size in bytes a console log file may reach before it is rotated
+CONSOLE_LOG_MAX_BYTES = 16 * 1024 * 1024
+
+# Rotated console log files kept next to the current one
+CONSOLE_LOG_BACKUPS = 3
+
+Pattern = Union[str, "re.Pattern"]
+Expectation = Tuple[Pattern, Optional[Callable[["re.Match"], object]]]
+
+
+def console_paced(resource_manager, board: str) -> bool:
+    """Check if a board is flagged as needing paced console writes
+
+    Parameters
+    ----------
+    resource_manager : ResourceManager
+        Resource manager to read the board config from
+    board : str
+        Board name as shown in the resource manager
+
+    Returns
+    -------
+    bool
+        True if console data must be written one byte at a time
+    """
+    value = resource_manager.get_item_value(
+        f"{board}.{CONSOLE_PACED_ITEM}", default="false"
+    )
+
+    return str(value).lower() in ("1", "true", "yes")
+
+
+class Deadline:
+    """Restartable monotonic deadline"""
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+        self.end = 0.0
+        self.restart()
+
+    def restart(self):
+        """Restart the deadline from now"""
+        self.end = time.monotonic() + self.timeout
+
+    def remaining(self) -> float:
+        """Seconds left before the deadline expires"""
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self) -> bool:
+        """True once the deadline has passed"""
+        return time.monotonic() >= self.end
+
+
+class ConsoleLog:
+    """Console output streamed to a rotating log file
+
+    Only the most recent ``ring_size`` characters are kept in memory. With a
+    path, all output is written to the file as it arrives and flushed so
+    the log survives a crash of the test. Once the file would exceed
+    ``max_bytes`` it is renamed to ``<path>.1``, older files move up to
+    ``<path>.<backups>`` and the oldest is dropped.
+
+    Strings registered with ``watch`` are tracked over the whole output, so
+    checks such as ``"TIMEOUT" in log`` also see text that has left memory.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ring_size: int = CONSOLE_RING_SIZE,
+        max_bytes: int = CONSOLE_LOG_MAX_BYTES,
+        backups: int = CONSOLE_LOG_BACKUPS,
+    ) -> None:
+        self.path = path
+        self.ring_size = ring_size
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.chunks: Deque[str] = deque()
+        # Characters held in memory and received in total
+        self.size = 0
+        self.total = 0
+
+        self._watched: Dict[str, bool] = {}
+        self._tail = ""
+        self._file = None
+        self._file_size = 0
+
+        if path is not None:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            # Rotated files of an earlier run would read as part of this one
+            for path_ in self.files()[1:]:
+                os.remove(path_)
+            self._file = open(path, "wb")
+
+    def files(self) -> List[str]:
+        """Existing log files, newest first"""
+        if self.path is None:
+            return []
+
+        paths = [self.path] + [f"{self.path}.{i}" for i in range(1, self.backups + 1)]
+        return [path for path in paths if os.path.exists(path)]
+
+    def watch(self, text: str):
+        """Track whether ``text`` ever appears in the output"""
+        self._watched.setdefault(text, text in self.text())
+
+    def append(self, text: str):
+        """Add newly received text to the log"""
+        if not text:
+            return
+
+        if self._watched:
+            window = self._tail + text
+            for watched, seen in self._watched.items():
+                if not seen and watched in window:
+                    self._watched[watched] = True
+            overlap = max(len(watched) for watched in self._watched) - 1
+            self._tail = window[-overlap:] if overlap > 0 else ""
+
+        self.chunks.append(text)
+        self.size += len(text)
+        self.total += len(text)
+        while self.size - len(self.chunks[0]) >= self.ring_size:
+            self.size -= len(self.chunks.popleft())
+        if self.size > self.ring_size:
+            excess = self.size - self.ring_size
+            self.chunks[0] = self.chunks[0][excess:]
+            self.size -= excess
+
+        if self._file is not None:
+            self._write(text.encode("utf-8", "replace"))
+
+    def _write(self, data: bytes):
+        if self._file_size and self._file_size + len(data) > self.max_bytes:
+            self._rotate()
+
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+
+        self._file = open(self.path, "wb")
+        self._file_size = 0
+
+    def close(self):
+        """Close the log file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def move(self, path: str):
+        """Close the log and rename its files to ``path``, ``path.1`` and so on"""
+        self.close()
+        if self.path is None or os.path.abspath(path) == os.path.abspath(self.path):
+            return
+
+        for index, src in enumerate(self.files()):
+            os.replace(src, f"{path}.{index}" if index else path)
+        self.path = path
+
+    def text(self) -> str:
+        """Most recent output held in memory"""
+        if len(self.chunks) > 1:
+            self.chunks = deque(["".join(self.chunks)])
+
+        return self.chunks[0] if self.chunks else ""
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def __len__(self) -> int:
+        return self.total
+
+    def __contains__(self, item: str) -> bool:
+        if self._watched.get(item):
+            return True
+
+        return item in self.text()
+
+
+class StreamMatcher:
+    """Incremental matcher over a stream of text
+
+    Only newly fed text is scanned, plus a tail of the previous window so
+    matches that straddle two reads are still found.
+    """
+
+    def __init__(
+        self,
+        expectations: List[Expectation],
+        overlap: int = MATCH_OVERLAP,
+        max_history: int = CONSOLE_RING_SIZE,
+    ):
+        self.expectations = []
+        self.overlap = 0
+        self.window = ""
+        # Unmatched text already scanned, only the last max_history is kept
+        self.history: Deque[str] = deque()
+        self.history_size = 0
+        self.max_history = max_history
+        self.before = ""
+
+        for pattern, callback in expectations:
+            if isinstance(pattern, str):
+                self.overlap = max(self.overlap, len(pattern) - 1)
+                pattern = re.compile(re.escape(pattern))
+            else:
+                self.overlap = max(self.overlap, overlap)
+            self.expectations.append((pattern, callback))
+
+    def feed(self, text: str):
+        """Add newly received text to the search window"""
+        self.window += text
+
+    def remainder(self) -> str:
+        """All text fed since the last match that has not been matched"""
+        return "".join(self.history) + self.window
+
+    def _keep(self, text: str):
+        self.history.append(text)
+        self.history_size += len(text)
+        while self.history and self.history_size > self.max_history:
+            excess = self.history_size - self.max_history
+            if len(self.history[0]) <= excess:
+                self.history_size -= len(self.history.popleft())
+            else:
+                self.history[0] = self.history[0][excess:]
+                self.history_size -= excess
+
+    def next_match(self):
+        """Find the earliest match in the current window
+
+        Text preceding a match is kept in ``before``.
+
+        Returns
+        -------
+        Optional[Tuple[re.Match, Callable]]
+            Match and its callback, or None if nothing matched
+        """
+        found = None
+        for regex, callback in self.expectations:
+            match = regex.search(self.window)
+            if match and (found is None or match.start() < found[0].start()):
+                found = (match, callback)
+
+        if found is not None:
+            match = found[0]
+            self.before = "".join(self.history) + self.window[: match.start()]
+            self.history.clear()
+            self.history_size = 0
+            self.window = self.window[match.end() :]
+        else:
+            cut = len(self.window) - self.overlap
+            if cut > 0:
+                self._keep(self.window[:cut])
+                self.window = self.window[cut:]
+
+        return found
+
+
+class ConsoleExpect:
+    """Wait on a serial console for one of several patterns
+
+    Reads block in the serial driver until data arrives, so a waiting
+    test sleeps in the kernel instead of polling ``in_waiting``.
+    """
+
+    def __init__(
+        self,
+        serial_port: serial.Serial,
+        on_data: Optional[Callable[[str], None]] = None,
+        overlap: int = MATCH_OVERLAP,
+    ) -> None:
+        self.serial_port = serial_port
+        self.on_data = on_data
+        self.overlap = overlap
+        self.pending = ""
+
+    def read(self, timeout: float) -> str:
+        """Block until data arrives or the timeout expires
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time to wait in seconds
+
+        Returns
+        -------
+        str
+            Decoded text, empty on timeout
+        """
+        timeout = round(max(timeout, 0.0), 3)
+        if self.serial_port.timeout != timeout:
+            self.serial_port.timeout = timeout
+
+        data = self.serial_port.read(1)
+        if not data:
+            return ""
+
+        waiting = self.serial_port.in_waiting
+        if waiting:
+            data += self.serial_port.read(waiting)
+
+        text = data.decode("utf-8", "replace")
+
+        if self.on_data is not None:
+            self.on_data(text)
+
+        return text
+
+    def _absorb_pending(self, matcher: StreamMatcher):
+        # Callbacks and retry actions may wait on the console themselves.
+        # Whatever they left unconsumed belongs to the outer wait.
+        matcher.feed(self.pending)
+        self.pending = ""
+
+    def write(
+        self,
+        data: bytes,
+        echo: Optional[Pattern] = None,
+        timeout: float = ECHO_TIMEOUT,
+        byte_delay: float = 0.0,
+    ) -> bool:
+        """Write a console command and wait for the target to respond
+
+        The command is written in one go and the call returns as soon as the
+        target echoes it instead of after a fixed delay. Targets that drop
+        characters on bulk writes can be paced with ``byte_delay``.
+
+        Parameters
+        ----------
+        data : bytes
+            Data to write out
+        echo : Optional[Pattern], optional
+            Echo or prompt to wait for, defaults to the command text itself
+        timeout : float, optional
+            Maximum time to wait for the echo
+        byte_delay : float, optional
+            Delay after each byte, 0 writes the whole command at once
+
+        Returns
+        -------
+        bool
+            True if the echo was seen before the timeout
+        """
+        if byte_delay:
+            for byte in data:
+                self.serial_port.write(bytes([byte]))
+                time.sleep(byte_delay)
+        else:
+            self.serial_port.write(data)
+
+        if echo is None:
+            echo = data.decode("utf-8", "replace").strip()
+        if not echo:
+            return True
+
+        result = self.expect(
+            [(echo, lambda _: True)], timeout=timeout, consume_before=False
+        )
+
+        return result is not None
+
+    def expect(
+        self,
+        expectations: List[Expectation],
+        timeout: Union[float, Deadline],
+        retry: Optional[Callable[[], None]] = None,
+        retry_interval: float = 1.0,
+        consume_before: bool = True,
+    ):
+        """Wait for the first of several patterns
+
+        Parameters
+        ----------
+        expectations : List[Expectation]
+            (pattern, callback) pairs. Patterns are plain strings or compiled
+            regexes. The callback receives the match and its return value is
+            returned from ``expect``. A callback returning None keeps waiting.
+            A missing callback returns the match itself.
+        timeout : Union[float, Deadline]
+            Timeout in seconds or a deadline the callbacks may restart
+        retry : Optional[Callable[[], None]], optional
+            Action to repeat while nothing has matched, e.g. a button press
+        retry_interval : float, optional
+            Seconds between retry actions
+        consume_before : bool, optional
+            Discard the text preceding the match. When False it is left for
+            the next wait along with the text following the match.
+
+        Returns
+        -------
+        object
+            Callback result, or None on timeout
+        """
+        deadline = timeout if isinstance(timeout, Deadline) else Deadline(timeout)
+        matcher = StreamMatcher(expectations, self.overlap)
+
+        matcher.feed(self.pending)
+        self.pending = ""
+        next_retry = time.monotonic() + retry_interval
+
+        if retry is not None:
+            retry()
+            self._absorb_pending(matcher)
+
+        while True:
+            found = matcher.next_match()
+
+            if found is not None:
+                match, callback = found
+                result = callback(match) if callback is not None else match
+                if result is not None:
+                    self.pending = matcher.remainder()
+                    if not consume_before:
+                        self.pending = matcher.before + self.pending
+                    return result
+                self._absorb_pending(matcher)
+                continue
+
+            if deadline.expired():
+                self.pending = matcher.remainder()
+                return None
+
+            wait = deadline.remaining()
+            if retry is not None:
+                now = time.monotonic()
+                if now >= next_retry:
+                    retry()
+                    self._absorb_pending(matcher)
+                    next_retry = time.monotonic() + retry_interval
+                wait = min(wait, max(0.0, next_retry - time.monotonic()))
+
+            matcher.feed(self.read(min(wait, READ_SLICE)))
@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+console_rack.py
+
+Description: Run the DATS/DATC and OTAS/OTAC console tests on many pairs at once
+
+"""
+import argparse
+import asyncio
+import os
+import sys
+from typing import Dict, Tuple
+
+# pylint: disable=import-error,wrong-import-position
+from resource_manager import ResourceManager
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "common"))
+from async_console import (
+    AsyncTester,
+    BoardJob,
+    run_jobs,
+    run_pairing,
+    run_steps,
+    with_timeout,
+)
+from console_sequences import DATC_TESTS, OTAC_TESTS, OTAS_TESTS, PAIRING, version
+from serial_expect import console_paced
+
+# pylint: enable=import-error,wrong-import-position
+
+# Time given to the boards to boot and connect after a reset
+BOOT_TIME = 5
+
+
+async def _reset(resource_manager: ResourceManager, board: str, owner: str):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, resource_manager.resource_reset, board, owner)
+
+
+def _tester(
+    resource_manager: ResourceManager, board: str, log_path: str, echo: bool
+) -> AsyncTester:
+    return AsyncTester(
+        resource_manager.get_item_value(f"{board}.console_port"),
+        name=board,
+        paced=console_paced(resource_manager, board),
+        log_path=log_path,
+        echo=echo,
+    )
+
+
+async def datc_tests(client: AsyncTester) -> Dict[str, bool]:
+    """All DATC tests, same sequence as ``datsc_connected.py``"""
+    results = {"pairing": await run_pairing(client.console, PAIRING, client.byte_delay)}
+    if not results["pairing"]:
+        return results
+
+    for name, steps in DATC_TESTS.items():
+        results[name] = bool(await run_steps(client.console, steps, client.byte_delay))
+    results["connection stability"] = client.test_stable_connection()
+
+    return results
+
+
+async def dats_tests(server: AsyncTester, stop: asyncio.Event) -> Dict[str, bool]:
+    """All DATS tests, logging the console until ``stop`` is set"""
+    results = {"pairing": await run_pairing(server.console, PAIRING, server.byte_delay)}
+    await stop.wait()
+    results["connection stability"] = server.test_stable_connection()
+
+    return results
+
+
+async def dats_pair(
+    resource_manager: ResourceManager,
+    server_board: str,
+    client_board: str,
+    timeout: float,
+    directory: str,
+    echo: bool,
+) -> Dict[str, bool]:
+    """Run the DATS/DATC tests on one pair"""
+    owner = resource_manager.get_owner(server_board)
+    await asyncio.gather(
+        _reset(resource_manager, server_board, owner),
+        _reset(resource_manager, client_board, owner),
+    )
+
+    server_log = os.path.join(directory, f"dats_console_out_{server_board}.txt")
+    client_log = os.path.join(directory, f"datc_console_out_{client_board}.txt")
+    server_tester = _tester(resource_manager, server_board, server_log, echo)
+    client_tester = _tester(resource_manager, client_board, client_log, echo)
+
+    async with server_tester as server, client_tester as client:
+        stop = asyncio.Event()
+        server_task = asyncio.ensure_future(
+            with_timeout(server_board, dats_tests(server, stop), timeout)
+        )
+        try:
+            client_results = await with_timeout(
+                client_board, datc_tests(client), timeout
+            )
+        finally:
+            stop.set()
+        server_results = await server_task
+
+    results = {f"DATC {name}": value for name, value in client_results.items()}
+    results.update({f"DATS {name}": value for name, value in server_results.items()})
+
+    return results
+
+
+async def otas_tests(server: AsyncTester) -> Dict[str, bool]:
+    """All OTAS tests, same sequence as ``otas_connected.py``"""
+    found = await run_steps(server.console, OTAS_TESTS["versioning"], server.byte_delay)
+    if found:
+        print(f"[{server.name}] GOT VERSION {version(found)}")
+
+    return {"versioning": bool(found)}
+
+
+async def otac_tests(client: AsyncTester) -> Dict[str, bool]:
+    """All OTAC tests, same sequence as ``otas_connected.py``"""
+    return {
+        name: bool(await run_steps(client.console, steps, client.byte_delay))
+        for name, steps in OTAC_TESTS.items()
+    }
+
+
+async def otas_pair(
+    resource_manager: ResourceManager,
+    server_board: str,
+    client_board: str,
+    timeout: float,
+    directory: str,
+    echo: bool,
+) -> Dict[str, bool]:
+    """Run the OTAS/OTAC tests on one pair"""
+    owner = resource_manager.get_owner(server_board)
+    await asyncio.gather(
+        _reset(resource_manager, server_board, owner),
+        _reset(resource_manager, client_board, owner),
+    )
+    # give time for connection
+    await asyncio.sleep(BOOT_TIME)
+
+    server_log = os.path.join(directory, f"otas_out_{server_board}.txt")
+    async with _tester(resource_manager, server_board, server_log, echo) as server:
+        server_results = await with_timeout(server_board, otas_tests(server), timeout)
+
+    client_log = os.path.join(directory, f"otac_out_{client_board}.txt")
+    async with _tester(resource_manager, client_board, client_log, echo) as client:
+        await _reset(resource_manager, client_board, owner)
+        await asyncio.sleep(BOOT_TIME)
+        client_results = await with_timeout(client_board, otac_tests(client), timeout)
+
+    results = {f"OTAC {name}": value for name, value in client_results.items()}
+    results.update({f"OTAS {name}": value for name, value in server_results.items()})
+
+    return results
+
+
+def _pair(value: str) -> Tuple[str, str]:
+    server, sep, client = value.partition(":")
+    if not sep or not server or not client or server == client:
+        raise argparse.ArgumentTypeError(f"Expected SERVER:CLIENT, got {value}")
+
+    return server, client
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Run DATS/DATC and OTAS/OTAC console tests on many board "
+        "pairs concurrently from one process",
+    )
+    parser.add_argument(
+        "--dats",
+        type=_pair,
+        action="append",
+        default=[],
+        metavar="SERVER:CLIENT",
+        help="DATS and DATC boards as shown in the resource manager",
+    )
+    parser.add_argument(
+        "--otas",
+        type=_pair,
+        action="append",
+        default=[],
+        metavar="SERVER:CLIENT",
+        help="OTAS and OTAC boards as shown in the resource manager",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=300,
+        help="Seconds each board may take before its tests are cancelled",
+    )
+    parser.add_argument(
+        "-d", "--directory", default="rack_out", help="Console log directory"
+    )
+    parser.add_argument(
+        "--echo", action="store_true", help="Print console output as it arrives"
+    )
+
+    return parser.parse_args()
+
+
+def _print_results(name, report):
+    overall = True
+
+    print(f"{name} RESULTS")
+    print(f"{'TEST':<28} Result")
+    for key, value in report.items():
+        print("-" * 35)
+        print(f"{key:<30}{'Fail' if not value else 'Pass'}")
+
+        if not value:
+            overall = False
+
+    print("-" * 35, "\n")
+
+    return overall
+
+
+def main():
+    args = config_cli()
+
+    boards = [board for pair in args.dats + args.otas for board in pair]
+    if not boards:
+        print("No pairs given, use --dats and/or --otas")
+        sys.exit(-1)
+    if len(boards) != len(set(boards)):
+        print("Every board may only be used by one pair")
+        sys.exit(-1)
+
+    os.makedirs(args.directory, exist_ok=True)
+    resource_manager = ResourceManager()
+
+    jobs = []
+    for suite, pairs in ((dats_pair, args.dats), (otas_pair, args.otas)):
+        for server, client in pairs:
+            jobs.append(
+                BoardJob(
+                    f"{server}:{client}",
+                    lambda suite=suite, server=server, client=client: suite(
+                        resource_manager,
+                        server,
+                        client,
+                        args.timeout,
+                        args.directory,
+                        args.echo,
+                    ),
+                    # Reset, boot and both boards' tests in the worst case
+                    timeout=2 * (args.timeout + BOOT_TIME) + 60,
+                )
+            )
+
+    results = asyncio.run(run_jobs(jobs))
+
+    print("\n\n")
+    overall = True
+    for name, report in results.items():
+        overall &= _print_results(name, report)
+
+    print(f"{'Overall':<10} {'Pass' if overall else 'Fail'}")
+
+    if not overall:
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
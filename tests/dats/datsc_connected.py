@@ -51,277 +51,246 @@ Description: Data server-client connection test
 import os
 import sys
 import threading
-import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 
 import serial
 
 
 from btm_resource_manager import ResourceManager
 
+# pylint: disable=import-error,wrong-import-position
+sys.path.append(str(Path(__file__).resolve().parents[1] / "common"))
+from console_sequences import DATC_TESTS, PAIRING, run_pairing, run_steps
+from serial_expect import (
+    PACED_BYTE_DELAY,
+    READ_SLICE,
+    ConsoleExpect,
+    ConsoleLog,
+    console_paced,
+)
+
+# pylint: enable=import-error,wrong-import-position
+
+# Folder the console logs are written to
+CONSOLE_OUT_FOLDER = "dats_out"
+
 
 class BasicTester:
-    def __init__(self, portname: str) -> None:
+    def __init__(
+        self, portname: str, paced: bool = False, log_name: Optional[str] = None
+    ) -> None:
+        """Open a board console
+
+        Parameters
+        ----------
+        portname : str
+            Console serial port
+        paced : bool, optional
+            Write console commands one byte at a time
+        log_name : Optional[str], optional
+            File in the output folder the console is streamed to. Only the
+            recent output is kept in memory if None
+        """
         self.portname = portname
-        self.console_output = ""
+        self.byte_delay = PACED_BYTE_DELAY if paced else 0.0
+        self.console_log = ConsoleLog(
+            os.path.join(CONSOLE_OUT_FOLDER, log_name) if log_name else None
+        )
+        self.console_log.watch("TIMEOUT")
         self.serial_port = serial.Serial(portname, baudrate=115200, timeout=0)
         self.serial_port.flush()
+        self.console = ConsoleExpect(self.serial_port, on_data=self._log_output)
+
+    @property
+    def console_output(self) -> str:
+        return self.console_log.text()
+
+    def _log_output(self, text: str):
+        self.console_log.append(text)
 
     def slow_write(self, data: bytes):
-        """Write UART data at human typing speeds
+        """Write a console command and wait for the target to echo it
+
+        Boards flagged as paced in the board config are written at human
+        typing speeds instead.
 
         Parameters
         ----------
-        serial_port : serial.Serial
-            Port to write data to
         data : bytes
             Data to write out
         """
-        for byte in data:
-     		# Make sure what we're writing is in the correct format
-            self.serial_port.write(byte.to_bytes(1, 'little'))
-            time.sleep(0.1)
-        
-        # Give the target device time to respond to the command
-        time.sleep(0.5)
-    
-            
+        self.console.write(data, byte_delay=self.byte_delay)
+
     def test_secure_connection(self) -> bool:
         """Generic secure connection test for pairing
 
-        Parameters
-        ----------
-        serial_port : serial.Serial
-            serial port to write and read from
-
         Returns
         -------
         bool
             True if test success. False otherwise
         """
-
-        start = datetime.now()
-        while True:
-            try:
-                new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                    "utf-8"
-                )
-            except UnicodeDecodeError:
-                new_text = ""
-
-            self.console_output += new_text
-
-            if "passkey" in new_text:
-                time.sleep(1)
-                self.slow_write("pin 1 1234\n".encode("utf-8"))
-                start = datetime.now()
-
-            if "Pairing completed successfully" in new_text or "Connection encrypted" in new_text:
-                return True
-            
-            if "Pairing failed" in new_text:
-                return False
-
-            if (datetime.now() - start).total_seconds() > 10:
-                print("\nTIMEOUT: Secure connection test")
-                return False
+        return run_pairing(self.console, PAIRING, self.byte_delay)
 
     def test_stable_connection(self) -> bool:
-        return "TIMEOUT" not in self.console_output
+        return "TIMEOUT" not in self.console_log
 
     def save_console_output(self, path):
-        folder = "dats_out"
+        """Finish the console log and store it as ``path`` in the output folder
+
+        A streamed log is renamed, otherwise the output held in memory is
+        written out.
+        """
+        folder = CONSOLE_OUT_FOLDER
         if not os.path.exists(folder):
             os.mkdir(folder)
         full_path = os.path.join(folder, path)
 
+        if self.console_log.path is not None:
+            self.console_log.move(full_path)
+            return
+
         with open(full_path, "w", encoding="utf-8") as console_out_file:
             # Make sure we can decode to utf-8, otherwise we might get a corrupted text file
             console_out_file.write(self.console_output[1:].encode('utf-8', 'replace').decode('utf-8', 'replace'))
 
 
 class ClientTester(BasicTester):
-    def __init__(self, portname: str) -> None:
-        BasicTester.__init__(self, portname=portname)
-
-    def write_char_test(self) -> bool:
-        """Test for unsecure write characteristic
-
-        Parameters
-        ----------
-        serial_port : serial.Serial
-            serial port to write to
-
-        Returns
-        -------
-        bool
-            True if test passed. False otherwise.
-        """
-
-        start = datetime.now()
-        while True:
-            self.slow_write("btn 2 l\n".encode("utf-8"))
-
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-            
-            if "hello" in new_text:
-                return True
-
-            if (datetime.now() - start).total_seconds() > 10:
-                print("\nTIMEOUT: Write Char Test")
-                return False
-
-    def write_secure_test(self) -> bool:
-        """Test for secure write
-
-        Parameters
-        ----------
-        serial_port : serial.Serial
-            Serial port to write to
-
-        Returns
-        -------
-        bool
-            True if test passed. False otherwise.
-        """
-        
-
-        start = datetime.now()
-
-        while True:
-            self.slow_write("btn 2 l\n".encode("utf-8"))
-            self.slow_write("btn 2 m\n".encode("utf-8"))
-
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-
-            if "Secure data received!" in new_text:
-                return True
-
-            if (datetime.now() - start).total_seconds() > 10:
-                print("\nTIMEOUT: Write Secure char test")
-                return False      
+    def __init__(
+        self, portname: str, paced: bool = False, log_name: Optional[str] = None
+    ) -> None:
+        BasicTester.__init__(self, portname=portname, paced=paced, log_name=log_name)
 
-    def phy_switch_test(self) -> bool:
-        """Test to update PHY from 1M to 2M
+    def run_test(self, name: str) -> bool:
+        """Run one of the DATC tests in ``DATC_TESTS``
 
         Parameters
         ----------
-        serial_port : serial.Serial
-            Serial port to write to
+        name : str
+            Test name
 
         Returns
         -------
         bool
             True if test passed. False otherwise.
         """
+        return bool(run_steps(self.console, DATC_TESTS[name], self.byte_delay))
 
-        
-        start = datetime.now()
 
-        while True:
-            self.slow_write("btn 2 s\n".encode("utf-8"))
-
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-
-            if "PHY Requested" in new_text or "DM_PHY_UPDATE_IND" in new_text:
-                return True
-
-            if (datetime.now() - start).total_seconds() > 10:
-                print("\nTIMEOUT: PHY switch test")
-                return False
-
-
-    def speed_test(self) -> bool:
-        """Test throughput example
-
-        Parameters
-        ----------
-        serial_port : serial.Serial
-            Serial port to write to
+def _client_thread(
+    portname: str, board: str, resource_manager: ResourceManager, owner: str
+) -> Dict[str, bool]:
+    """Run the client side tests
+
+    Returns
+    -------
+    Dict[str, bool]
+        Result of each test
+    """
+    resource_manager.resource_reset(board, owner)
+    client = ClientTester(
+        portname,
+        paced=console_paced(resource_manager, board),
+        log_name=f"datc_console_out_{board}.txt",
+    )
+    results = {}
 
-        Returns
-        -------
-        bool
-            True if test passed. False otherwise.
-        """
-        start = datetime.now()
-        while True:
-            self.slow_write("btn 2 x\n".encode("utf-8"))
-            self.slow_write("btn 2 m\n".encode("utf-8"))
+    results["pairing"] = client.test_secure_connection()
+    if not results["pairing"]:
+        client.save_console_output(f"datc_console_out_{board}.txt")
+        return results
 
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
+    for name in DATC_TESTS:
+        results[name] = client.run_test(name)
 
-            self.console_output += new_text
+    results["connection stability"] = client.test_stable_connection()
+    client.save_console_output(f"datc_console_out_{board}.txt")
 
-            if "bps" in new_text:
-                return True
+    return results
 
-            if (self.serial_port.in_waiting == 0):
-                if (datetime.now() - start).total_seconds() > 20:
-                    print("\nTIMEOUT: Speed test")
-                    return False
-    
 
+def _server_thread(
+    portname: str,
+    board: str,
+    resource_manager: ResourceManager,
+    owner: str,
+    stop: threading.Event,
+) -> Dict[str, bool]:
+    """Run the server side tests and log its console until ``stop`` is set
+
+    Reads block until console data arrives or ``READ_SLICE`` passes, so
+    the server sleeps instead of competing with the client for the GIL.
+
+    Returns
+    -------
+    Dict[str, bool]
+        Result of each test
+    """
+    resource_manager.resource_reset(board, owner)
+    server = BasicTester(
+        portname,
+        paced=console_paced(resource_manager, board),
+        log_name=f"dats_console_out_{board}.txt",
+    )
+    results = {}
 
-test_results_client = {}
+    results["pairing"] = server.test_secure_connection()
 
+    while not stop.is_set():
+        server.console.read(READ_SLICE)
 
-def _client_thread(
-    portname: str, board: str, resource_manager: ResourceManager, owner: str
-):
-    resource_manager.resource_reset(board, owner)
-    client = ClientTester(portname)
-
-    test_results_client["pairing"] = client.test_secure_connection()
-    if not test_results_client["pairing"]:
-        client.save_console_output(f"datc_console_out_{board}.txt")
-        return test_results_client
+    results["connection stability"] = server.test_stable_connection()
+    server.save_console_output(f"dats_console_out_{board}.txt")
 
-    test_results_client["write characteristic"] = client.write_char_test()
-    test_results_client["speed"] = client.speed_test()
-    test_results_client["write secure"] = client.write_secure_test()
-    test_results_client["phy switch"] = client.phy_switch_test()
+    return results
 
-    test_results_client["connection stability"] = client.test_stable_connection()
-    client.save_console_output(f"datc_console_out_{board}.txt")
 
-    return test_results_client
+def run_pair(
+    server_board: str, client_board: str, resource_manager: ResourceManager
+) -> Tuple[Dict[str, bool], Dict[str, bool]]:
+    """Run the DATS/DATC tests on one pair of boards
 
+    The server keeps logging its console until the client is done. Pairs
+    share no state so several may run at once.
 
-test_results_server = {}
-kill_server = False
+    Parameters
+    ----------
+    server_board : str
+        DATS board as shown in the resource manager
+    client_board : str
+        DATC board as shown in the resource manager
+    resource_manager : ResourceManager
+        Resource manager to look the boards up in
 
+    Returns
+    -------
+    Tuple[Dict[str, bool], Dict[str, bool]]
+        Client and server results
+    """
+    # Get console ports associated with the boards
+    server_port = resource_manager.get_item_value(f"{server_board}.console_port")
+    client_port = resource_manager.get_item_value(f"{client_board}.console_port")
 
-def _server_thread(
-    portname: str, board: str, resource_manager: ResourceManager, owner: str
-):
-    resource_manager.resource_reset(board, owner)
-    server = BasicTester(portname)
-    
-    test_results_server["pairing"] = server.test_secure_connection()
+    # Reset to start from scratch
+    owner = resource_manager.get_owner(server_board)
 
-    while not kill_server:
-        new_text = server.serial_port.read(server.serial_port.in_waiting).decode(
-            "utf-8"
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        client = pool.submit(
+            _client_thread, client_port, client_board, resource_manager, owner
+        )
+        server = pool.submit(
+            _server_thread, server_port, server_board, resource_manager, owner, stop
         )
-        server.console_output += new_text
 
-    test_results_server["connection stability"] = server.test_stable_connection()
-    server.save_console_output(f"dats_console_out_{board}.txt")
+        try:
+            client_results = client.result()
+        finally:
+            stop.set()
+        server_results = server.result()
 
-    return test_results_server
+    return client_results, server_results
 
 
 def _print_results(name, report):
@@ -342,7 +311,6 @@ def _print_results(name, report):
 
 
 def main():
-    global kill_server
     if len(sys.argv) < 3:
         print(f"DATSC TEST: Not enough arguments! Expected 2 got {len(sys.argv)}")
 
@@ -365,39 +333,9 @@ def main():
         server_board != client_board
     ), f"Client Board ({client_board}) must not  be the same as Server ({server_board})"
 
-    # Get console ports associated with the boards
-    server_port = resource_manager.get_item_value(f"{server_board}.console_port")
-    client_port = resource_manager.get_item_value(f"{client_board}.console_port")
-
-    # Reset to start from scratch
-    owner = resource_manager.get_owner(server_board)
-
-    # Configure and run tests
-    client_t = threading.Thread(
-        target=_client_thread,
-        args=(
-            client_port,
-            client_board,
-            resource_manager,
-            owner,
-        ),
+    test_results_client, test_results_server = run_pair(
+        server_board, client_board, resource_manager
     )
-    server_t = threading.Thread(
-        target=_server_thread,
-        args=(
-            server_port,
-            server_board,
-            resource_manager,
-            owner,
-        ),
-    )
-
-    client_t.start()
-    server_t.start()
-
-    client_t.join()
-    kill_server = True
-    server_t.join()
 
     # Print Results
     print("\n\n")
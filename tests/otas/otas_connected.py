@@ -50,213 +50,127 @@ Description: Data server-client connection test
 """
 
 import os
-import re
 import sys
 import time
-from datetime import datetime
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 
 import serial
 
 from resource_manager import ResourceManager
 
+# pylint: disable=import-error,wrong-import-position
+sys.path.append(str(Path(__file__).resolve().parents[1] / "common"))
+from console_sequences import OTAC_TESTS, OTAS_TESTS, run_steps, version
+from serial_expect import PACED_BYTE_DELAY, ConsoleExpect, ConsoleLog, console_paced
+
+# pylint: enable=import-error,wrong-import-position
+
 BTN1 = 1
 BTN2 = 2
 
+# Folder the console logs are written to
+CONSOLE_OUT_FOLDER = "otas_out"
+
 class BasicTester:
-    def __init__(self, portname: str) -> None:
+    def __init__(
+        self, portname: str, paced: bool = False, log_name: Optional[str] = None
+    ) -> None:
+        """Open a board console
+
+        Parameters
+        ----------
+        portname : str
+            Console serial port
+        paced : bool, optional
+            Write console commands one byte at a time
+        log_name : Optional[str], optional
+            File in the output folder the console is streamed to. Only the
+            recent output is kept in memory if None
+        """
         self.portname = portname
-        self.console_output = ""
+        self.byte_delay = PACED_BYTE_DELAY if paced else 0.0
+        self.console_log = ConsoleLog(
+            os.path.join(CONSOLE_OUT_FOLDER, log_name) if log_name else None
+        )
         self.serial_port = serial.Serial(portname, baudrate=115200, timeout=2)
         self.serial_port.flush()
         # self.serial_port.write('echo off\n'.encode())
+        self.console = ConsoleExpect(self.serial_port, on_data=self._log_output)
+
+    @property
+    def console_output(self) -> str:
+        return self.console_log.text()
+
+    def _log_output(self, text: str):
+        self.console_log.append(text)
+        print(text, end="")
 
     def slow_write(self, data: bytes):
         """Write UART data at human typing speeds
 
         Parameters
         ----------
-        serial_port : serial.Serial
-            Port to write data to
         data : bytes
             Data to write out
         """
-        for byte in data:
-            # print(f"slow {byte}")
-            self.serial_port.write(byte)
-            time.sleep(0.1)
+        self.console.write(data, byte_delay=PACED_BYTE_DELAY)
 
     def press_btn(self, btn_num: int, method: str):
         """Press button via console
 
+        The command is written in one go unless the board is flagged as
+        paced, and returns once the target echoes it.
+
         Parameters
         ----------
-        serial_port : serial.Serial
-            Serial port to write to
         btn_num : int
             Button number (1/2)
         method : str
             Button method (s/m/l/x)
         """
         command = f"btn {btn_num} {method}\r".encode("utf-8")
-        # self.serial_port.writelines([command])
-        self.serial_port.write(command)
-        # self.slow_write(command)
-        # time.sleep(0.5)
+        self.console.write(command, byte_delay=self.byte_delay)
 
     def save_console_output(self, path):
-        folder = "otas_out"
+        """Finish the console log and store it as ``path`` in the output folder
+
+        A streamed log is renamed, otherwise the output held in memory is
+        written out.
+        """
+        folder = CONSOLE_OUT_FOLDER
         if not os.path.exists(folder):
             os.mkdir(folder)
         full_path = os.path.join(folder, path)
 
+        if self.console_log.path is not None:
+            self.console_log.move(full_path)
+            return
+
         with open(full_path, "w", encoding="utf-8") as console_out_file:
             console_out_file.write(self.console_output)
 
 
 class ClientTester(BasicTester):
-    def __init__(self, portname: str) -> None:
-        BasicTester.__init__(self, portname)
-
-    def test_discover_filespace(self, retry=True) -> bool:
-        """Test discovery filespace
-
-        Parameters
-        ----------
-        serial_port : serial.Serial
-            Seiral port to write to
-
-        Returns
-        -------
-        bool
-            True if test passed. False otherwise
-        """
-
-        self.press_btn(BTN2, "s")
-
-        start = datetime.now()
+    def __init__(
+        self, portname: str, paced: bool = False, log_name: Optional[str] = None
+    ) -> None:
+        BasicTester.__init__(self, portname, paced, log_name)
 
-        while True:
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-
-            print(new_text, end="")
-
-            if "File discovery complete" in self.console_output:
-                return True
-
-            if (datetime.now() - start).total_seconds() > 10:
-                if retry:
-                    time.sleep(5)
-                    return self.test_discover_filespace(retry=False)
-
-                return False
-
-            time.sleep(1)
-            self.press_btn(BTN2, "s")
-
-    def test_start_update_xfer(self, retry=True) -> bool:
-        """Test firmware update
+    def run_test(self, name: str) -> bool:
+        """Run one of the OTAC tests in ``OTAC_TESTS``
 
         Parameters
         ----------
-        serial_port : serial.Serial
-            Serial port to write to
+        name : str
+            Test name
 
         Returns
         -------
         bool
             True if test passed. False otherwise
         """
-
-        self.press_btn(BTN2, "m")
-
-        start = datetime.now()
-
-        while True:
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-
-            print(new_text, end="")
-
-            if "Starting file transfer" in self.console_output:
-                break
-
-            if (datetime.now() - start).total_seconds() > 10:
-                if retry:
-                    time.sleep(5)
-                    return self.test_discover_filespace(retry=False)
-
-                return False
-
-            time.sleep(1)
-            self.press_btn(BTN2, "m")
-
-        start = datetime.now()
-
-        # wait for complete
-        while True:
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-            print(new_text, end="")
-            if "transfer complete" in self.console_output:
-                return True
-
-            if (datetime.now() - start).total_seconds() > 30:
-                return False
-
-    def verify_xfer(self, retry=True) -> bool:
-        """Test transfer verification
-
-        Parameters
-        ----------
-        serial_port : serial.Serial
-            Serial port to write to
-
-        Returns
-        -------
-        bool
-            True if test passed. False otherwise
-        """
-
-        self.press_btn(BTN2, "l")
-
-        start = datetime.now()
-
-        pattern = r"Verify complete status:\s*(.+)"
-
-        while True:
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-
-            print(new_text, end="")
-
-            status_match = re.search(pattern, self.console_output)
-
-            # Check for successful completion
-            if status_match:
-                status = status_match.group(1) == 0
-                if status == 0:
-                    return True
-                print(f"status mismatch {status}")
-                print(status)
-                return False
-
-            if (datetime.now() - start).total_seconds() > 10:
-                if retry:
-                    time.sleep(5)
-                    return self.test_discover_filespace(retry=False)
-
-                return False
+        return bool(run_steps(self.console, OTAC_TESTS[name], self.byte_delay))
 
 
 def client_tests(
@@ -275,14 +189,17 @@ def client_tests(
         Test report
     """
 
-    client = ClientTester(portname)
+    client = ClientTester(
+        portname,
+        paced=console_paced(resource_manager, boardname),
+        log_name=f"otac_out_{boardname}.txt",
+    )
     client.serial_port.flush()
     resource_manager.resource_reset(boardname)
     time.sleep(5)
     client_results = {}
-    client_results["filespace"] = client.test_discover_filespace()
-    client_results["update"] = client.test_start_update_xfer()
-    client_results["verify"] = client.verify_xfer()
+    for name in OTAC_TESTS:
+        client_results[name] = client.run_test(name)
 
     client.save_console_output(f"otac_out_{boardname}.txt")
 
@@ -290,8 +207,10 @@ def client_tests(
 
 
 class ServerTester(BasicTester):
-    def __init__(self, portname: str) -> None:
-        BasicTester.__init__(self, portname)
+    def __init__(
+        self, portname: str, paced: bool = False, log_name: Optional[str] = None
+    ) -> None:
+        BasicTester.__init__(self, portname, paced, log_name)
 
     def test_version(self) -> bool:
         """Test the version of firmware
@@ -307,35 +226,14 @@ class ServerTester(BasicTester):
             True if test passed. False otherwise
         """
 
-        self.press_btn(BTN2, "m")
-        start = datetime.now()
-
-        pattern = r"FW_VERSION:\s*(.+)"
-
-        while True:
-            new_text = self.serial_port.read(self.serial_port.in_waiting).decode(
-                "utf-8"
-            )
-            self.console_output += new_text
-
-            print(new_text, end="")
-
-            version_match = re.search(pattern, self.console_output)
-
-            if version_match:
-                version = version_match.group(1)
-                print(f"GOT VERSION {version}")
-                return True
-
-            if (datetime.now() - start).total_seconds() > 10:
-                # print("TIMEOUT!!")
-                return False
+        found = run_steps(self.console, OTAS_TESTS["versioning"], self.byte_delay)
+        if found:
+            print(f"GOT VERSION {version(found)}")
 
-            time.sleep(1)
-            self.press_btn(BTN2, "m")
+        return bool(found)
 
 
-def server_tests(portname: str, boardname):
+def server_tests(portname: str, boardname, paced: bool = False):
     """All server tests
 
     Parameters
@@ -350,7 +248,7 @@ def server_tests(portname: str, boardname):
     """
 
     test_results_server = {}
-    server = ServerTester(portname)
+    server = ServerTester(portname, paced, log_name=f"otas_out_{boardname}.txt")
     test_results_server["versioning"] = server.test_version()
 
     server.save_console_output(f"otas_out_{boardname}.txt")
@@ -409,7 +307,9 @@ def main():
     time.sleep(5)
 
     # Run the tests
-    test_server_results = server_tests(server_port, SERVER_BOARD)
+    test_server_results = server_tests(
+        server_port, SERVER_BOARD, console_paced(resource_manager, SERVER_BOARD)
+    )
     # resource_manager.resource_reset(SERVER_BOARD)
     # time.sleep(5)
     test_client_results = client_tests(client_port, CLIENT_BOARD, resource_manager)
@@ -61,9 +61,8 @@ import argparse
 import time
 from datetime import datetime
 from glob import glob
-from typing import List
+from typing import List, Optional
 
-import matplotlib.pyplot as plt
 import resource_manager
 
 # pylint: disable=import-error,wrong-import-position
@@ -77,10 +76,111 @@ from packaging import version
 from resource_manager import ResourceManager
 from rich import print
 
+from anomaly import (
+    DEFAULT_EXTEND_TIME,
+    AnomalyMonitor,
+    AnomalyPolicy,
+    add_anomaly_args,
+    anomaly_table,
+)
+from charts import ChartSpec, Line, render_charts
+from interval_metrics import (
+    ADV_PKT_INTERVALS,
+    DEFAULT_WINDOW,
+    IntervalSeries,
+    RollingMetrics,
+    window_samples,
+)
+from metrics_exporter import MetricsExporter, record_metrics
+from report_stage import (
+    add_report_args,
+    load_report_meta,
+    run_report_stage,
+    save_report_meta,
+)
+from sample_store import ADV_PKT_FIELDS, ADV_PKT_METRICS, SampleStore
+from sampler import MIN_SAMPLE_PERIOD, PeriodicSampler
 from utils import create_directory, make_version_table
 
 # pylint: enable=import-error,wrong-import-position
 
+ADV_CHARTS = [
+    ChartSpec(
+        "advertisiments.png",
+        "Advertismenets Vs. Time",
+        "Time (sec)",
+        "Advertisments",
+        [Line("tx_adv", decimation="lttb")],
+    ),
+    ChartSpec(
+        "scan_req_resp.png",
+        "Scan Requests and Responses",
+        "Time (sec)",
+        "Packet Count",
+        [
+            Line("tx_resp", "Scan Response", decimation="lttb"),
+            Line("rx_req", "Scan Request", decimation="lttb"),
+        ],
+    ),
+    ChartSpec(
+        "requets_metrics.png",
+        "Scan Request Metrics Vs. Time",
+        "time (sec)",
+        "Rate (%)",
+        [
+            Line("scan_request_rate", "Scan Request Rate"),
+            Line("scan_request_crc_rate", "Scan Request CRC Rate"),
+            Line("scan_request_timeout_rate", "Scan Request Timeout Rate"),
+        ],
+        ylim=(0, 100),
+    ),
+    ChartSpec(
+        "isr_timing.png",
+        "ISR Timing",
+        "Time (sec)",
+        "ISR Time (usec)",
+        [Line("rx_isr", "RX ISR"), Line("tx_isr", "TX ISR")],
+    ),
+    ChartSpec(
+        "setup_timing.png",
+        "Setup Timing",
+        "Time (sec)",
+        "Setup Time (usec)",
+        [Line("rx_setup", "RX SETUP"), Line("tx_setup", "TX SETUP")],
+    ),
+]
+
+
+def window_charts(window: float) -> List[ChartSpec]:
+    return [
+        ChartSpec(
+            "requests_window.png",
+            f"{window:g} s Window Scan Request Metrics Vs. Time",
+            "time (sec)",
+            "Rate (%)",
+            [
+                Line("scan_request_rate", "Scan Request Rate", source="window"),
+                Line("scan_request_crc_rate", "Scan Request CRC Rate", source="window"),
+                Line(
+                    "scan_request_timeout_rate",
+                    "Scan Request Timeout Rate",
+                    source="window",
+                ),
+            ],
+            ylim=(0, 100),
+        ),
+        ChartSpec(
+            "tx_adv_throughput.png",
+            f"{window:g} s Window Advertisements Sent Vs. Time",
+            "Time (sec)",
+            "Advertisements/s",
+            [Line("tx_adv_per_sec", source="window")],
+        ),
+    ]
+
+
+SAMPLES_FNAME = "adv_samples.npy"
+
 if version.parse(resource_manager.__version__) < version.parse("1.1.1"):
     raise RuntimeError("Resource manager of 1.1.1 or greater is required")
 
@@ -101,24 +201,52 @@ def config_cli():
         "-s",
         "--sample-rate",
         default=1,
-        help="Sample rate in seconds. Minimum of 1 second",
+        help=f"Sample period in seconds. Minimum of {MIN_SAMPLE_PERIOD} seconds",
     )
+    parser.add_argument(
+        "-w",
+        "--window",
+        default=DEFAULT_WINDOW,
+        type=float,
+        help="Rolling window in seconds for the interval metrics",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve live stats in Prometheus format on this local port",
+    )
+    add_anomaly_args(parser)
+    add_report_args(parser)
 
     return parser.parse_args()
 
 
 class AdvTest:
     def __init__(
-        self, dut_board: str, sample_rate: int, duration: int, directory: str
+        self,
+        dut_board: str,
+        sample_rate: float,
+        duration: int,
+        directory: str,
+        window: float = DEFAULT_WINDOW,
+        metrics_port: Optional[int] = None,
+        on_anomaly: str = "ignore",
+        extend_time: float = DEFAULT_EXTEND_TIME,
     ) -> None:
         self.dut_board = dut_board
 
         self.directory = directory
         self.duration = duration
         self.sample_rate = (
-            sample_rate if sample_rate >= 1 and sample_rate <= duration else 1
+            sample_rate if MIN_SAMPLE_PERIOD <= sample_rate <= duration else 1
         )
         self.iterations = int(int(self.duration) / float(self.sample_rate))
+        self.window = window
+        self.metrics_port = metrics_port
+        self.on_anomaly = on_anomaly
+        self.extend_time = extend_time
+        self.anomalies = []
+        self.stop_reason = None
 
         rmanager = ResourceManager()
         self.target = rmanager.get_item_value(f"{self.dut_board}.target")
@@ -126,7 +254,10 @@ class AdvTest:
         self.dut_hci_port = rmanager.get_item_value(f"{dut_board}.hci_port")
         self.dut = BleHci(self.dut_hci_port)
 
-        self.results: List[AdvPktStats] = []
+        # One sample per iteration plus the final read
+        self.results = SampleStore(
+            ADV_PKT_FIELDS, self.iterations + 1, metrics=ADV_PKT_METRICS
+        )
 
         self.start_time = datetime.now()
         self.stop_time = None
@@ -135,188 +266,200 @@ class AdvTest:
         self.dut.reset()
         self.dut.start_advertising(connect=True, adv_name="adv-test")
 
-        with alive_bar(self.iterations) as bar:
-            for _ in range(self.iterations):
-                try:
-                    stats, _ = self.dut.get_adv_stats()
-                    self.results.append(stats)
-                except:
-                    self.results.append(AdvPktStats())
+        sampler = PeriodicSampler(self.sample_rate, {"dut": self.dut.get_adv_stats})
+        rolling = RollingMetrics(
+            ADV_PKT_INTERVALS, window_samples(self.window, self.sample_rate)
+        )
+        exporter = MetricsExporter(
+            self.metrics_port, "ble_adv_stability", labels={"dut": self.dut_board}
+        )
 
-                bar()
+        # There is no peer to measure a PER against, watch ISR times and reads
+        monitor = AnomalyMonitor(ADV_PKT_INTERVALS, ["dut"], self.sample_rate, None)
+        policy = AnomalyPolicy(
+            self.on_anomaly, self.extend_time, self.sample_rate, self.iterations
+        )
+
+        with sampler, exporter, alive_bar(self.iterations) as bar:
+            for index in sampler.ticks(0, lambda: policy.iterations):
+                sample = sampler.poll()["dut"]
+                if sample.error is None:
+                    self.results.append(sample.value[0], sample.timestamp)
+                else:
+                    self.results.append(AdvPktStats(), sample.timestamp)
+
+                rolling.update(self.results.last())
+                snapshot = rolling.snapshot()
+                exporter.publish(
+                    {
+                        **record_metrics(self.results.last()),
+                        **{f"window_{key}": value for key, value in snapshot.items()},
+                        "sample_index": index + 1,
+                    }
+                )
+                bar.text = rolling.summary()
+
+                anomalies = monitor.update(
+                    index,
+                    sample.timestamp,
+                    {"dut": self.results.last()},
+                    {"dut": sample.error is not None},
+                )
+                for anomaly in anomalies:
+                    print(f"[yellow]Anomaly: {anomaly.detail}[/yellow]")
+                self.iterations = policy.apply(index, anomalies)
 
-                time.sleep(self.sample_rate)
+                bar()
 
         try:
             stats, _ = self.dut.get_adv_stats()
-            self.results.append(stats)
+            self.results.append(stats, time.time())
             self.dut.reset()
         except:
             pass
 
+        self.anomalies = monitor.to_list()
+        self.stop_reason = policy.stop_reason
         self.stop_time = datetime.now()
-        self._compile_results()
+        self._save_report_data()
+
+    def _save_report_data(self):
+        create_directory(self.directory)
 
-    def _add_pdf(self):
-        now = datetime.now()
-        filepath_date = now.strftime("%m_%d_%y")
-        gen = ReportGenerator(
-            f"{self.directory}/advertising_stability_report_{filepath_date}.pdf"
+        self.results.save(f"{self.directory}/{SAMPLES_FNAME}")
+        save_report_meta(
+            self.directory,
+            {
+                "dut": self.dut_board,
+                "target": self.target,
+                "package": self.package,
+                "sample_rate": self.sample_rate,
+                "window": self.window,
+                "start_time": self.start_time.isoformat(),
+                "stop_time": self.stop_time.isoformat(),
+                "anomalies": self.anomalies,
+                "stop_reason": self.stop_reason,
+            },
         )
-        charts = glob(f"{self.directory}/*.png")
-
-        inch = gen.rlib.units.inch
-        for chart in charts:
-            gen.add_image(chart, img_dims=(8 * inch, 6 * inch))
-
-        gen.new_page()
-
-        last_data = self.results[-1]
-        cummulative_table = [
-            ["Metric", "Value", "Unit"],
-            ["TX Advertisments", last_data.tx_adv, "Count"],
-            ["Scan Requests", last_data.rx_req, "Count"],
-            ["Scan Request CRCs", last_data.rx_req_crc, "Count"],
-            ["Scan Request Timeouts", last_data.rx_req_timeout, "Count"],
-            ["Scan Responses", last_data.tx_resp, "Count"],
-            ["Adv Errors", last_data.err_adv, "Count"],
-            ["RX Setup", last_data.rx_setup, "usec"],
-            ["TX Setup", last_data.tx_setup, "usec"],
-            ["RX ISR", last_data.rx_isr, "usec"],
-            ["TX ISR", last_data.tx_isr, "usec"],
-            ["TX Chain", last_data.tx_chain if last_data.tx_chain else 0, "Count"],
-            ["Scan Request Rate", round(last_data.scan_request_rate(), 2), "%"],
-            ["Scan Request CRC Rate", round(last_data.scan_request_crc_rate(), 2), "%"],
-            [
-                "Scan Request Timeout Rate",
-                round(last_data.scan_request_timeout_rate(), 2),
-                "%",
-            ],
-            [
-                "Scan Request Fulfillment",
-                round(last_data.scan_req_fulfillment(), 2),
-                "%",
-            ],
-        ]
 
+
+def add_pdf(
+    results: SampleStore, window: IntervalSeries, meta: dict, directory: str
+):
+    now = datetime.now()
+    filepath_date = now.strftime("%m_%d_%y")
+    gen = ReportGenerator(
+        f"{directory}/advertising_stability_report_{filepath_date}.pdf"
+    )
+    charts = glob(f"{directory}/*.png")
+
+    inch = gen.rlib.units.inch
+    for chart in charts:
+        gen.add_image(chart, img_dims=(8 * inch, 6 * inch))
+
+    gen.new_page()
+
+    last_data = results.last()
+    cummulative_table = [
+        ["Metric", "Value", "Unit"],
+        ["TX Advertisments", last_data["tx_adv"], "Count"],
+        ["Scan Requests", last_data["rx_req"], "Count"],
+        ["Scan Request CRCs", last_data["rx_req_crc"], "Count"],
+        ["Scan Request Timeouts", last_data["rx_req_timeout"], "Count"],
+        ["Scan Responses", last_data["tx_resp"], "Count"],
+        ["Adv Errors", last_data["err_adv"], "Count"],
+        ["RX Setup", last_data["rx_setup"], "usec"],
+        ["TX Setup", last_data["tx_setup"], "usec"],
+        ["RX ISR", last_data["rx_isr"], "usec"],
+        ["TX ISR", last_data["tx_isr"], "usec"],
+        ["TX Chain", last_data["tx_chain"], "Count"],
+        [
+            "Scan Request Rate",
+            round(float(last_data["scan_request_rate"]), 2),
+            "%",
+        ],
+        [
+            "Scan Request CRC Rate",
+            round(float(last_data["scan_request_crc_rate"]), 2),
+            "%",
+        ],
+        [
+            "Scan Request Timeout Rate",
+            round(float(last_data["scan_request_timeout_rate"]), 2),
+            "%",
+        ],
+        [
+            "Scan Request Fulfillment",
+            round(float(last_data["scan_req_fulfillment"]), 2),
+            "%",
+        ],
+    ]
+
+    gen.add_table(
+        cummulative_table,
+        col_widths=(gen.page_width - inch) / 4,
+        caption="Cummulative Advertising Metrics",
+    )
+    gen.add_table(
+        window.table(),
+        col_widths=(gen.page_width - inch) / 4,
+        caption="Window Metrics",
+    )
+
+    start_time = datetime.fromisoformat(meta["start_time"])
+    stop_time = datetime.fromisoformat(meta["stop_time"])
+    misc_info_table = [
+        ["Title", "Value"],
+        ["DUT", meta["dut"]],
+        ["Target", meta["target"]],
+        ["Package", meta["package"]],
+        ["Date", now.strftime("%m/%d/%y")],
+        ["Stop Time", start_time.strftime("%H:%M:%S")],
+        ["Stop Time", stop_time.strftime("%H:%M:%S")],
+        ["Anomalies", len(meta.get("anomalies", []))],
+    ]
+    if meta.get("stop_reason"):
+        misc_info_table.append(["Stop Reason", meta["stop_reason"]])
+    gen.add_table(
+        misc_info_table,
+        col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 8,
+        caption="Misc Info",
+    )
+    if meta.get("anomalies"):
         gen.add_table(
-            cummulative_table,
+            anomaly_table(meta["anomalies"]),
             col_widths=(gen.page_width - inch) / 4,
-            caption="Cummulative Advertising Metrics",
+            caption="Anomalies",
         )
 
-        misc_info_table = [
-            ["Title", "Value"],
-            ["DUT", self.dut_board],
-            ["Target", self.target],
-            ["Package", self.package],
-            ["Date", now.strftime("%m/%d/%y")],
-            ["Stop Time", self.start_time.strftime("%H:%M:%S")],
-            ["Stop Time", self.stop_time.strftime("%H:%M:%S")],
-        ]
-        gen.add_table(
-            misc_info_table,
-            col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 8,
-            caption="Misc Info",
-        )
+    gen.add_table(
+        make_version_table(),
+        col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 7,
+        caption="Version Info",
+    )
 
-        gen.add_table(
-            make_version_table(),
-            col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 7,
-            caption="Version Info",
-        )
+    date = now.strftime("%m/%d/%y")
+    gen.build(doc_title=f"BLE Advertising Stability Report {date}")
 
-        date = now.strftime("%m/%d/%y")
-        gen.build(doc_title=f"BLE Advertising Stability Report {date}")
-
-    def _add_plots(self):
-        tx_data = []
-
-        scan_responses = []
-        scan_requests = []
-
-        rx_isr = []
-        tx_isr = []
-
-        rx_setup = []
-        tx_setup = []
-
-        req_rate = []
-        crc_rate = []
-        timeout_rate = []
-        fulfillment_rate = []
-
-        stat: scan_requests
-        for stat in self.results:
-            tx_data.append(stat.tx_adv)
-
-            scan_requests.append(stat.rx_req)
-            scan_responses.append(stat.tx_resp)
-            rx_isr.append(stat.rx_isr)
-            tx_isr.append(stat.tx_isr)
-            tx_setup.append(stat.tx_setup)
-            rx_setup.append(stat.rx_setup)
-
-            req_rate.append(stat.scan_request_rate())
-            crc_rate.append(stat.scan_request_crc_rate())
-            timeout_rate.append(stat.scan_request_timeout_rate())
-            fulfillment_rate.append(stat.scan_req_fulfillment())
-
-        time_data = [x * self.sample_rate for x in range(len(self.results))]
-
-        plt.plot(time_data, tx_data)
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Advertisments")
-        plt.title("Advertismenets Vs. Time")
-        plt.savefig(f"{self.directory}/advertisiments.png")
-        plt.close()
-
-        plt.plot(time_data, scan_responses, label="Scan Response")
-        plt.plot(time_data, scan_requests, label="Scan Request")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Packet Count")
-        plt.title("Scan Requests and Responses")
-        plt.legend()
-        plt.savefig(f"{self.directory}/scan_req_resp.png")
-
-        plt.close()
-
-        plt.plot(time_data, req_rate, label="Scan Request Rate")
-        plt.plot(time_data, crc_rate, label="Scan Request CRC Rate")
-        plt.plot(time_data, timeout_rate, label="Scan Request Timeout Rate")
-        plt.ylim([0, 100])
-        plt.xlabel("time (sec)")
-        plt.ylabel("Rate (%)")
-        plt.title("Scan Request Metrics Vs. Time")
-        plt.legend()
-        plt.savefig(f"{self.directory}/requets_metrics.png")
-        plt.close()
-
-        # ISR Timing
-        plt.plot(time_data, rx_isr, label="RX ISR")
-        plt.plot(time_data, tx_isr, label="TX ISR")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("ISR Time (usec)")
-        plt.title("ISR Timing")
-        plt.legend()
-        plt.savefig(f"{self.directory}/isr_timing.png")
-        plt.close()
-
-        # Setup Timing
-        plt.plot(time_data, rx_setup, label="RX SETUP")
-        plt.plot(time_data, tx_setup, label="TX SETUP")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Setup Time (usec)")
-        plt.title("Setup Timing")
-        plt.legend()
-        plt.savefig(f"{self.directory}/setup_timing.png")
-        plt.close()
-
-    def _compile_results(self):
-        create_directory(self.directory)
 
-        self._add_plots()
-        self._add_pdf()
+def compile_report(directory: str):
+    """Build the plots and PDF from the data saved in a result directory"""
+    meta = load_report_meta(directory)
+    results = SampleStore.from_file(f"{directory}/{SAMPLES_FNAME}", ADV_PKT_METRICS)
+
+    sample_rate = meta["sample_rate"]
+    window = meta.get("window", DEFAULT_WINDOW)
+    series = IntervalSeries(
+        results, ADV_PKT_INTERVALS, window_samples(window, sample_rate), sample_rate
+    )
+
+    render_charts(
+        ADV_CHARTS + window_charts(window),
+        {None: results, "window": series},
+        sample_rate,
+        directory,
+    )
+    add_pdf(results, series, meta, directory)
 
 
 def main():
@@ -325,16 +468,25 @@ def main():
 
     args = config_cli()
 
+    if args.report_only:
+        compile_report(args.directory)
+        return
+
     dut_board = args.dut
 
     adv_test = AdvTest(
         dut_board=dut_board,
-        sample_rate=int(args.sample_rate),
+        sample_rate=float(args.sample_rate),
         duration=int(args.time),
         directory=args.directory,
+        window=args.window,
+        metrics_port=args.metrics_port,
+        on_anomaly=args.on_anomaly,
+        extend_time=args.extend_time,
     )
 
     adv_test.run()
+    run_report_stage(args, compile_report, args.directory)
 
 
 if __name__ == "__main__":
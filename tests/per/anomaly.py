@@ -0,0 +1,456 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+anomaly.py
+
+Description: Streaming anomaly detection and run policies for stability tests
+
+"""
+import argparse
+import math
+from collections import deque
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from interval_metrics import IntervalSpec, RollingMetrics
+
+# What a run does once an anomaly is detected
+POLICIES = ("ignore", "abort", "extend")
+# Default extension of a run on anomaly in seconds
+DEFAULT_EXTEND_TIME = 600
+
+
+@dataclass
+class AnomalyLimits:
+    """Detector settings, durations in seconds"""
+
+    # Time used to learn the normal PER and ISR times
+    warmup: float = 60
+    # CUSUM of the interval PER above the learned PER plus the slack, in
+    # percent. Alarms once the accumulated excess reaches the threshold
+    per_slack: float = 5.0
+    per_threshold: float = 500.0
+    # Alarm while the smoothed interval PER stays above the limit
+    per_ewma_alpha: float = 0.1
+    per_ewma_limit: float = 90.0
+    # Alarm when more than this fraction of reads time out in the window
+    timeout_window: float = 60
+    timeout_limit: float = 0.5
+    # Alarm when more reconnects than the limit happen in the window
+    reconnect_window: float = 300
+    reconnect_limit: int = 5
+    # Alarm when the smoothed ISR time drifts this far from the learned one
+    isr_alpha: float = 0.05
+    isr_drift: float = 0.25
+
+
+@dataclass
+class Anomaly:
+    """One detected anomaly"""
+
+    detector: str
+    role: str
+    sample_index: int
+    timestamp: float
+    detail: str
+
+
+class Cusum:
+    """One sided CUSUM detecting an increase of the mean"""
+
+    def __init__(self, slack: float, threshold: float) -> None:
+        self.slack = slack
+        self.threshold = threshold
+        self.target = 0.0
+        self.value = 0.0
+        self.active = False
+
+    def update(self, sample: float) -> bool:
+        """Add a sample, True if the alarm was just raised"""
+        self.value = max(0.0, self.value + sample - self.target - self.slack)
+        if self.value == 0:
+            self.active = False
+        elif self.value >= self.threshold and not self.active:
+            self.active = True
+            return True
+
+        return False
+
+
+class Ewma:
+    """Exponentially weighted moving average"""
+
+    def __init__(self, alpha: float) -> None:
+        self.alpha = alpha
+        self.value = float("NaN")
+
+    def update(self, sample: float) -> float:
+        """Add a sample and return the new average"""
+        if math.isnan(self.value):
+            self.value = sample
+        else:
+            self.value += self.alpha * (sample - self.value)
+
+        return self.value
+
+
+class BurstCounter:
+    """Number of events in a sliding window of samples"""
+
+    def __init__(self, window: int) -> None:
+        self.window = max(window, 1)
+        self._events = deque(maxlen=self.window)
+        self.count = 0
+
+    def update(self, events: int) -> int:
+        """Add the events of one sample and return the window total"""
+        if len(self._events) == self.window:
+            self.count -= self._events[0]
+        self._events.append(events)
+        self.count += events
+
+        return self.count
+
+    @property
+    def samples(self) -> int:
+        """Number of samples in the window"""
+        return len(self._events)
+
+
+class _Latch:
+    def __init__(self) -> None:
+        self.active = False
+
+    def update(self, condition: bool) -> bool:
+        rising = condition and not self.active
+        self.active = condition
+        return rising
+
+
+class _RoleDetectors:
+    """PER, ISR and timeout detectors of one controller"""
+
+    def __init__(
+        self,
+        spec: IntervalSpec,
+        rate: Optional[str],
+        limits: AnomalyLimits,
+        sample_rate: float,
+    ) -> None:
+        self.spec = spec
+        self.rate = rate
+        self.limits = limits
+        self.warmup = max(int(limits.warmup / sample_rate), 1)
+
+        # Window of one sample gives the rates of the last interval
+        self.interval = RollingMetrics(spec, 1)
+        self.valid_samples = 0
+        self._per_sum = 0.0
+        self._per_count = 0
+        self.per_cusum = Cusum(limits.per_slack, limits.per_threshold)
+        self.per_ewma = Ewma(limits.per_ewma_alpha)
+        self.per_latch = _Latch()
+
+        self._isr_sums = np.zeros(len(spec.gauges))
+        self.isr_baseline = None
+        self.isr_ewma = [Ewma(limits.isr_alpha) for _ in spec.gauges]
+        self.isr_latch = [_Latch() for _ in spec.gauges]
+
+        self.timeouts = BurstCounter(int(limits.timeout_window / sample_rate))
+        self.timeout_latch = _Latch()
+
+    def update(self, record: Optional[np.void], timeout: bool) -> List[tuple]:
+        alarms = []
+
+        self.timeouts.update(int(timeout))
+        fraction = self.timeouts.count / self.timeouts.samples
+        if self.timeout_latch.update(
+            self.timeouts.samples == self.timeouts.window
+            and fraction > self.limits.timeout_limit
+        ):
+            alarms.append(
+                ("timeouts", f"{fraction:.0%} of reads timed out in the window")
+            )
+
+        if record is None or not any(record[name] for name in self.spec.counters):
+            return alarms
+
+        self.interval.update(record)
+        self.valid_samples += 1
+        # The first valid sample has no interval before it
+        if self.valid_samples == 1:
+            return alarms
+
+        alarms += self._update_per()
+        alarms += self._update_isr(record)
+
+        return alarms
+
+    def _update_per(self) -> List[tuple]:
+        if self.rate is None:
+            return []
+
+        per = self.interval.snapshot()[self.rate]
+        if math.isnan(per):
+            return []
+
+        learning = self._per_count < self.warmup
+        if learning:
+            self._per_sum += per
+            self._per_count += 1
+            self.per_cusum.target = self._per_sum / self._per_count
+
+        alarms = []
+        smoothed = self.per_ewma.update(per)
+        if self.per_latch.update(smoothed > self.limits.per_ewma_limit):
+            alarms.append(("per_ewma", f"Smoothed PER reached {smoothed:.1f}%"))
+        if not learning and self.per_cusum.update(per):
+            alarms.append(
+                (
+                    "per_cusum",
+                    f"PER rose above the learned {self.per_cusum.target:.1f}%",
+                )
+            )
+
+        return alarms
+
+    def _update_isr(self, record: np.void) -> List[tuple]:
+        values = np.array([record[name] for name in self.spec.gauges], dtype=float)
+
+        if self.isr_baseline is None:
+            self._isr_sums += values
+            if self.valid_samples > self.warmup:
+                self.isr_baseline = self._isr_sums / self.warmup
+            return []
+
+        alarms = []
+        for i, name in enumerate(self.spec.gauges):
+            smoothed = self.isr_ewma[i].update(values[i])
+            baseline = self.isr_baseline[i]
+            drift = abs(smoothed - baseline) / baseline if baseline else 0.0
+            if self.isr_latch[i].update(drift > self.limits.isr_drift):
+                alarms.append(
+                    (
+                        "isr_drift",
+                        f"{name} drifted to {smoothed:.1f} usec "
+                        f"from {baseline:.1f} usec",
+                    )
+                )
+
+        return alarms
+
+
+class AnomalyMonitor:
+    """Per sample anomaly detection over the stats of one or more controllers
+
+    Runs a CUSUM and an EWMA over the interval PER, a sliding window rate of
+    read timeouts and an EWMA drift check of the ISR times per controller,
+    plus a sliding window count of reconnects for the whole test. The
+    normal PER and ISR times are learned over the warmup. Every detector
+    reports once when it trips and again only after it has cleared.
+    """
+
+    def __init__(
+        self,
+        spec: IntervalSpec,
+        roles: List[str],
+        sample_rate: float,
+        rate: Optional[str] = "per",
+        limits: Optional[AnomalyLimits] = None,
+    ) -> None:
+        """Create a monitor
+
+        Parameters
+        ----------
+        spec : IntervalSpec
+            Counters and gauges of the samples
+        roles : List[str]
+            Name of each controller sampled, e.g. ``["periph", "central"]``
+        sample_rate : float
+            Sample period in seconds
+        rate : Optional[str], optional
+            Rate of ``spec`` watched as the PER. PER detection is off if None
+        limits : Optional[AnomalyLimits], optional
+            Detector settings
+        """
+        self.limits = limits or AnomalyLimits()
+        self.detectors = {
+            role: _RoleDetectors(spec, rate, self.limits, sample_rate)
+            for role in roles
+        }
+        self.reconnects = BurstCounter(
+            int(self.limits.reconnect_window / sample_rate)
+        )
+        self._reconnect_latch = _Latch()
+        self.anomalies: List[Anomaly] = []
+
+    def update(
+        self,
+        index: int,
+        timestamp: float,
+        records: Dict[str, Optional[np.void]],
+        timeouts: Optional[Dict[str, bool]] = None,
+        reconnects: int = 0,
+    ) -> List[Anomaly]:
+        """Add the samples taken at one instant
+
+        Parameters
+        ----------
+        index : int
+            Sample index
+        timestamp : float
+            Epoch time of the samples
+        records : Dict[str, Optional[np.void]]
+            Newest sample of each controller, None if it could not be read
+        timeouts : Optional[Dict[str, bool]], optional
+            Controllers whose read timed out
+        reconnects : int, optional
+            Reconnects since the previous sample
+
+        Returns
+        -------
+        List[Anomaly]
+            Anomalies detected at this sample
+        """
+        timeouts = timeouts or {}
+        found = []
+
+        for role, record in records.items():
+            for detector, detail in self.detectors[role].update(
+                record, timeouts.get(role, False)
+            ):
+                found.append(Anomaly(detector, role, index, timestamp, detail))
+
+        count = self.reconnects.update(reconnects)
+        if self._reconnect_latch.update(count > self.limits.reconnect_limit):
+            found.append(
+                Anomaly(
+                    "reconnect_storm",
+                    "",
+                    index,
+                    timestamp,
+                    f"{count} reconnects in {self.limits.reconnect_window:g} s",
+                )
+            )
+
+        self.anomalies += found
+        return found
+
+    def to_list(self) -> List[dict]:
+        """Detected anomalies as JSON serializable dicts"""
+        return [asdict(anomaly) for anomaly in self.anomalies]
+
+
+def add_anomaly_args(parser: argparse.ArgumentParser) -> None:
+    """Add the anomaly policy options to a test's command line
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Test argument parser
+    """
+    parser.add_argument(
+        "--on-anomaly",
+        choices=POLICIES,
+        default="ignore",
+        help="Stop the run early or extend it once an anomaly is detected. "
+        "Anomalies are always listed in the report",
+    )
+    parser.add_argument(
+        "--extend-time",
+        type=float,
+        default=DEFAULT_EXTEND_TIME,
+        help="Seconds added to the run with --on-anomaly extend",
+    )
+
+
+class AnomalyPolicy:
+    """Decide how many samples a run takes as anomalies are detected"""
+
+    def __init__(
+        self,
+        policy: str,
+        extend_time: float,
+        sample_rate: float,
+        iterations: int,
+        stop_reason: Optional[str] = None,
+    ) -> None:
+        """Create a policy
+
+        Parameters
+        ----------
+        policy : str
+            One of ``POLICIES``
+        extend_time : float
+            Seconds added to the run on the first anomaly with "extend"
+        sample_rate : float
+            Sample period in seconds
+        iterations : int
+            Number of samples the run is planned with
+        stop_reason : Optional[str], optional
+            Reason the plan was already changed, when resuming a run
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown anomaly policy {policy}")
+
+        self.policy = policy
+        self.extension = int(extend_time / sample_rate)
+        self.iterations = iterations
+        self.stop_reason = stop_reason
+
+    def apply(self, index: int, anomalies: List[Anomaly]) -> int:
+        """Update the planned number of samples after sample ``index``
+
+        A run is extended once, so a board that keeps failing can not hold
+        the test forever.
+
+        Returns
+        -------
+        int
+            Index to stop before
+        """
+        if not anomalies or self.stop_reason is not None:
+            return self.iterations
+
+        if self.policy == "abort":
+            self.iterations = index + 1
+            self.stop_reason = f"Aborted on {anomalies[0].detector}"
+        elif self.policy == "extend":
+            self.iterations += self.extension
+            self.stop_reason = f"Extended on {anomalies[0].detector}"
+
+        return self.iterations
+
+
+def anomaly_table(anomalies: List[dict]) -> List[list]:
+    """Report table of anomalies as returned by ``AnomalyMonitor.to_list``"""
+    table = [["Time", "Detector", "Role", "Detail"]]
+    for anomaly in anomalies:
+        table.append(
+            [
+                datetime.fromtimestamp(anomaly["timestamp"]).strftime("%H:%M:%S"),
+                anomaly["detector"],
+                anomaly["role"],
+                anomaly["detail"],
+            ]
+        )
+
+    return table
@@ -0,0 +1,249 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+charts.py
+
+Description: Declarative report charts rendered in parallel
+
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+# pylint: disable=wrong-import-position
+import numpy as np
+from matplotlib.figure import Figure
+
+from sample_store import SampleStore
+
+# pylint: enable=wrong-import-position
+
+# Matplotlib's default figure size and resolution
+FIG_SIZE = (6.4, 4.8)
+FIG_DPI = 100
+
+
+@dataclass
+class Line:
+    """One series of a chart"""
+
+    column: str
+    label: Optional[str] = None
+    linestyle: str = "-"
+    # Store the column is read from when a chart mixes several
+    source: Optional[str] = None
+    # Value plotted for NaN samples, NaN samples are left as gaps if None
+    nan: Optional[float] = None
+    # "minmax" keeps every spike, "lttb" suits smooth series like counters
+    decimation: str = "minmax"
+
+
+@dataclass
+class ChartSpec:
+    """One report figure"""
+
+    filename: str
+    title: str
+    xlabel: str
+    ylabel: str
+    lines: List[Line] = field(default_factory=list)
+    ylim: Optional[Tuple[float, float]] = None
+
+
+def minmax_decimate(
+    x: np.ndarray, y: np.ndarray, buckets: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce a series to the min and max sample of each bucket
+
+    The envelope drawn from the reduced series is the same as from the
+    full one at a width of ``buckets`` pixels, so spikes are kept.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sample times
+    y : np.ndarray
+        Sample values
+    buckets : int
+        Number of buckets, normally the plot width in pixels
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Decimated times and values, in time order
+    """
+    num_samples = len(y)
+    if num_samples <= 2 * buckets:
+        return x, y
+
+    size = -(-num_samples // buckets)
+    grid = np.minimum(np.arange(buckets * size).reshape(buckets, size), num_samples - 1)
+    values = y[grid].astype(float)
+
+    offsets = np.arange(buckets) * size
+    mins = np.where(np.isnan(values), np.inf, values).argmin(axis=1) + offsets
+    maxs = np.where(np.isnan(values), -np.inf, values).argmax(axis=1) + offsets
+
+    index = np.unique(np.minimum(np.concatenate((mins, maxs)), num_samples - 1))
+    return x[index], y[index]
+
+
+def lttb_decimate(
+    x: np.ndarray, y: np.ndarray, threshold: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce a series with Largest-Triangle-Three-Buckets
+
+    Keeps the first and last sample and, from each bucket in between, the
+    sample forming the largest triangle with the previously kept sample and
+    the mean of the next bucket. Steps such as counter resets are kept. The
+    Python loop runs once per bucket so the cost is bounded by ``threshold``
+    regardless of the series length. Series with NaN fall back to
+    ``minmax_decimate``.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sample times
+    y : np.ndarray
+        Sample values
+    threshold : int
+        Number of samples to keep
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Decimated times and values, in time order
+    """
+    num_samples = len(y)
+    if num_samples <= threshold or threshold < 3:
+        return x, y
+    if np.isnan(y).any():
+        return minmax_decimate(x, y, threshold // 2)
+
+    x_data = x.astype(float)
+    y_data = y.astype(float)
+
+    # threshold - 2 buckets between the fixed first and last sample
+    edges = np.linspace(1, num_samples - 1, threshold - 1).astype(int)
+    index = np.empty(threshold, dtype=int)
+    index[0] = 0
+    index[-1] = num_samples - 1
+
+    prev = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else num_samples
+        next_x = x_data[stop:next_stop].mean()
+        next_y = y_data[stop:next_stop].mean()
+
+        area = np.abs(
+            (x_data[prev] - next_x) * (y_data[start:stop] - y_data[prev])
+            - (x_data[prev] - x_data[start:stop]) * (next_y - y_data[prev])
+        )
+        prev = start + int(area.argmax())
+        index[bucket + 1] = prev
+
+    return x[index], y[index]
+
+
+DECIMATORS = {"minmax": minmax_decimate, "lttb": lttb_decimate}
+
+
+def _render(spec: ChartSpec, series: List[Tuple[np.ndarray, np.ndarray]], path: str):
+    fig = Figure(figsize=FIG_SIZE, dpi=FIG_DPI)
+    axes = fig.subplots()
+
+    for line, (x_data, y_data) in zip(spec.lines, series):
+        axes.plot(x_data, y_data, label=line.label, linestyle=line.linestyle)
+
+    if spec.ylim is not None:
+        axes.set_ylim(spec.ylim)
+    axes.set_xlabel(spec.xlabel)
+    axes.set_ylabel(spec.ylabel)
+    axes.set_title(spec.title)
+    if any(line.label for line in spec.lines):
+        axes.legend()
+
+    fig.savefig(path)
+
+    return path
+
+
+def render_charts(
+    specs: List[ChartSpec],
+    sources: Union[SampleStore, Dict[Optional[str], SampleStore]],
+    sample_rate: float,
+    directory: str,
+    workers: Optional[int] = None,
+) -> List[str]:
+    """Render charts concurrently in a process pool
+
+    Series are decimated to the figure width with ``Line.decimation``
+    before being handed to the workers, so neither the plotting cost nor
+    the output size grows with the run length.
+
+    Parameters
+    ----------
+    specs : List[ChartSpec]
+        Charts to render
+    sources : Union[SampleStore, Dict[Optional[str], SampleStore]]
+        Store read by every line, or stores selected by ``Line.source``.
+        Anything with ``column`` and ``sample_times``, such as an
+        ``IntervalSeries``, can be used as a store
+    sample_rate : float
+        Nominal sample period, used if samples lack capture times
+    directory : str
+        Directory the PNGs are saved to
+    workers : Optional[int], optional
+        Number of processes. Defaults to one per CPU
+
+    Returns
+    -------
+    List[str]
+        Path of each chart in the order of ``specs``
+    """
+    width = int(FIG_SIZE[0] * FIG_DPI)
+    times = {}
+
+    jobs = []
+    for spec in specs:
+        series = []
+        for line in spec.lines:
+            if isinstance(sources, dict):
+                store = sources[line.source]
+            else:
+                store = sources
+            if id(store) not in times:
+                times[id(store)] = store.sample_times(sample_rate)
+
+            y_data = store.column(line.column)
+            if line.nan is not None:
+                y_data = np.nan_to_num(y_data, nan=line.nan)
+            decimate = DECIMATORS[line.decimation]
+            series.append(decimate(times[id(store)], y_data, width))
+
+        jobs.append((spec, series, os.path.join(directory, spec.filename)))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_render, *job) for job in jobs]
+        return [future.result() for future in futures]
@@ -66,7 +66,7 @@ from datetime import datetime
 from glob import glob
 from typing import List
 
-import matplotlib.pyplot as plt
+import numpy as np
 import resource_manager
 
 # pylint: disable=import-error,wrong-import-position
@@ -80,8 +80,43 @@ from packaging import version
 from resource_manager import ResourceManager
 from rich import print
 
+from anomaly import (
+    Anomaly,
+    AnomalyMonitor,
+    AnomalyPolicy,
+    add_anomaly_args,
+    anomaly_table,
+)
+from charts import ChartSpec, Line, render_charts
+from interval_metrics import (
+    DATA_PKT_INTERVALS,
+    DEFAULT_WINDOW,
+    IntervalSeries,
+    RollingMetrics,
+    window_samples,
+)
+from metrics_exporter import MetricsExporter, record_metrics
+from report_stage import (
+    add_report_args,
+    load_report_meta,
+    run_report_stage,
+    save_report_meta,
+)
+from sample_store import (
+    DATA_PKT_FIELDS,
+    DATA_PKT_METRICS,
+    SampleStore,
+    load_checkpoint,
+    save_checkpoint,
+)
+from sampler import MIN_SAMPLE_PERIOD, PeriodicSampler
+
 # pylint: enable=import-error,wrong-import-position
 
+CHECKPOINT_FNAME = "checkpoint.json"
+PERIPH_JOURNAL_FNAME = "periph_samples.journal"
+CENTRAL_JOURNAL_FNAME = "central_samples.journal"
+
 if version.parse(resource_manager.__version__) < version.parse("1.1.1"):
     raise RuntimeError("Resource manager of 1.1.1 or greater is required")
 
@@ -97,118 +132,114 @@ def get_git_hash(path):
         return "Unknown"
 
 
-def save_per_plot(periph, central, sample_rate, directory):
-    time_data = [x * sample_rate for x in range(len(periph))]
-
-    pers_periph = []
-    pers_central = []
-
-    stat: DataPktStats
-
-    for i, stat in enumerate(periph):
-        try:
-            pers_periph.append(stat.per())
-        except ZeroDivisionError:
-            pers_periph.append(100)
-
-        try:
-            pers_central.append(central[i].per())
-        except ZeroDivisionError:
-            pers_central.append(100)
-
-    filepath = f"{directory}/per.png"
-
-    plt.plot(time_data, pers_periph, label="peripheral", linestyle="--")
-    plt.plot(time_data, pers_central, label="central")
-    plt.ylim([0, 100])
-    plt.xlabel("time (sec)")
-    plt.ylabel("PER (%)")
-    plt.title("PER Vs. Time")
-    plt.legend()
-    plt.savefig(filepath)
-    plt.close()
-
-    return filepath
-
-
-def save_individual(data, sample_rate, label, directory) -> DataPktStats:
-    time_data = [x * sample_rate for x in range(len(data))]
-
-    crcs = []
-    timeouts = []
-    rx_ok = []
-    tx_data = []
-    rx_setup = []
-    tx_setup = []
-    rx_isr = []
-    tx_isr = []
-
-    stat: DataPktStats
-
-    for stat in data:
-        rx_ok.append(stat.rx_data)
-        crcs.append(stat.rx_data_crc)
-        timeouts.append(stat.rx_data_timeout)
-        tx_data.append(stat.tx_data)
-
-        rx_setup.append(stat.rx_setup)
-        tx_setup.append(stat.tx_setup)
-        rx_isr.append(stat.rx_isr)
-        tx_isr.append(stat.tx_isr)
-
-    # RX Packet stats
-    plt.plot(time_data, rx_ok, label="RX-OK")
-    plt.plot(time_data, crcs, label="RX-CRC")
-    plt.plot(time_data, timeouts, label="RX-Timeout")
-    plt.xlabel("time (sec)")
-    plt.ylabel("Packets (count)")
-    plt.title(f"{label} RX Packet Stats")
-    plt.legend()
-    plt.savefig(f"{directory}/{label}_rx_data.png")
-    plt.close()
-
-    # TX Packet Stats
-    plt.plot(time_data, tx_data)
-    plt.xlabel("time (sec)")
-    plt.ylabel("Packets (count)")
-    plt.title(f"{label} Transmitted Packets Vs. Time")
-    plt.savefig(f"{directory}/{label}_tx_data.png")
-    plt.close()
-
-    # ISR Timing
-    plt.plot(time_data, tx_isr, label="TX-ISR")
-    plt.plot(time_data, rx_isr, label="RX-ISR")
-    plt.xlabel("time (sec)")
-    plt.ylabel("ISR Times (usec)")
-    plt.title(f"{label} ISR Timing Vs. Time")
-    plt.legend()
-    plt.savefig(f"{directory}/{label}_isr.png")
-    plt.close()
-
-    # Setup Timing
-    plt.plot(time_data, tx_setup, label="TX-Setup")
-    plt.plot(time_data, rx_setup, label="RX-Setup")
-    plt.xlabel("time (sec)")
-    plt.ylabel("SetupTimes (usec)")
-    plt.title(f"{label} Setup Timing Vs. Time")
-    plt.legend()
-    plt.savefig(f"{directory}/{label}_setup.png")
-    plt.close()
-
-
-def make_table(data: DataPktStats):
+PER_CHART = ChartSpec(
+    "per.png",
+    "PER Vs. Time",
+    "time (sec)",
+    "PER (%)",
+    # Samples without any received packets count as fully errored
+    [
+        Line("per", "peripheral", linestyle="--", source="periph", nan=100),
+        Line("per", "central", source="central", nan=100),
+    ],
+    ylim=(0, 100),
+)
+
+
+def window_charts(window: float) -> List[ChartSpec]:
+    return [
+        ChartSpec(
+            "per_window.png",
+            f"{window:g} s Window PER Vs. Time",
+            "time (sec)",
+            "PER (%)",
+            [
+                Line("per", "peripheral", linestyle="--", source="periph_window"),
+                Line("per", "central", source="central_window"),
+            ],
+            ylim=(0, 100),
+        ),
+        ChartSpec(
+            "throughput.png",
+            f"{window:g} s Window Throughput Vs. Time",
+            "time (sec)",
+            "Packets/s",
+            [
+                Line("rx_data_per_sec", "Peripheral RX", source="periph_window"),
+                Line(
+                    "tx_data_per_sec",
+                    "Peripheral TX",
+                    linestyle="--",
+                    source="periph_window",
+                ),
+                Line("rx_data_per_sec", "Central RX", source="central_window"),
+                Line(
+                    "tx_data_per_sec",
+                    "Central TX",
+                    linestyle="--",
+                    source="central_window",
+                ),
+            ],
+        ),
+    ]
+
+
+def individual_charts(label: str, source: str) -> List[ChartSpec]:
+    return [
+        ChartSpec(
+            f"{label}_rx_data.png",
+            f"{label} RX Packet Stats",
+            "time (sec)",
+            "Packets (count)",
+            [
+                Line("rx_data", "RX-OK", source=source, decimation="lttb"),
+                Line("rx_data_crc", "RX-CRC", source=source, decimation="lttb"),
+                Line("rx_data_timeout", "RX-Timeout", source=source, decimation="lttb"),
+            ],
+        ),
+        ChartSpec(
+            f"{label}_tx_data.png",
+            f"{label} Transmitted Packets Vs. Time",
+            "time (sec)",
+            "Packets (count)",
+            [Line("tx_data", source=source, decimation="lttb")],
+        ),
+        ChartSpec(
+            f"{label}_isr.png",
+            f"{label} ISR Timing Vs. Time",
+            "time (sec)",
+            "ISR Times (usec)",
+            [
+                Line("tx_isr", "TX-ISR", source=source),
+                Line("rx_isr", "RX-ISR", source=source),
+            ],
+        ),
+        ChartSpec(
+            f"{label}_setup.png",
+            f"{label} Setup Timing Vs. Time",
+            "time (sec)",
+            "SetupTimes (usec)",
+            [
+                Line("tx_setup", "TX-Setup", source=source),
+                Line("rx_setup", "RX-Setup", source=source),
+            ],
+        ),
+    ]
+
+
+def make_table(data: np.void):
     return [
         ["Stat", "Value", "Unit"],
-        ["RX OK", data.rx_data, "Count"],
-        ["RX CRC", data.rx_data_crc, "Count"],
-        ["RX Timeout", data.rx_data_timeout, "Count"],
-        ["TX OK", data.tx_data, "Count"],
-        ["Err Data", data.err_data, "Count"],
-        ["RX Setup", data.rx_setup, "usec"],
-        ["TX Setup", data.tx_setup, "usec"],
-        ["RX ISR", data.rx_isr, "usec"],
-        ["TX ISR", data.tx_isr, "usec"],
-        ["PER", round(data.per(), 2), "%"],
+        ["RX OK", data["rx_data"], "Count"],
+        ["RX CRC", data["rx_data_crc"], "Count"],
+        ["RX Timeout", data["rx_data_timeout"], "Count"],
+        ["TX OK", data["tx_data"], "Count"],
+        ["Err Data", data["err_data"], "Count"],
+        ["RX Setup", data["rx_setup"], "usec"],
+        ["TX Setup", data["tx_setup"], "usec"],
+        ["RX ISR", data["rx_isr"], "usec"],
+        ["TX ISR", data["tx_isr"], "usec"],
+        ["PER", round(float(data["per"]), 2), "%"],
     ]
 
 
@@ -233,10 +264,13 @@ def make_version_table():
 
 
 def add_pdf(
-    periph_overall: List[dict],
-    central_overall: List[dict],
+    periph_overall: np.void,
+    central_overall: np.void,
     directory: str,
     misc_data: dict,
+    periph_window: IntervalSeries,
+    central_window: IntervalSeries,
+    anomalies: List[dict],
 ):
     now = datetime.now()
     filepath_date = now.strftime("%m_%d_%y")
@@ -267,12 +301,28 @@ def add_pdf(
         col_widths=(gen.page_width - inch) / 4,
         caption="Central Metrics",
     )
+    gen.add_table(
+        periph_window.table(),
+        col_widths=(gen.page_width - inch) / 4,
+        caption="Peripheral Window Metrics",
+    )
+    gen.add_table(
+        central_window.table(),
+        col_widths=(gen.page_width - inch) / 4,
+        caption="Central Window Metrics",
+    )
 
     gen.add_table(
         make_misc_table(misc_data),
         col_widths=(gen.page_width - inch) * 3 / 8,
         caption="Misc. Metrics",
     )
+    if anomalies:
+        gen.add_table(
+            anomaly_table(anomalies),
+            col_widths=(gen.page_width - inch) / 4,
+            caption="Anomalies",
+        )
 
     gen.new_page()
     gen.add_table(
@@ -285,39 +335,87 @@ def add_pdf(
     gen.build(doc_title=f"BLE Connection Stability Report {date}")
 
 
-def save_results(
-    periph, central, sample_rate, misc_data: dict, phy: str, directory: str
+def save_report_data(
+    periph: SampleStore,
+    central: SampleStore,
+    sample_rate,
+    misc_data: dict,
+    phy: str,
+    window: float,
+    anomalies: List[dict],
+    directory: str,
 ):
-    """Store PER Results
+    """Save everything the report is built from
 
     Parameters
     ----------
-    results : Dict[str,list]
-        Results from per sweep
+    periph : SampleStore
+        Peripheral samples
+    central : SampleStore
+        Central samples
     """
+    periph.save(f"{directory}/Peripheral_{phy}_samples.npy")
+    central.save(f"{directory}/Central_{phy}_samples.npy")
+
+    save_report_meta(
+        directory,
+        {
+            "phy": phy,
+            "sample_rate": sample_rate,
+            "window": window,
+            "misc": misc_data,
+            "anomalies": anomalies,
+        },
+    )
 
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-    else:
-        shutil.rmtree(directory)
-        os.mkdir(directory)
 
-    save_per_plot(periph, central, sample_rate=sample_rate, directory=directory)
+def compile_report(directory: str):
+    """Build the plots and PDF from the data saved in a result directory
 
-    save_individual(
-        data=periph,
-        sample_rate=sample_rate,
-        label=f"Peripheral_{phy}",
-        directory=directory,
+    Parameters
+    ----------
+    directory : str
+        Result directory written by ``save_report_data``
+    """
+    meta = load_report_meta(directory)
+    phy = meta["phy"]
+    sample_rate = meta["sample_rate"]
+
+    periph = SampleStore.from_file(
+        f"{directory}/Peripheral_{phy}_samples.npy", DATA_PKT_METRICS
     )
-    save_individual(
-        data=central,
-        sample_rate=sample_rate,
-        label=f"Central_{phy}",
-        directory=directory,
+    central = SampleStore.from_file(
+        f"{directory}/Central_{phy}_samples.npy", DATA_PKT_METRICS
     )
 
-    add_pdf(periph[-1], central[-1], directory, misc_data)
+    window = meta.get("window", DEFAULT_WINDOW)
+    num_window = window_samples(window, sample_rate)
+    sources = {
+        "periph": periph,
+        "central": central,
+        "periph_window": IntervalSeries(
+            periph, DATA_PKT_INTERVALS, num_window, sample_rate
+        ),
+        "central_window": IntervalSeries(
+            central, DATA_PKT_INTERVALS, num_window, sample_rate
+        ),
+    }
+
+    charts = [PER_CHART]
+    charts += window_charts(window)
+    charts += individual_charts(f"Peripheral_{phy}", "periph")
+    charts += individual_charts(f"Central_{phy}", "central")
+    render_charts(charts, sources, sample_rate, directory)
+
+    add_pdf(
+        periph.last(),
+        central.last(),
+        directory,
+        meta["misc"],
+        sources["periph_window"],
+        sources["central_window"],
+        meta.get("anomalies", []),
+    )
 
 
 reconnect = False
@@ -355,8 +453,28 @@ def config_cli():
         "-s",
         "--sample-rate",
         default=1,
-        help="Sample rate in seconds. Minimum of 1 second",
+        type=float,
+        help=f"Sample period in seconds. Minimum of {MIN_SAMPLE_PERIOD} seconds",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the journal in the result directory",
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        default=DEFAULT_WINDOW,
+        type=float,
+        help="Rolling window in seconds for the interval PER and throughput",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve live stats in Prometheus format on this local port",
     )
+    add_anomaly_args(parser)
+    add_report_args(parser)
 
     return parser.parse_args()
 
@@ -383,6 +501,10 @@ def main():
 
     args = config_cli()
 
+    if args.report_only:
+        compile_report(args.directory)
+        return
+
     central_board: str = args.central
     periph_board: str = args.peripheral
 
@@ -391,10 +513,37 @@ def main():
             f"Central must not be the same as peripheral, {central_board} = {periph_board}"
         )
 
+    checkpoint_path = os.path.join(args.directory, CHECKPOINT_FNAME)
+    if args.resume:
+        state = load_checkpoint(checkpoint_path)
+        if (state["central"], state["peripheral"]) != (central_board, periph_board):
+            raise ValueError(
+                f"Journal in {args.directory} is for {state['central']} and "
+                f"{state['peripheral']}, not {central_board} and {periph_board}"
+            )
+    else:
+        if os.path.exists(args.directory):
+            shutil.rmtree(args.directory)
+        os.mkdir(args.directory)
+
+        state = {
+            "central": central_board,
+            "peripheral": periph_board,
+            "phy": args.phy,
+            "sample_rate": max(args.sample_rate, MIN_SAMPLE_PERIOD),
+            "time": int(args.time),
+            "window": args.window,
+            "start_time": datetime.now().isoformat(),
+            "Dropped Connections": 0,
+            "Timeouts": 0,
+        }
+        save_checkpoint(checkpoint_path, state)
+
     resource_manager = ResourceManager()
 
-    sample_rate = args.sample_rate if args.sample_rate >= 1 else 1
-    iterations = int(int(args.time) / float(sample_rate))
+    sample_rate = state["sample_rate"]
+    # Cut short or extended by the anomaly policy
+    iterations = state.get("iterations", int(state["time"] / float(sample_rate)))
     assert isinstance(iterations, int)
 
     central_hci_port = resource_manager.get_item_value(f"{central_board}.hci_port")
@@ -414,12 +563,32 @@ def main():
         id_tag="periph",
     )
 
-    periph_cummulative = []
-    central_cummulative = []
+    # One sample per iteration plus the final read
+    periph_cummulative = SampleStore(
+        DATA_PKT_FIELDS,
+        iterations + 1,
+        metrics=DATA_PKT_METRICS,
+        journal=os.path.join(args.directory, PERIPH_JOURNAL_FNAME),
+        resume=args.resume,
+    )
+    central_cummulative = SampleStore(
+        DATA_PKT_FIELDS,
+        iterations + 1,
+        metrics=DATA_PKT_METRICS,
+        journal=os.path.join(args.directory, CENTRAL_JOURNAL_FNAME),
+        resume=args.resume,
+    )
+
+    # A crash between the two appends leaves one side a sample ahead
+    start_index = min(len(periph_cummulative), len(central_cummulative))
+    periph_cummulative.truncate(start_index)
+    central_cummulative.truncate(start_index)
+    if args.resume:
+        print(f"[cyan]Resuming at sample {start_index} of {iterations}[/cyan]")
 
     misc = {
-        "Dropped Connections": 0,
-        "Timeouts": 0,
+        "Dropped Connections": state["Dropped Connections"],
+        "Timeouts": state["Timeouts"],
         "Central Board": central_board,
         "Peripheral Board": periph_board,
         "Central Target": resource_manager.get_item_value(f"{central_board}.target"),
@@ -432,7 +601,7 @@ def main():
         ),
     }
 
-    start_time = datetime.now()
+    start_time = datetime.fromisoformat(state["start_time"])
 
     connect(periph, central)
 
@@ -443,21 +612,79 @@ def main():
     except:
         pass
 
-    with alive_bar(iterations) as bar:
-        for _ in range(iterations):
-            try:
-                periph_stats, _ = periph.get_conn_stats()
-                periph_cummulative.append(periph_stats)
-            except TimeoutError or TypeError:
-                misc["Timeouts"] += 1
-                periph_cummulative.append(DataPktStats())
-
-            try:
-                central_stats, _ = central.get_conn_stats()
-                central_cummulative.append(central_stats)
-            except TimeoutError or TypeError:
-                misc["Timeouts"] += 1
-                central_cummulative.append(DataPktStats())
+    sampler = PeriodicSampler(
+        sample_rate,
+        {"periph": periph.get_conn_stats, "central": central.get_conn_stats},
+    )
+    stores = {"periph": periph_cummulative, "central": central_cummulative}
+    window = state.get("window", DEFAULT_WINDOW)
+    rolling = {
+        name: RollingMetrics(DATA_PKT_INTERVALS, window_samples(window, sample_rate))
+        for name in stores
+    }
+    for name, store in stores.items():
+        rolling[name].extend(store.records())
+
+    exporter = MetricsExporter(
+        args.metrics_port,
+        "ble_connection_stability",
+        labels={
+            "central": central_board,
+            "peripheral": periph_board,
+            "phy": state["phy"],
+        },
+    )
+
+    monitor = AnomalyMonitor(DATA_PKT_INTERVALS, list(stores), sample_rate)
+    monitor.anomalies = [Anomaly(**anomaly) for anomaly in state.get("anomalies", [])]
+    policy = AnomalyPolicy(
+        args.on_anomaly,
+        args.extend_time,
+        sample_rate,
+        iterations,
+        stop_reason=state.get("stop_reason"),
+    )
+
+    with sampler, exporter, alive_bar(iterations - start_index) as bar:
+        for index in sampler.ticks(start_index, lambda: policy.iterations):
+            timeouts = {}
+            for name, sample in sampler.poll().items():
+                timeouts[name] = sample.error is not None
+                if sample.error is None:
+                    stores[name].append(sample.value[0], sample.timestamp)
+                elif isinstance(sample.error, (TimeoutError, TypeError)):
+                    misc["Timeouts"] += 1
+                    stores[name].append(DataPktStats(), sample.timestamp)
+                else:
+                    raise sample.error
+
+                rolling[name].update(stores[name].last())
+                snapshot = rolling[name].snapshot()
+                exporter.publish(
+                    {
+                        **record_metrics(stores[name].last()),
+                        **{f"window_{key}": value for key, value in snapshot.items()},
+                    },
+                    role=name,
+                )
+
+            bar.text = " | ".join(
+                f"{name}: {metrics.summary()}" for name, metrics in rolling.items()
+            )
+
+            anomalies = monitor.update(
+                index,
+                sample.timestamp,
+                {name: store.last() for name, store in stores.items()},
+                timeouts,
+                reconnects=int(reconnect),
+            )
+            for anomaly in anomalies:
+                print(
+                    f"[yellow]Anomaly on {anomaly.role or 'connection'}: "
+                    f"{anomaly.detail}[/yellow]"
+                )
+            policy.apply(index, anomalies)
 
             if reconnect:
                 misc["Dropped Connections"] += 1
@@ -467,14 +694,33 @@ def main():
                 except TimeoutError:
                     misc["Timeouts"] += 1
 
+            exporter.publish(
+                {
+                    "sample_index": index + 1,
+                    "timeouts": misc["Timeouts"],
+                    "dropped_connections": misc["Dropped Connections"],
+                    "anomalies": len(monitor.anomalies),
+                }
+            )
+
+            state["sample_index"] = index + 1
+            state["Dropped Connections"] = misc["Dropped Connections"]
+            state["Timeouts"] = misc["Timeouts"]
+            state["iterations"] = policy.iterations
+            state["anomalies"] = monitor.to_list()
+            if policy.stop_reason is not None:
+                state["stop_reason"] = policy.stop_reason
+            save_checkpoint(checkpoint_path, state)
+
             bar()
-            time.sleep(sample_rate)
 
     try:
         periph_stats, _ = periph.get_conn_stats()
         central_stats, _ = central.get_conn_stats()
-        periph_cummulative.append(periph_stats)
-        central_cummulative.append(central_stats)
+        # Skip when resuming a run that already took its final read
+        if len(periph_cummulative) == policy.iterations:
+            periph_cummulative.append(periph_stats, time.time())
+            central_cummulative.append(central_stats, time.time())
         central.disconnect()
         periph.disconnect()
         central.reset()
@@ -482,18 +728,26 @@ def main():
     except TimeoutError:
         pass
 
+    periph_cummulative.close()
+    central_cummulative.close()
+
     misc["Start Time"] = start_time.strftime("%H:%M:%S")
     misc["Stop Time"] = datetime.now().strftime("%H:%M:%S")
+    misc["Anomalies"] = len(monitor.anomalies)
+    if policy.stop_reason is not None:
+        misc["Stop Reason"] = policy.stop_reason
 
-    print("[cyan]Plotting results. This may take some time[/cyan]")
-    save_results(
+    save_report_data(
         periph=periph_cummulative,
         central=central_cummulative,
         misc_data=misc,
-        phy=args.phy,
+        phy=state["phy"],
         sample_rate=sample_rate,
+        window=window,
+        anomalies=monitor.to_list(),
         directory=args.directory,
     )
+    run_report_stage(args, compile_report, args.directory)
 
 
 if __name__ == "__main__":
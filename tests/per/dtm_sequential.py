@@ -0,0 +1,289 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+dtm_sequential.py
+
+Description: Direct test mode PER sweep that stops each point early once
+the pass/fail decision against the spec PER is statistically clear
+
+"""
+import math
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import matplotlib.pyplot as plt
+import pandas as pd
+from alive_progress import alive_bar
+
+# pylint: disable=import-error,wrong-import-position
+from max_ble_hci import BleHci
+from max_ble_hci.constants import PhyOption
+
+from utils import wilson_bounds
+
+# pylint: enable=import-error,wrong-import-position
+
+# Packets counted before a decision may be taken
+MIN_PACKETS = 100
+
+# Normal quantile of the decision confidence. 99% since the counts are
+# checked repeatedly while the test runs
+DECISION_Z = 2.58
+
+# Seconds between packet count reads
+POLL_INTERVAL = 0.05
+
+# Seconds without new transmitted packets before a point is given up
+STALL_TIMEOUT = 5.0
+
+
+def channel_frequency(channel: int) -> int:
+    """Center frequency in MHz of an RF channel (0-39)"""
+    return 2402 + 2 * channel
+
+
+def channel_loss(losses: Union[float, Dict], channel: int) -> float:
+    """Path loss of a channel from the TX path calibration
+
+    Parameters
+    ----------
+    losses : Union[float, Dict]
+        One loss for all channels, or losses keyed by frequency in MHz
+    channel : int
+        RF channel (0-39)
+
+    Returns
+    -------
+    float
+        Loss in dB at the calibrated frequency closest to the channel
+    """
+    if not isinstance(losses, dict):
+        return float(losses)
+
+    freq = channel_frequency(channel)
+    nearest = min(losses, key=lambda cal_freq: abs(float(cal_freq) - freq))
+
+    return float(losses[nearest])
+
+
+class SequentialPerTest:
+    """Sequential pass/fail test of a PER against a limit
+
+    A decision is taken as soon as the Wilson interval of the running PER
+    lies entirely above or below the limit. Points close to the limit run
+    until the full packet budget is used.
+    """
+
+    def __init__(
+        self,
+        limit: float,
+        max_packets: int,
+        min_packets: int = MIN_PACKETS,
+        z: float = DECISION_Z,
+    ) -> None:
+        self.limit = limit
+        self.max_packets = max_packets
+        self.min_packets = min(min_packets, max_packets)
+        self.z = z
+
+    def decide(self, num_packets: int, num_errors: int) -> Optional[bool]:
+        """Decide pass or fail from the running counts
+
+        Parameters
+        ----------
+        num_packets : int
+            Packets transmitted so far
+        num_errors : int
+            Packets not received so far
+
+        Returns
+        -------
+        Optional[bool]
+            True for pass, False for fail, None if more packets are needed
+        """
+        if num_packets < self.min_packets:
+            return None
+
+        per = 100 * num_errors / num_packets
+
+        if num_packets >= self.max_packets:
+            return per < self.limit
+
+        low, high = wilson_bounds(per, num_packets, self.z)
+        if high < self.limit:
+            return True
+        if low >= self.limit:
+            return False
+
+        return None
+
+
+class DtmPerSweep:
+    """PER over RX power and channel measured in direct test mode
+
+    The master transmits and the DUT receives. Packet counts are read while
+    the test runs so each point stops as soon as it is decided. A point
+    whose packet count stops growing is abandoned after ``stall_timeout``.
+    """
+
+    def __init__(
+        self,
+        master: BleHci,
+        dut: BleHci,
+        phy: str,
+        packet_len: int,
+        losses: Union[float, Dict],
+        sequential: SequentialPerTest,
+        stall_timeout: float = STALL_TIMEOUT,
+    ) -> None:
+        self.master = master
+        self.dut = dut
+        self.phy = PhyOption.str_to_enum(phy)
+        self.packet_len = packet_len
+        self.losses = losses
+        self.sequential = sequential
+        self.stall_timeout = stall_timeout
+
+    def measure(self, atten, channel: int, power: int) -> Tuple[float, int]:
+        """Measure one channel and RX power point
+
+        Parameters
+        ----------
+        atten : RCDAT6000
+            Attenuator between master and DUT
+        channel : int
+            RF channel (0-39)
+        power : int
+            Uncalibrated RX power in dBm
+
+        Returns
+        -------
+        Tuple[float, int]
+            PER in percent and the number of packets it was measured over.
+            The PER is NaN if the point stalled
+        """
+        atten.set_attenuation(int(power + channel_loss(self.losses, channel)))
+
+        self.master.reset()
+        self.dut.reset()
+
+        num_packets, num_errors = 0, 0
+        try:
+            self.dut.rx_test(channel=channel, phy=self.phy)
+            self.master.tx_test(
+                channel=channel, phy=self.phy, packet_len=self.packet_len
+            )
+
+            last_progress = time.monotonic()
+            while True:
+                time.sleep(POLL_INTERVAL)
+                try:
+                    stats_tx, _ = self.master.get_test_stats()
+                    stats_rx, _ = self.dut.get_test_stats()
+                except TimeoutError:
+                    stats_tx = None
+
+                if stats_tx is not None:
+                    if stats_tx.tx_data > num_packets:
+                        last_progress = time.monotonic()
+                    num_packets = stats_tx.tx_data
+                    num_errors = max(0, num_packets - stats_rx.rx_data)
+
+                    if self.sequential.decide(num_packets, num_errors) is not None:
+                        break
+
+                if time.monotonic() - last_progress > self.stall_timeout:
+                    print(
+                        f"Channel {channel} at {power} dBm stalled after "
+                        f"{num_packets} packets, marking it failed"
+                    )
+                    return math.nan, num_packets
+        finally:
+            # Never leave the boards in test mode
+            self.master.reset()
+            self.dut.reset()
+
+        return 100 * num_errors / max(num_packets, 1), num_packets
+
+    def run(self, atten, channels: List[int], powers: List[int]) -> pd.DataFrame:
+        """Measure every channel and RX power point
+
+        Parameters
+        ----------
+        atten : RCDAT6000
+            Attenuator between master and DUT
+        channels : List[int]
+            RF channels to measure
+        powers : List[int]
+            RX powers in dBm, from strongest to weakest
+
+        Returns
+        -------
+        pd.DataFrame
+            CHANNEL, RX_INPUT_POWER, PER and NUM_PACKETS per point
+        """
+        rows = []
+        with alive_bar(len(channels) * len(powers)) as progress:
+            for channel in channels:
+                for power in powers:
+                    per, num_packets = self.measure(atten, channel, power)
+                    rows.append(
+                        {
+                            "CHANNEL": channel,
+                            "RX_INPUT_POWER": power,
+                            "PER": per,
+                            "NUM_PACKETS": num_packets,
+                        }
+                    )
+                    progress()
+
+        atten.set_attenuation(0)
+
+        return pd.DataFrame(rows)
+
+
+def spec_passed(df: pd.DataFrame, spec_per: float, spec_power: float) -> bool:
+    """Check that every point stronger than the spec power meets the spec PER"""
+    strong = df[df["RX_INPUT_POWER"] > spec_power]
+
+    return bool((strong["PER"] < spec_per).all())
+
+
+def save_results(df: pd.DataFrame, directory: str):
+    """Store the sweep as CSV and a PER heatmap
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Sweep results from ``DtmPerSweep.run``
+    directory : str
+        Results directory
+    """
+    df.to_csv(f"{directory}/per_dtm.csv", index=False)
+
+    heatmap = df.pivot(index="RX_INPUT_POWER", columns="CHANNEL", values="PER")
+    heatmap = heatmap.sort_index(ascending=False)
+
+    _, axes = plt.subplots()
+    image = axes.imshow(heatmap.to_numpy(), aspect="auto", cmap="RdYlGn_r", vmin=0, vmax=100)
+    axes.set_xticks(range(len(heatmap.columns)), labels=heatmap.columns)
+    axes.set_yticks(range(len(heatmap.index)), labels=heatmap.index)
+    axes.set(xlabel="Channel", ylabel="RX Power (dBm)", title="PER Heatmap")
+    plt.colorbar(image, ax=axes, label="PER (%)")
+    plt.savefig(f"{directory}/per_heatmap.png")
+    plt.close()
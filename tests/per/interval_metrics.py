@@ -0,0 +1,340 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+interval_metrics.py
+
+Description: Per-interval and rolling window metrics from cumulative stats
+
+"""
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from sample_store import (
+    ADV_PKT_METRICS,
+    DATA_PKT_METRICS,
+    SCAN_PKT_METRICS,
+    Rate,
+    SampleStore,
+)
+
+# ISR and setup times are binned per usec, longer times land in the last bin
+GAUGE_BINS = 1024
+PERCENTILES = (50, 99)
+# Default rolling window length in seconds
+DEFAULT_WINDOW = 60
+
+
+@dataclass
+class IntervalSpec:
+    """How the stats of one kind of sample are turned into interval metrics"""
+
+    # Cumulative counters, converted to per-interval deltas
+    counters: List[str]
+    # Rates recomputed over the deltas in the window
+    rates: Dict[str, Rate]
+    # Counters reported as packets per second over the window
+    throughput: List[str]
+    # Instantaneous values reported as percentiles over the window
+    gauges: List[str]
+
+
+DATA_PKT_INTERVALS = IntervalSpec(
+    counters=["rx_data", "rx_data_crc", "rx_data_timeout", "tx_data", "err_data"],
+    rates=DATA_PKT_METRICS,
+    throughput=["rx_data", "tx_data"],
+    gauges=["rx_isr", "tx_isr"],
+)
+ADV_PKT_INTERVALS = IntervalSpec(
+    counters=["tx_adv", "rx_req", "rx_req_crc", "rx_req_timeout", "tx_resp", "err_adv"],
+    rates=ADV_PKT_METRICS,
+    throughput=["tx_adv"],
+    gauges=["rx_isr", "tx_isr"],
+)
+SCAN_PKT_INTERVALS = IntervalSpec(
+    counters=[
+        "rx_adv",
+        "rx_adv_crc",
+        "rx_adv_timeout",
+        "tx_req",
+        "rx_rsp",
+        "rx_rsp_crc",
+        "rx_rsp_timeout",
+        "err_scan",
+    ],
+    rates=SCAN_PKT_METRICS,
+    throughput=["rx_adv"],
+    gauges=["rx_isr", "tx_isr"],
+)
+
+
+def window_samples(window: float, sample_rate: float) -> int:
+    """Number of samples in a window of ``window`` seconds"""
+    return max(int(round(window / sample_rate)), 1)
+
+
+def _rate(num: float, den: float) -> float:
+    return 100 * num / den if den else float("NaN")
+
+
+class RollingMetrics:
+    """Streaming rolling window metrics over cumulative stats samples
+
+    Each sample costs O(1) regardless of the window length. Running sums of
+    the counter deltas in the window are kept and the ISR/setup time
+    percentiles come from a fixed size histogram.
+
+    Counters are converted to deltas against the previous sample. A sample
+    where any counter went down follows a controller reset, e.g. after a
+    reconnect or ``reset_connection_stats``, so its counters are the delta.
+    All zero samples are failed reads and are skipped.
+    """
+
+    def __init__(self, spec: IntervalSpec, window: int) -> None:
+        """Create rolling metrics
+
+        Parameters
+        ----------
+        spec : IntervalSpec
+            Counters, rates, throughputs and gauges to track
+        window : int
+            Window length in samples
+        """
+        self.spec = spec
+        self.window = max(window, 1)
+
+        self._index = {name: i for i, name in enumerate(spec.counters)}
+        self._prev = None
+        self._deltas = deque(maxlen=self.window)
+        self._sums = np.zeros(len(spec.counters))
+        self._times = deque(maxlen=self.window + 1)
+        self._gauges = deque(maxlen=self.window)
+        self._hist = np.zeros((len(spec.gauges), GAUGE_BINS), dtype=np.int64)
+
+    def update(self, record: np.void) -> None:
+        """Add the newest sample
+
+        Parameters
+        ----------
+        record : np.void
+            Sample as returned by ``SampleStore.last``
+        """
+        values = np.array([record[name] for name in self.spec.counters], dtype=float)
+        if not values.any():
+            return
+
+        if self._prev is None:
+            delta = np.zeros_like(values)
+        elif (values < self._prev).any():
+            delta = values
+        else:
+            delta = values - self._prev
+        self._prev = values
+
+        if len(self._deltas) == self.window:
+            self._sums -= self._deltas[0]
+        self._deltas.append(delta)
+        self._sums += delta
+        self._times.append(float(record["time"]))
+
+        bins = np.array(
+            [int(record[name]) for name in self.spec.gauges], dtype=np.int64
+        ).clip(0, GAUGE_BINS - 1)
+        rows = np.arange(len(bins))
+        if len(self._gauges) == self.window:
+            self._hist[rows, self._gauges[0]] -= 1
+        self._gauges.append(bins)
+        self._hist[rows, bins] += 1
+
+    def extend(self, records: np.ndarray) -> None:
+        """Add several samples, e.g. to refill the window of a resumed run"""
+        for record in records[-(self.window + 1) :]:
+            self.update(record)
+
+    def _sum(self, names: List[str]) -> float:
+        return sum(self._sums[self._index[name]] for name in names)
+
+    def snapshot(self) -> Dict[str, float]:
+        """Current window metrics
+
+        Returns
+        -------
+        Dict[str, float]
+            Windowed rates by metric name, ``<counter>_per_sec`` throughputs
+            and ``<gauge>_p<percentile>`` percentiles
+        """
+        metrics = {}
+        for name, (numerator, denominator) in self.spec.rates.items():
+            metrics[name] = _rate(self._sum(numerator), self._sum(denominator))
+
+        elapsed = self._times[-1] - self._times[0] if self._times else 0
+        for name in self.spec.throughput:
+            metrics[f"{name}_per_sec"] = (
+                self._sums[self._index[name]] / elapsed if elapsed > 0 else float("NaN")
+            )
+
+        count = len(self._gauges)
+        for row, name in enumerate(self.spec.gauges):
+            cumulative = np.cumsum(self._hist[row])
+            for percentile in PERCENTILES:
+                metrics[f"{name}_p{percentile}"] = (
+                    float(np.searchsorted(cumulative, percentile / 100 * count))
+                    if count
+                    else float("NaN")
+                )
+
+        return metrics
+
+    def summary(self) -> str:
+        """Short one line description of the current window"""
+        return ", ".join(
+            f"{name} {value:.1f}" for name, value in self.snapshot().items()
+        )
+
+
+def counter_deltas(records: np.ndarray, counters: List[str]) -> np.ndarray:
+    """Per-interval deltas of cumulative counters
+
+    Applies the same reset and failed read handling as ``RollingMetrics``
+    to a whole run at once.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Structured array of samples
+    counters : List[str]
+        Cumulative counter columns
+
+    Returns
+    -------
+    np.ndarray
+        Deltas with one row per sample and one column per counter
+    """
+    values = np.stack([records[name] for name in counters], axis=1).astype(float)
+    valid = values.any(axis=1)
+
+    # Index of the last valid sample before each sample
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(values)), -1))
+    prev = np.concatenate(([-1], last_valid[:-1]))
+
+    deltas = values - values[np.maximum(prev, 0)]
+    reset = (deltas < 0).any(axis=1)
+    deltas[reset] = values[reset]
+    deltas[~valid | (prev < 0)] = 0
+
+    return deltas
+
+
+class IntervalSeries:
+    """Rolling window metrics for every sample of a finished run
+
+    Exposes the same ``column`` and ``sample_times`` interface as
+    ``SampleStore`` so it can be charted directly.
+    """
+
+    def __init__(
+        self, store: SampleStore, spec: IntervalSpec, window: int, sample_rate: float
+    ) -> None:
+        """Compute the series
+
+        Parameters
+        ----------
+        store : SampleStore
+            Recorded samples
+        spec : IntervalSpec
+            Counters, rates, throughputs and gauges to compute
+        window : int
+            Window length in samples
+        sample_rate : float
+            Nominal sample period, used if samples lack capture times
+        """
+        window = max(window, 1)
+        records = store.records()
+        self._times = store.sample_times(sample_rate)
+
+        deltas = counter_deltas(records, spec.counters)
+        index = {name: i for i, name in enumerate(spec.counters)}
+
+        # Sum of the deltas in the window ending at each sample
+        cumulative = np.vstack(
+            (np.zeros(len(spec.counters)), np.cumsum(deltas, axis=0))
+        )
+        stop = np.arange(1, len(deltas) + 1)
+        start = np.maximum(stop - window, 0)
+        sums = cumulative[stop] - cumulative[start]
+
+        self._columns = {}
+        for name, (numerator, denominator) in spec.rates.items():
+            num = sum(sums[:, index[counter]] for counter in numerator)
+            den = sum(sums[:, index[counter]] for counter in denominator)
+            rate = np.full(len(sums), np.nan)
+            np.divide(100 * num, den, out=rate, where=den != 0)
+            self._columns[name] = rate
+
+        elapsed = self._times - self._times[np.maximum(stop - 1 - window, 0)]
+        for name in spec.throughput:
+            throughput = np.full(len(sums), np.nan)
+            np.divide(sums[:, index[name]], elapsed, out=throughput, where=elapsed > 0)
+            self._columns[f"{name}_per_sec"] = throughput
+
+        # Percentiles over the whole run, skipping failed reads
+        valid = np.zeros(len(records), dtype=bool)
+        for name in spec.counters:
+            valid |= records[name] != 0
+
+        self.percentiles = {}
+        for name in spec.gauges:
+            for percentile in PERCENTILES:
+                self.percentiles[f"{name}_p{percentile}"] = (
+                    float(np.percentile(records[name][valid], percentile))
+                    if valid.any()
+                    else float("NaN")
+                )
+
+    def column(self, name: str) -> np.ndarray:
+        """Rolling window series of one metric"""
+        return self._columns[name]
+
+    def sample_times(self, sample_rate: float) -> np.ndarray:
+        """Time of each sample in seconds since the first"""
+        # pylint: disable=unused-argument
+        return self._times
+
+    def table(self) -> List[list]:
+        """Report table of the window extremes, mean throughput and percentiles"""
+        table = [["Metric", "Value", "Unit"]]
+
+        for name, column in self._columns.items():
+            finite = column[np.isfinite(column)].tolist()
+            label = name.replace("_", " ").upper()
+            if not finite:
+                continue
+
+            if name.endswith("_per_sec"):
+                mean = sum(finite) / len(finite)
+                table.append([f"Mean {label}", round(mean, 2), "pkt/s"])
+            else:
+                table.append([f"Min Window {label}", round(min(finite), 2), "%"])
+                table.append([f"Max Window {label}", round(max(finite), 2), "%"])
+
+        for name, value in self.percentiles.items():
+            table.append([name.replace("_", " ").upper(), round(value, 2), "usec"])
+
+        return table
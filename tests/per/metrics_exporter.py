@@ -0,0 +1,181 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+metrics_exporter.py
+
+Description: Prometheus endpoint publishing live stats of long running tests
+
+"""
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def record_metrics(record: np.void) -> Dict[str, float]:
+    """Every stats column of a sample except its capture time
+
+    Parameters
+    ----------
+    record : np.void
+        Sample as returned by ``SampleStore.last``
+    """
+    return {
+        name: float(record[name]) for name in record.dtype.names if name != "time"
+    }
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class MetricsExporter:
+    """Serve the latest published values as Prometheus gauges over HTTP
+
+    Values are only replaced on ``publish``, so a scrape never waits for
+    the test and the test never waits for a scrape. Without a port nothing
+    is served and publishing only keeps the latest values.
+    """
+
+    def __init__(
+        self,
+        port: Optional[int],
+        prefix: str,
+        labels: Optional[Dict[str, str]] = None,
+        host: str = "127.0.0.1",
+    ) -> None:
+        """Create an exporter
+
+        Parameters
+        ----------
+        port : Optional[int]
+            Port the /metrics endpoint is served on. Disabled if None
+        prefix : str
+            Prefix of every metric name, e.g. ``ble_connection_stability``
+        labels : Optional[Dict[str, str]], optional
+            Labels added to every metric, e.g. the board names
+        host : str, optional
+            Address to listen on. Local only by default
+        """
+        self.port = port
+        self.host = host
+        self.prefix = prefix
+        self.labels = labels or {}
+
+        self._values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        """Start serving in a background thread"""
+        if self.port is None or self._server is not None:
+            return
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", f"{len(body)}")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving"""
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+    def publish(self, metrics: Dict[str, float], **labels: str) -> None:
+        """Replace the values of some gauges
+
+        Parameters
+        ----------
+        metrics : Dict[str, float]
+            Gauge values by name, without the prefix
+        labels : str
+            Labels of this set of values, e.g. ``role="central"``
+        """
+        key = tuple(sorted({**self.labels, **labels}.items()))
+
+        with self._lock:
+            for name, value in metrics.items():
+                self._values.setdefault(name, {})[key] = float(value)
+
+    def render(self) -> str:
+        """Current values in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._values.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} gauge")
+                for labels, value in series.items():
+                    lines.append(
+                        f"{metric}{_format_labels(labels)} {_format_value(value)}"
+                    )
+
+        return "\n".join(lines) + "\n"
@@ -77,11 +77,23 @@ from max_ble_hci.hci_packets import EventPacket
 from max_ble_hci.packet_codes import EventCode, EventMaskLE, EventSubcode
 from max_ble_hci.constants import PhyOption
 from resource_manager import ResourceManager
-from utils import config_switches, create_directory, make_version_table, is_ci
+from utils import (
+    config_switches,
+    create_directory,
+    is_ci,
+    make_version_table,
+    wilson_bounds,
+)
 from datetime import datetime
 
 # pylint: enable=import-error,wrong-import-position
 
+# PER (%) at which the sensitivity point is reached
+SENS_PER = 30.8
+
+# HCI failures tolerated at a single RX power
+START_RETRIES = 15
+
 
 def print_test_config(slave, master):
     print("Using:")
@@ -110,6 +122,23 @@ def config_cli():
         default="-20:-100:-2",
         help="RX power range. Syntax:  start:stop:step. If no step, default step -2",
     )
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="Search for the sensitivity points instead of sweeping every step",
+    )
+    parser.add_argument(
+        "--coarse-step",
+        default=10,
+        type=int,
+        help="Coarse RX power step in dB used by --search",
+    )
+    parser.add_argument(
+        "--max-dwells",
+        default=3,
+        type=int,
+        help="Max holds per RX power while the PER is too close to the limit (--search)",
+    )
 
     return parser.parse_args()
 
@@ -123,6 +152,9 @@ class SensitivityConnTest:
         directory: str,
         hold_time: int,
         attens: list,
+        search: bool = False,
+        coarse_step: int = 10,
+        max_dwells: int = 3,
     ) -> None:
         self.periph_board = periph_board
         self.central_board = central_board
@@ -133,6 +165,10 @@ class SensitivityConnTest:
 
         self.hold_time = hold_time
         self.attens = attens
+        self.search = search
+        self.coarse_step = coarse_step
+        self.max_dwells = max_dwells
+        self.failed_per = False
 
         self.resource_manager = ResourceManager()
 
@@ -262,8 +298,8 @@ class SensitivityConnTest:
         gen.new_page()
         gen.add_image(sens_plot_path, img_dims=(8 * inch, 6 * inch))
 
-        below_spec_p = df[df["slave"] > 30.8]
-        below_spec_c = df[df["master"] > 30.8]
+        below_spec_p = df[df["slave"] > SENS_PER]
+        below_spec_c = df[df["master"] > SENS_PER]
 
         if len(below_spec_p) > 0:
             sens_point_periph = below_spec_p["attens"].iloc[0]
@@ -364,89 +400,220 @@ class SensitivityConnTest:
         except:
             pass
 
+    def _measure_point(self, atten, power: int):
+        """Hold an RX power and read the PER stats of both sides
+
+        Parameters
+        ----------
+        atten : RCDAT6000
+            Attenuator between the boards
+        power : int
+            Uncalibrated RX power in dBm
+
+        Returns
+        -------
+        Optional[Tuple[DataPktStats, DataPktStats]]
+            Peripheral and central stats, None if the HCI retries ran out
+            or an assertion triggered
+        """
+        retries = START_RETRIES
+
+        while True:
+            atten.set_attenuation(int(power + self.loss))
+            time.sleep(self.hold_time)
+
+            try:
+                periph_stats, _ = self.periph.get_conn_stats()
+                self.periph.reset_connection_stats()
+
+            except TimeoutError:
+                retries -= 1
+                self.periph_hci_failures += 1
+                if retries == 0:
+                    return None
+                continue
+            except ValueError:
+                # partial return indicates assertion triggered
+                print("[red]ASSERTION Triggered![/red]")
+                return None
+            try:
+                central_stats, _ = self.central.get_conn_stats()
+                self.central.reset_connection_stats()
+
+            except TimeoutError:
+                retries -= 1
+                self.central_hci_failures += 1
+                if retries == 0:
+                    return None
+                continue
+            except ValueError:
+                # partial return indicates assertion triggered
+                print("[red]ASSERTION Triggered![/red]")
+                return None
+
+            if periph_stats.rx_data and central_stats.rx_data:
+                self._force_reset_stats()
+                return periph_stats, central_stats
+
+            if self.reconnect:
+                print("Attempting reconnect!")
+                retries -= 1
+                if retries == 0:
+                    return None
+                try:
+                    self.connect()
+                    self.reconnect = False
+                    self.disconnects += 1
+                except:
+                    pass
+
+            self._force_reset_stats()
+
+    def _measure_confident(self, atten, power: int):
+        """Measure both PERs, dwelling again while either is unclear
+
+        A point is repeated until the confidence interval of each side's PER
+        excludes the sensitivity limit or ``max_dwells`` is reached.
+
+        Returns
+        -------
+        Optional[Tuple[float, float]]
+            Peripheral and central PER, None if the measurement failed
+        """
+        totals = [[0.0, 0], [0.0, 0]]
+
+        for _ in range(self.max_dwells):
+            stats = self._measure_point(atten, power)
+            if stats is None:
+                return None
+
+            decided = True
+            for total, stat in zip(totals, stats):
+                num_packets = stat.rx_data + stat.rx_data_crc + stat.rx_data_timeout
+                total[0] += stat.per() * num_packets
+                total[1] += num_packets
+
+                low, high = wilson_bounds(total[0] / total[1], total[1])
+                if low < SENS_PER <= high:
+                    decided = False
+
+            if decided:
+                break
+
+        return tuple(total[0] / total[1] for total in totals)
+
+    def _record(self, results: Dict[str, list], power: int, periph_per, central_per):
+        results["slave"].append(periph_per)
+        results["master"].append(central_per)
+        results["attens"].append(power)
+
+        if (periph_per >= SENS_PER or central_per >= SENS_PER) and power < 70:
+            self.failed_per = True
+
+    def _sweep(self, atten, results: Dict[str, list], progress):
+        for power in self.attens:
+            stats = self._measure_point(atten, power)
+            if stats is None:
+                break
+
+            periph_per = stats[0].per()
+            central_per = stats[1].per()
+            self._record(results, power, periph_per, central_per)
+
+            if periph_per >= SENS_PER and self.periph_sens is None:
+                self.periph_sens = power
+
+            if central_per >= SENS_PER and self.central_sens is None:
+                self.central_sens = power
+
+            progress()
+
+    def _search(self, atten, results: Dict[str, list], progress):
+        """Find the sensitivity of both sides without walking every step
+
+        The RX power grid is first walked in coarse steps until both sides
+        cross the PER limit, then each side is bisected down to the grid
+        step between its last passing and first failing point.
+        """
+        grid = self.attens
+        stride = 1
+        if len(grid) > 1:
+            stride = max(1, round(self.coarse_step / abs(grid[1] - grid[0])))
+
+        measured = {}
+
+        def measure(idx):
+            if idx not in measured:
+                pers = self._measure_confident(atten, grid[idx])
+                if pers is None:
+                    return None
+                measured[idx] = pers
+                self._record(results, grid[idx], *pers)
+                progress()
+
+            return measured[idx]
+
+        coarse = list(range(0, len(grid), stride))
+        if coarse[-1] != len(grid) - 1:
+            coarse.append(len(grid) - 1)
+
+        first_fail = [None, None]
+        for idx in coarse:
+            pers = measure(idx)
+            if pers is None:
+                return
+            for side in (0, 1):
+                if first_fail[side] is None and pers[side] >= SENS_PER:
+                    first_fail[side] = idx
+            if None not in first_fail:
+                break
+
+        sens = [None, None]
+        for side in (0, 1):
+            high = first_fail[side]
+            if high is None:
+                continue
+
+            low = max(
+                (idx for idx, pers in measured.items() if idx < high and pers[side] < SENS_PER),
+                default=-1,
+            )
+            while high - low > 1:
+                mid = (low + high) // 2
+                pers = measure(mid)
+                if pers is None:
+                    return
+                if pers[side] >= SENS_PER:
+                    high = mid
+                else:
+                    low = mid
+
+            sens[side] = grid[high]
+
+        self.periph_sens, self.central_sens = sens
+
     def run(self):
         # could disable with local, but then you might as well use the stability test
         atten = mc_rcdat_6000.RCDAT6000()
 
         results = {"attens": [], "slave": [], "master": []}
-        failed_per = False
+        self.failed_per = False
 
         self.start_time = datetime.now()
         self.connect()
 
-        atten_steps = len(self.attens)
-
-        START_RETRIES = 15
-        retries = START_RETRIES
-        with alive_bar(atten_steps) as bar:
-            while self.attens:
-                i = self.attens[0]
-                calibrated_value = int(i + self.loss)
-                atten.set_attenuation(calibrated_value)
-                time.sleep(self.hold_time)
-
-                try:
-                    periph_stats, _ = self.periph.get_conn_stats()
-                    self.periph.reset_connection_stats()
-
-                except TimeoutError:
-                    retries -= 1
-                    self.periph_hci_failures += 1
-                    if retries == 0:
-                        break
-                    continue
-                except ValueError:
-                    # partial return indicates assertion triggered
-                    print("[red]ASSERTION Triggered![/red]")
-                    break
-                try:
-                    central_stats, _ = self.central.get_conn_stats()
-                    self.central.reset_connection_stats()
-
-                except TimeoutError:
-                    retries -= 1
-                    self.central_hci_failures += 1
-                    if retries == 0:
-                        break
-                    continue
-                except ValueError:
-                    # partial return indicates assertion triggered
-                    print("[red]ASSERTION Triggered![/red]")
-                    break
-
-                if periph_stats.rx_data and central_stats.rx_data:
-                    periph_per = periph_stats.per()
-                    central_per = central_stats.per()
-
-                    results["slave"].append(periph_per)
-                    results["master"].append(central_per)
-                    results["attens"].append(i)
-
-                    if periph_per >= 30.8 and self.periph_sens is None:
-                        self.periph_sens = i
-
-                    if central_per >= 30.8 and self.central_sens is None:
-                        self.central_sens = i
-
-                    if (periph_per >= 30.8 or central_per >= 30.8) and i < 70:
-                        failed_per = True
-
-                    self.attens.pop(0)
-                    bar()
-                    retries = START_RETRIES
-                elif self.reconnect:
-                    print("Attempting reconnect!")
-                    retries -= 1
-                    if retries == 0:
-                        break
-                    try:
-                        self.connect()
-                        self.reconnect = False
-                        self.disconnects += 1
-                    except:
-                        pass
+        if self.search:
+            with alive_bar(None) as progress:
+                self._search(atten, results, progress)
 
-                self._force_reset_stats()
+            # plot and report in RX power order like a full sweep
+            order = sorted(
+                range(len(results["attens"])), key=lambda idx: -results["attens"][idx]
+            )
+            results = {key: [value[idx] for idx in order] for key, value in results.items()}
+        else:
+            with alive_bar(len(self.attens)) as progress:
+                self._sweep(atten, results, progress)
 
         self.stop_time = datetime.now()
 
@@ -460,7 +627,7 @@ class SensitivityConnTest:
 
         self.save_results(results)
 
-        if failed_per:
+        if self.failed_per:
             return -1
 
         return 0
@@ -530,8 +697,11 @@ def main():
         central_board=central_board,
         phy=args.phy,
         directory=results_dir,
-        hold_time=args.hold_time,
+        hold_time=float(args.hold_time),
         attens=attens,
+        search=args.search,
+        coarse_step=args.coarse_step,
+        max_dwells=args.max_dwells,
     )
 
     err = test.run()
@@ -63,17 +63,24 @@ from typing import Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from ble_test_suite.controllers import RxSensitivityTestController
+from ble_test_suite.equipment import mc_rcdat_6000
 from ble_test_suite.equipment.mc_rf_sw import MiniCircuitsRFSwitch
 from ble_test_suite.phy import rx_sensitivity as RxSens
 from ble_test_suite.results import format_dataframe
 from ble_test_suite.utils import PlotId
+from max_ble_hci import BleHci
 from resource_manager import ResourceManager
 
 from utils import is_ci
 from ble_db import BleDB
+from dtm_sequential import DtmPerSweep, SequentialPerTest, save_results, spec_passed
 
 ENV_CI_CONFIG = "CI_CONFIG_DIR"
+SPEC_SENSITIVITY = -70.8
+PER_CSV = "per_results.csv"
+SENSITIVITY_CSV = "sensitivity.csv"
 CALIBRATION_FNAME = "rfphy_sw2atten_calibration.json"
 TEST_MASTER_ID = "nRF52840_1"
 DESC = """
@@ -101,6 +108,16 @@ def _setup_ci():
     )
     parser.add_argument("--num-packets", type=int, default=1000, help="Num packets.")
     parser.add_argument("--no-cal", action="store_true", help="Num packets.")
+    parser.add_argument(
+        "--calibration",
+        default="",
+        help="Calibration file of the TX path. Default the CI calibration file",
+    )
+    parser.add_argument(
+        "--attenuator",
+        default="",
+        help="Serial number of the TX path attenuator, overriding the calibration",
+    )
     parser.add_argument(
         "-s",
         "--settings",
@@ -108,6 +125,11 @@ def _setup_ci():
         help="Optional settings file will default to environment vars if left empty",
     )
     parser.add_argument("--local", action='store_true',help='Set env to be local (i.e. do not configure switches)')
+    parser.add_argument(
+        "--early-stop",
+        action="store_true",
+        help="Stop each point once its pass/fail against the spec PER is statistically clear",
+    )
 
     return parser.parse_args()
 
@@ -139,6 +161,26 @@ def cfg_switches(rm: ResourceManager, devs: Tuple[str, str]) -> None:
         rf_sw.set_sw_state(dev1_sw_port)
 
 
+def tx_attenuator(calibration: dict) -> str:
+    """Serial number of the attenuator on the calibrated TX path
+
+    Parameters
+    ----------
+    calibration : dict
+        Calibration, its ``tx_path`` holds one serial number or a list
+
+    Returns
+    -------
+    str
+        Serial number of the first attenuator
+    """
+    attenuators = calibration["tx_path"]["attenuators"]
+    if isinstance(attenuators, str):
+        return attenuators
+
+    return attenuators[0]
+
+
 def create_results_dir(results_dir):
     import pathlib
 
@@ -147,6 +189,139 @@ def create_results_dir(results_dir):
     os.mkdir
 
 
+def run_early_stop(
+    rm: ResourceManager,
+    args,
+    spec_per: float,
+    attenuation_stop: int,
+    calibration: dict,
+    packet_len: int,
+):
+    """Run the DTM sweep with sequential early stopping of each point
+
+    Uses the same TX path calibration, attenuator and packet length as the
+    controller so both sweeps give comparable sensitivities.
+
+    Parameters
+    ----------
+    rm : ResourceManager
+        Resource manager object.
+    args : argparse.Namespace
+        Command line arguments.
+    spec_per : float
+        PER limit each point is decided against.
+    attenuation_stop : int
+        Weakest RX power in dBm.
+    calibration : dict
+        Calibration given to the controller, its ``tx_path`` holds the
+        attenuator serial numbers and the losses.
+    packet_len : int
+        Packet length in bytes.
+
+    Returns
+    -------
+    pd.DataFrame
+        Sweep results
+    """
+    tx_path = calibration["tx_path"]
+    sweep = DtmPerSweep(
+        master=BleHci(rm.get_item_value(f"{args.master}.hci_port"), id_tag="master"),
+        dut=BleHci(rm.get_item_value(f"{args.dut}.hci_port"), id_tag="dut"),
+        phy=args.phy,
+        packet_len=packet_len,
+        losses=tx_path.get("losses", 0),
+        sequential=SequentialPerTest(limit=spec_per, max_packets=args.num_packets),
+    )
+
+    channels = [int(ch) for ch in args.channels.split(",")]
+    step = int(args.attenuation_step)
+    powers = list(range(-20, attenuation_stop - 1, -step))
+
+    atten = mc_rcdat_6000.RCDAT6000(tx_attenuator(calibration))
+
+    return sweep.run(atten, channels, powers)
+
+
+def channel_sensitivity(df: pd.DataFrame, spec_per: float):
+    """Sensitivity of each channel, the strongest power failing the spec PER
+
+    A point without a PER, e.g. one stopped because the boards stalled,
+    counts as failing, so weaker points are not read past it. The channel
+    is then unmeasured, as is a channel with no failing point.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        PER results with CHANNEL, RX_INPUT_POWER and PER columns
+    spec_per : float
+        Spec PER in percent
+
+    Returns
+    -------
+    Tuple[np.ndarray, List[float]]
+        Channels and their sensitivity in dBm, NaN if unmeasured
+    """
+    channels = np.unique(df.loc[:, "CHANNEL"])
+    sens = []
+    for ch in channels:
+        points = df[df["CHANNEL"] == ch].sort_values("RX_INPUT_POWER", ascending=False)
+        per = points["PER"].to_numpy()
+        failing = ~(per < spec_per)
+        idx = np.argmax(failing)
+        if failing[idx] and not np.isnan(per[idx]):
+            sens.append(points["RX_INPUT_POWER"].iloc[idx])
+        else:
+            sens.append(np.nan)
+
+    return channels, sens
+
+
+def plot_sensitivity(channels, sens, results_dir: str):
+    """Plot the sensitivity of each channel against the spec
+
+    Parameters
+    ----------
+    channels : array_like
+        RF channels
+    sens : array_like
+        Sensitivity in dBm of each channel
+    results_dir : str
+        Results directory.
+    """
+    sens = np.array(sens)
+    x_axis = np.array(channels)
+
+    spec_pwr = SPEC_SENSITIVITY
+    measured = ~np.isnan(sens)
+    bad_idx = measured & np.greater_equal(sens, spec_pwr)
+
+    good_idx = measured & np.logical_not(bad_idx)
+
+    _, axes = plt.subplots()
+
+    if bad_idx.any():
+        axes.stem(
+            x_axis[bad_idx],
+            sens[bad_idx],
+            bottom=spec_pwr,
+            linefmt="-k",
+            markerfmt="xr",
+            basefmt="--b",
+        )
+    if good_idx.any():
+        axes.stem(
+            x_axis[good_idx],
+            sens[good_idx],
+            bottom=spec_pwr,
+            linefmt="-k",
+            markerfmt="og",
+            basefmt="--b",
+        )
+
+    axes.set(xlabel="Channel", ylabel="RX Power (dBm)", title="Sensitivity")
+    plt.savefig(f"{results_dir}/sensitivity_stem.png")
+
+
 def main():
     args = _setup_ci()
 
@@ -155,7 +330,9 @@ def main():
         cal_file = None
 
     else:
-        cal_file = os.path.join(os.getenv(ENV_CI_CONFIG), CALIBRATION_FNAME)
+        cal_file = args.calibration or os.path.join(
+            os.getenv(ENV_CI_CONFIG), CALIBRATION_FNAME
+        )
 
     if args.settings != "":
         settings_path = args.settings
@@ -208,6 +385,8 @@ def main():
 
     if not args.no_cal:
         user_setings["calibration_file"] = cal_file
+        with open(cal_file, "r") as calibration_file:
+            calibration = json.load(calibration_file)
     else:
         
         
@@ -215,6 +394,13 @@ def main():
             "attenuators" : ['12208030083'],
             'losses' : 0
         }}
+        calibration = user_setings['calibration_dict']
+
+    # Pairs measured at once each need their own attenuator
+    if args.attenuator:
+        calibration["tx_path"]["attenuators"] = [args.attenuator]
+        user_setings.pop("calibration_file", None)
+        user_setings["calibration_dict"] = calibration
 
 
     test_settings = user_setings
@@ -222,72 +408,44 @@ def main():
     create_results_dir(args.results)
 
     cfg = RxSens.init_new_test(master_info, dut_info, test_setup=test_settings)
-    ctrl = RxSensitivityTestController(cfg, hci_log_level=logging.WARN)
 
-    ctrl.run_test()
+    if args.early_stop:
+        df = run_early_stop(
+            rm,
+            args,
+            cfg.spec.sensitivity_per,
+            attenuation_stop,
+            calibration,
+            int(user_setings["packet_lens"]),
+        )
+        save_results(df, args.results)
+        test_passed = spec_passed(df, cfg.spec.sensitivity_per, SPEC_SENSITIVITY)
+    else:
+        ctrl = RxSensitivityTestController(cfg, hci_log_level=logging.WARN)
+        ctrl.run_test()
+        df = None
 
-    try:
+    if df is None:
         df = ctrl.get_dataframe()
-        sens = []
-        channels = np.unique(df.loc[:, "CHANNEL"])
-
-        for ch in channels:
-
-
-            idx = np.where(
-                np.greater_equal(
-                    df.loc[df["CHANNEL"] == ch, "PER"].to_numpy(),
-                    cfg.spec.sensitivity_per,
-                )
-            )[0][0]
-            sens.append(df.loc[idx, "RX_INPUT_POWER"])
-            
-    except:
-        print("Sensitivity bounds not present!")
-
+    df.to_csv(f"{args.results}/{PER_CSV}", index=False)
 
+    channels, sens = channel_sensitivity(df, cfg.spec.sensitivity_per)
+    unmeasured = [int(ch) for ch, power in zip(channels, sens) if np.isnan(power)]
+    if unmeasured:
+        print(f"Sensitivity not measured on channels {unmeasured}")
 
+    pd.DataFrame({"CHANNEL": channels, "SENSITIVITY": sens}).to_csv(
+        f"{args.results}/{SENSITIVITY_CSV}", index=False
+    )
 
-    if len(sens) == len(channels):
-        # store sensitivity data in database
-        if len(sens) == 40 and is_ci():
-            db = BleDB()
-            db.add_sensitivity_dtm(args.dut, sens)
+    # store sensitivity data in database
+    if len(sens) == 40 and not unmeasured and is_ci():
+        db = BleDB()
+        db.add_sensitivity_dtm(args.dut, sens)
 
-        sens = np.array(sens)
-        x_axis = channels
+    plot_sensitivity(channels, sens, args.results)
 
-        spec_pwr = -70.8
-        bad_idx = np.greater_equal(sens, spec_pwr)
-    
-        good_idx = np.logical_not(bad_idx)
-
-        _, axes = plt.subplots()
-
-        if bad_idx.any():
-            axes.stem(
-                x_axis[bad_idx],
-                sens[bad_idx],
-                bottom=spec_pwr,
-                linefmt="-k",
-                markerfmt="xr",
-                basefmt="--b",
-            )
-        if good_idx.any():
-            axes.stem(
-                x_axis[good_idx],
-                sens[good_idx],
-                bottom=spec_pwr,
-                linefmt="-k",
-                markerfmt="og",
-                basefmt="--b",
-            )
-
-        axes.set(xlabel="Channel", ylabel="RX Power (dBm)", title="Sensitivity")
-        plt.savefig(f"{args.results}/sensitivity_stem.png")
-
-
-    if not ctrl.results():
+    if not (test_passed if args.early_stop else ctrl.results()):
         sys.exit(-1)
 
 
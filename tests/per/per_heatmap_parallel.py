@@ -0,0 +1,320 @@
+#! /usr/bin/env python3
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+per_heatmap_parallel.py
+
+Description: Split a PER heatmap channel sweep across several master/DUT
+pairs and merge the results
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from resource_manager import ResourceManager
+
+# pylint: disable=import-error,wrong-import-position
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from bench_scheduler import get_inventory, pair_boards
+
+from ble_db import BleDB
+from dtm_sequential import save_results
+from per_heatmap import (
+    PER_CSV,
+    SENSITIVITY_CSV,
+    cfg_switches,
+    plot_sensitivity,
+    tx_attenuator,
+)
+from utils import is_ci
+
+# pylint: enable=import-error,wrong-import-position
+
+PER_HEATMAP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "per_heatmap.py")
+ALL_CHANNELS = ",".join(str(ch) for ch in range(40))
+
+
+def config_cli():
+    parser = argparse.ArgumentParser(
+        description="Run per_heatmap on several master/DUT pairs at once, each "
+        "pair measuring a share of the channels.",
+        epilog="Unrecognized arguments (e.g. --phy, --num-packets) are passed on "
+        "to per_heatmap.py. Every pair needs its own attenuator, given by "
+        "--calibrations or --attenuators in the order of the pairs.",
+    )
+    parser.add_argument(
+        "--pairs",
+        nargs="+",
+        default=[],
+        help="master:dut pairs as shown in resource manager",
+    )
+    parser.add_argument(
+        "--testers",
+        nargs="+",
+        default=[],
+        help="Master boards to pair automatically with the --duts boards",
+    )
+    parser.add_argument("--duts", nargs="+", default=[], help="DUT boards to pair")
+    parser.add_argument("--channels", type=str, default=ALL_CHANNELS)
+    parser.add_argument(
+        "--results", type=str, default="results", help="Results directory."
+    )
+    parser.add_argument(
+        "--calibrations",
+        nargs="+",
+        default=[],
+        help="Calibration file of each pair's TX path",
+    )
+    parser.add_argument(
+        "--attenuators",
+        nargs="+",
+        default=[],
+        help="Attenuator serial number of each pair, overriding its calibration",
+    )
+    parser.add_argument(
+        "--db-board",
+        default="",
+        help="Board the merged sensitivity is stored under. Default first DUT",
+    )
+
+    return parser.parse_known_args()
+
+
+def get_pairs(rm: ResourceManager, args) -> List[Tuple[str, str]]:
+    """Get the master/DUT pairs to run on
+
+    Explicit pairs are used as given. Otherwise testers and DUTs are
+    matched across different RF switches.
+
+    Parameters
+    ----------
+    rm : ResourceManager
+        Resource manager object.
+    args : argparse.Namespace
+        Command line arguments.
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        Master/DUT pairs
+    """
+    if args.pairs:
+        return [tuple(pair.split(":")) for pair in args.pairs]
+
+    inventory = get_inventory(rm, args.testers + args.duts, "")
+
+    return pair_boards(inventory, args.testers)
+
+
+def check_switch_paths(rm: ResourceManager, pairs: List[Tuple[str, str]]) -> None:
+    """Make sure no two pairs share an RF switch
+
+    Boards without a switch are not connected through one and are skipped.
+
+    Parameters
+    ----------
+    rm : ResourceManager
+        Resource manager object.
+    pairs : List[Tuple[str, str]]
+        Master/DUT pairs
+
+    Raises
+    ------
+    RuntimeError
+        If a switch is used by more than one pair
+    """
+    owners = {}
+    for pair in pairs:
+        for board in pair:
+            sw_model, _ = rm.get_switch_config(board)
+            if not sw_model:
+                continue
+            if sw_model in owners and owners[sw_model] != pair:
+                raise RuntimeError(
+                    f"{pair} and {owners[sw_model]} share switch {sw_model}"
+                )
+            owners[sw_model] = pair
+
+
+def pair_attenuators(
+    pairs: List[Tuple[str, str]],
+    calibrations: List[str],
+    attenuators: List[str],
+    no_cal: bool,
+) -> List[List[str]]:
+    """Get the per_heatmap arguments selecting each pair's attenuator
+
+    Parameters
+    ----------
+    pairs : List[Tuple[str, str]]
+        Master/DUT pairs
+    calibrations : List[str]
+        Calibration file of each pair, or empty
+    attenuators : List[str]
+        Attenuator serial number of each pair, or empty
+    no_cal : bool
+        Pairs run without a calibration file
+
+    Returns
+    -------
+    List[List[str]]
+        Arguments of each pair
+
+    Raises
+    ------
+    RuntimeError
+        If a pair has no attenuator of its own or two pairs share one
+    """
+    for name, values in (("calibrations", calibrations), ("attenuators", attenuators)):
+        if values and len(values) != len(pairs):
+            raise RuntimeError(f"Expected {len(pairs)} {name}, one per pair")
+    if not attenuators and (no_cal or not calibrations):
+        raise RuntimeError(
+            "Every pair needs its own attenuator, give --attenuators or --calibrations"
+        )
+
+    owners = {}
+    pair_args = []
+    for index, pair in enumerate(pairs):
+        args = []
+        if calibrations and not no_cal:
+            args += ["--calibration", calibrations[index]]
+        if attenuators:
+            attenuator = attenuators[index]
+            args += ["--attenuator", attenuator]
+        else:
+            with open(calibrations[index], "r", encoding="utf-8") as cal_file:
+                attenuator = tx_attenuator(json.load(cal_file))
+
+        if attenuator in owners:
+            raise RuntimeError(
+                f"{pair} and {owners[attenuator]} share attenuator {attenuator}"
+            )
+        owners[attenuator] = pair
+        pair_args.append(args)
+
+    return pair_args
+
+
+def split_channels(channels: List[str], num_pairs: int) -> List[List[str]]:
+    """Deal the channels round robin so every pair sweeps the whole band"""
+    return [chunk for chunk in (channels[i::num_pairs] for i in range(num_pairs)) if chunk]
+
+
+def main():
+    args, heatmap_args = config_cli()
+
+    rm = ResourceManager()
+    pairs = get_pairs(rm, args)
+    if not pairs:
+        print("No master/DUT pairs available!")
+        sys.exit(-1)
+
+    check_switch_paths(rm, pairs)
+    try:
+        attenuator_args = pair_attenuators(
+            pairs, args.calibrations, args.attenuators, "--no-cal" in heatmap_args
+        )
+    except (OSError, ValueError, KeyError, RuntimeError) as err:
+        print(err)
+        sys.exit(-1)
+
+    # Switch paths are fixed for the whole run, set them all up front
+    for pair in pairs:
+        cfg_switches(rm, pair)
+
+    channels = args.channels.split(",")
+    chunks = split_channels(channels, len(pairs))
+
+    os.makedirs(args.results, exist_ok=True)
+
+    runs = []
+    for (master, dut), chunk, pair_args in zip(pairs, chunks, attenuator_args):
+        results_dir = os.path.join(args.results, f"{master}_{dut}")
+        print(f"{master} -> {dut}: channels {','.join(chunk)}")
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                PER_HEATMAP_SCRIPT,
+                master,
+                dut,
+                "--channels",
+                ",".join(chunk),
+                "--results",
+                results_dir,
+                "--local",
+                *pair_args,
+                *heatmap_args,
+            ]
+        )
+        runs.append((results_dir, process))
+
+    passed = True
+    for _, process in runs:
+        if process.wait() != 0:
+            passed = False
+
+    per_frames = []
+    sens_frames = []
+    for results_dir, _ in runs:
+        per_path = os.path.join(results_dir, PER_CSV)
+        sens_path = os.path.join(results_dir, SENSITIVITY_CSV)
+        if os.path.exists(per_path):
+            per_frames.append(pd.read_csv(per_path))
+        if os.path.exists(sens_path):
+            sens_frames.append(pd.read_csv(sens_path))
+
+    if not per_frames:
+        print("No results to merge!")
+        sys.exit(-1)
+
+    per_df = pd.concat(per_frames, ignore_index=True).sort_values(
+        ["CHANNEL", "RX_INPUT_POWER"], ascending=[True, False]
+    )
+    per_df.to_csv(os.path.join(args.results, PER_CSV), index=False)
+    save_results(per_df, args.results)
+
+    if len(sens_frames) == len(runs):
+        sens_df = pd.concat(sens_frames, ignore_index=True).sort_values("CHANNEL")
+        sens_df.to_csv(os.path.join(args.results, SENSITIVITY_CSV), index=False)
+
+        channels = sens_df["CHANNEL"].to_numpy()
+        sens = sens_df["SENSITIVITY"].to_numpy()
+
+        # store sensitivity data in database
+        if len(sens) == 40 and not np.isnan(sens).any() and is_ci():
+            db = BleDB()
+            db.add_sensitivity_dtm(args.db_board or pairs[0][1], list(sens))
+
+        plot_sensitivity(channels, sens, args.results)
+    else:
+        print("Sensitivity bounds not present for every pair!")
+
+    if not passed:
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,17 +18,23 @@ DO_CONNECTED=1
 TESTER_TARGET=$(resource_manager -g ${TESTER}.target)
 DUT_TARGET=$(resource_manager -g ${DUT}.target)
 
-make -C $RF_PATH/"$TESTER_TARGET"/build/gcc -j
-make -C $RF_PATH/"$DUT_TARGET"/build/gcc -j
-
 DUT_EXAMPLE=$MAXIM_PATH/Examples/"$DUT_TARGET"/Bluetooth/BLE5_ctr
 TESTER_EXAMPLE=$MAXIM_PATH/Examples/"$TESTER_TARGET"/Bluetooth/BLE5_ctr
 
-make -C "$DUT_EXAMPLE" -j
-make -C "$TESTER_EXAMPLE" -j
-
-(cd "$DUT_EXAMPLE" && ocdflash $DUT)
-(cd "$TESTER_EXAMPLE" && ocdflash $TESTER)
+# Unchanged sources restore the previous build, a shared target builds once.
+# RF_PATH is a checkout inside MAXIM_PATH and is hashed as part of it
+BUILD_CACHE="python3 ../../shell-scripts/build_cache.py"
+for TARGET in $(printf '%s\n' "$TESTER_TARGET" "$DUT_TARGET" | sort -u); do
+    $BUILD_CACHE -t "$TARGET" -s "$MAXIM_PATH" -o "$RF_PATH/$TARGET" \
+        -C "$RF_PATH/$TARGET/build/gcc" -- -j || exit 1
+    $BUILD_CACHE -t "$TARGET" -s "$MAXIM_PATH" \
+        -o "$MAXIM_PATH/Examples/$TARGET/Bluetooth/BLE5_ctr/build" \
+        -C "$MAXIM_PATH/Examples/$TARGET/Bluetooth/BLE5_ctr" -- -j || exit 1
+done
+
+python3 ../../shell-scripts/ocd_flash.py \
+    "$DUT:$DUT_EXAMPLE/build/${DUT_TARGET,,}.elf" \
+    "$TESTER:$TESTER_EXAMPLE/build/${TESTER_TARGET,,}.elf" || exit 1
 
 echo TESTER $TESTER
 echo DUT $DUT
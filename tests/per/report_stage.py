@@ -0,0 +1,126 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+report_stage.py
+
+Description: Build stability reports from saved samples, off the measurement path
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Callable
+
+# pylint: disable=import-error,wrong-import-position
+from rich import print
+
+from sample_store import load_checkpoint, save_checkpoint
+
+# pylint: enable=import-error,wrong-import-position
+
+REPORT_META_FNAME = "report.json"
+REPORT_LOG_FNAME = "report.log"
+
+
+def add_report_args(parser: argparse.ArgumentParser) -> None:
+    """Add the report stage options to a test's command line
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Test argument parser
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--no-report",
+        action="store_true",
+        help="Only save the samples. Build the report later with --report-only",
+    )
+    group.add_argument(
+        "--detach-report",
+        action="store_true",
+        help="Build the report in a background process and exit once measuring ends",
+    )
+    group.add_argument(
+        "--report-only",
+        action="store_true",
+        help="Build the report from the samples saved in the result directory "
+        "without touching any hardware",
+    )
+
+
+def save_report_meta(directory: str, meta: dict) -> None:
+    """Save everything besides the samples the report needs
+
+    Parameters
+    ----------
+    directory : str
+        Result directory
+    meta : dict
+        JSON serializable report info
+    """
+    save_checkpoint(os.path.join(directory, REPORT_META_FNAME), meta)
+
+
+def load_report_meta(directory: str) -> dict:
+    """Load the report info written by ``save_report_meta``"""
+    return load_checkpoint(os.path.join(directory, REPORT_META_FNAME))
+
+
+def run_report_stage(
+    args: argparse.Namespace, compile_report: Callable[[str], None], directory: str
+) -> None:
+    """Build the report from the saved samples as requested on the command line
+
+    Must only be called once the samples and report info are saved and the
+    boards are no longer needed.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed arguments including the ones from ``add_report_args``
+    compile_report : Callable[[str], None]
+        Builds the plots and PDF from a result directory
+    directory : str
+        Result directory
+    """
+    if args.no_report:
+        print(
+            f"[cyan]Samples saved to {directory}. "
+            "Build the report with --report-only[/cyan]"
+        )
+    elif args.detach_report:
+        argv = [arg for arg in sys.argv if arg != "--detach-report"]
+        log_path = os.path.join(directory, REPORT_LOG_FNAME)
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            # New session so the report outlives this process and its job
+            process = subprocess.Popen(
+                [sys.executable, *argv, "--report-only"],
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        print(
+            f"[cyan]Building report in the background (pid {process.pid}), "
+            f"log: {log_path}[/cyan]"
+        )
+    else:
+        print("[cyan]Plotting results. This may take some time[/cyan]")
+        compile_report(directory)
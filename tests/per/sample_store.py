@@ -0,0 +1,363 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+sample_store.py
+
+Description: Columnar store for periodic stats samples
+
+"""
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Stats counters as reported by the controllers
+DATA_PKT_FIELDS = [
+    "rx_data",
+    "rx_data_crc",
+    "rx_data_timeout",
+    "tx_data",
+    "err_data",
+    "rx_setup",
+    "tx_setup",
+    "rx_isr",
+    "tx_isr",
+]
+ADV_PKT_FIELDS = [
+    "tx_adv",
+    "rx_req",
+    "rx_req_crc",
+    "rx_req_timeout",
+    "tx_resp",
+    "err_adv",
+    "rx_setup",
+    "tx_setup",
+    "rx_isr",
+    "tx_isr",
+    "tx_chain",
+]
+SCAN_PKT_FIELDS = [
+    "rx_adv",
+    "rx_adv_crc",
+    "rx_adv_timeout",
+    "tx_req",
+    "rx_rsp",
+    "rx_rsp_crc",
+    "rx_rsp_timeout",
+    "err_scan",
+    "rx_setup",
+    "tx_setup",
+    "rx_isr",
+    "tx_isr",
+]
+
+# Seconds between syncs of a journal to disk. Every record is flushed to the
+# OS at once, so only a power loss can drop the records of the last interval
+DEFAULT_SYNC_INTERVAL = 10.0
+
+# Derived metric columns as 100 * sum(numerator) / sum(denominator) over the
+# counters, matching the stats class methods of the same name
+Rate = Tuple[List[str], List[str]]
+DATA_PKT_METRICS: Dict[str, Rate] = {
+    "per": (
+        ["rx_data_crc", "rx_data_timeout"],
+        ["rx_data", "rx_data_crc", "rx_data_timeout"],
+    ),
+}
+ADV_PKT_METRICS: Dict[str, Rate] = {
+    "scan_request_rate": (["rx_req"], ["tx_adv"]),
+    "scan_request_crc_rate": (["rx_req_crc"], ["tx_adv"]),
+    "scan_request_timeout_rate": (["rx_req_timeout"], ["tx_adv"]),
+    "scan_req_fulfillment": (["tx_resp"], ["rx_req"]),
+}
+SCAN_PKT_METRICS: Dict[str, Rate] = {
+    "per": (
+        ["rx_adv_crc", "rx_adv_timeout"],
+        ["rx_adv", "rx_adv_crc", "rx_adv_timeout"],
+    ),
+    "scan_response_rate": (["rx_rsp"], ["tx_req"]),
+    "scan_response_crc_rate": (["rx_rsp_crc"], ["tx_req"]),
+    "scan_response_timeout_rate": (["rx_rsp_timeout"], ["tx_req"]),
+}
+
+
+def percent_rate(
+    records: np.ndarray, numerator: List[str], denominator: List[str]
+) -> np.ndarray:
+    """Rate in percent of summed counter columns
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Structured array of samples
+    numerator : List[str]
+        Counters summed as the numerator
+    denominator : List[str]
+        Counters summed as the denominator
+
+    Returns
+    -------
+    np.ndarray
+        Rate of each sample, NaN where the denominator is 0
+    """
+    num = np.zeros(len(records))
+    for name in numerator:
+        num += records[name]
+    den = np.zeros(len(records))
+    for name in denominator:
+        den += records[name]
+
+    rate = np.full(len(records), np.nan)
+    np.divide(100 * num, den, out=rate, where=den != 0)
+
+    return rate
+
+
+class SampleStore:
+    """Preallocated structured array of fixed width stats records
+
+    Each sample is one record holding its capture time, the stats counters
+    as integers and any derived metrics as floats. Columns are returned as views into the
+    store so plotting and tables never copy or rebuild per-sample lists.
+
+    Derived metrics are not computed per sample. They are filled in for all
+    new records at once with column operations when the store is read.
+
+    With a journal every record is also appended to a raw file as soon as
+    it is recorded, so a crashed run can be reloaded and continued. The
+    journal is synced to disk every ``sync_interval`` seconds and on close,
+    not per record, so sampling is never held up by the disk.
+    """
+
+    def __init__(
+        self,
+        counters: List[str],
+        capacity: int,
+        metrics: Optional[Dict[str, Rate]] = None,
+        journal: Optional[str] = None,
+        resume: bool = False,
+        sync_interval: float = DEFAULT_SYNC_INTERVAL,
+    ) -> None:
+        """Create a store
+
+        Parameters
+        ----------
+        counters : List[str]
+            Integer stats attributes recorded from each sample
+        capacity : int
+            Number of records to preallocate. The store grows if exceeded
+        metrics : Optional[Dict[str, Rate]], optional
+            Derived float columns mapped to the counters they are a rate of
+        journal : Optional[str], optional
+            File every record is appended to
+        resume : bool, optional
+            Reload the records already in the journal instead of starting
+            a new one
+        sync_interval : float, optional
+            Seconds between syncs of the journal to disk
+        """
+        self.counters = counters
+        self.metrics = metrics or {}
+
+        fields: List[Tuple[str, str]] = [("time", "f8")]
+        fields += [(name, "i8") for name in counters]
+        fields += [(name, "f8") for name in self.metrics]
+        self.dtype = np.dtype(fields)
+
+        self._data = np.zeros(max(capacity, 1), dtype=self.dtype)
+        self._size = 0
+        # Records before this index have their metrics filled in
+        self._computed = 0
+        self._journal = None
+        self.sync_interval = sync_interval
+        self._last_sync = time.monotonic()
+
+        if journal is not None:
+            if resume and os.path.exists(journal):
+                self._load_journal(journal)
+            self._journal = open(journal, "ab" if resume else "wb")
+
+    def _load_journal(self, path: str):
+        # A crash may have cut the last record short, drop it
+        num_records = os.path.getsize(path) // self.dtype.itemsize
+        os.truncate(path, num_records * self.dtype.itemsize)
+
+        records = np.fromfile(path, dtype=self.dtype, count=num_records)
+        while len(self._data) < num_records:
+            self._grow()
+
+        self._data[:num_records] = records
+        self._size = num_records
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _grow(self):
+        data = np.zeros(2 * len(self._data), dtype=self.dtype)
+        data[: self._size] = self._data[: self._size]
+        self._data = data
+
+    def append(self, stats, timestamp: float = float("NaN")) -> None:
+        """Record one stats sample
+
+        Counters reported as None are stored as 0.
+
+        Parameters
+        ----------
+        stats : DataPktStats | AdvPktStats | ScanPktStats
+            Stats sample read from a controller
+        timestamp : float, optional
+            Epoch time the sample was captured at
+        """
+        if self._size == len(self._data):
+            self._grow()
+
+        record = self._data[self._size]
+        record["time"] = timestamp
+        for name in self.counters:
+            record[name] = getattr(stats, name, None) or 0
+
+        self._size += 1
+
+        if self._journal is not None:
+            self._journal.write(record.tobytes())
+            self._journal.flush()
+            if time.monotonic() - self._last_sync >= self.sync_interval:
+                self.sync()
+
+    def sync(self) -> None:
+        """Sync the journal to disk"""
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        self._last_sync = time.monotonic()
+
+    def truncate(self, size: int) -> None:
+        """Drop every sample after the first ``size``"""
+        self._size = min(self._size, size)
+        self._computed = min(self._computed, self._size)
+
+        if self._journal is not None:
+            self._journal.truncate(self._size * self.dtype.itemsize)
+            self._journal.flush()
+
+    def close(self) -> None:
+        """Sync and close the journal"""
+        if self._journal is not None:
+            self.sync()
+            self._journal.close()
+            self._journal = None
+
+    def _update_metrics(self):
+        if self._computed == self._size:
+            return
+
+        rows = self._data[self._computed : self._size]
+        for name, (numerator, denominator) in self.metrics.items():
+            rows[name] = percent_rate(rows, numerator, denominator)
+
+        self._computed = self._size
+
+    def column(self, name: str) -> np.ndarray:
+        """View of one column over all recorded samples"""
+        self._update_metrics()
+        return self._data[name][: self._size]
+
+    def records(self) -> np.ndarray:
+        """View of all recorded samples"""
+        self._update_metrics()
+        return self._data[: self._size]
+
+    def last(self) -> np.void:
+        """Most recent sample"""
+        if not self._size:
+            raise IndexError("No samples recorded")
+
+        self._update_metrics()
+        return self._data[self._size - 1]
+
+    def sample_times(self, sample_rate: float) -> np.ndarray:
+        """Time of each sample in seconds since the first
+
+        Uses the capture timestamps when every sample has one, otherwise
+        the nominal sample instants.
+        """
+        times = self.column("time")
+        if self._size and np.isfinite(times).all():
+            return times - times[0]
+
+        return np.arange(self._size) * sample_rate
+
+    def save(self, path: str) -> None:
+        """Write all recorded samples to an .npy file"""
+        np.save(path, self.records())
+
+    @classmethod
+    def from_file(
+        cls, path: str, metrics: Optional[Dict[str, Rate]] = None
+    ) -> "SampleStore":
+        """Load a store written by ``save``
+
+        Integer columns become counters.
+
+        Parameters
+        ----------
+        path : str
+            .npy file of recorded samples
+        metrics : Optional[Dict[str, Rate]], optional
+            Derived columns the store was created with
+        """
+        records = np.load(path)
+        counters = [
+            name
+            for name in records.dtype.names
+            if name != "time" and records.dtype[name].kind == "i"
+        ]
+
+        store = cls(counters, len(records), metrics=metrics)
+        store._data[: len(records)] = records
+        store._size = len(records)
+
+        return store
+
+
+def save_checkpoint(path: str, state: dict) -> None:
+    """Atomically replace the run state stored next to the journals
+
+    Parameters
+    ----------
+    path : str
+        Checkpoint file
+    state : dict
+        JSON serializable run state
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as checkpoint:
+        json.dump(state, checkpoint, indent=4)
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str) -> dict:
+    """Load the run state written by ``save_checkpoint``"""
+    with open(path, "r", encoding="utf-8") as checkpoint:
+        return json.load(checkpoint)
@@ -0,0 +1,133 @@
+###############################################################################
+#
+# Copyright 2024 Analog Devices, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+"""
+sampler.py
+
+Description: Fixed rate stats sampling on a monotonic schedule
+
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+
+# Shortest supported sample period in seconds
+MIN_SAMPLE_PERIOD = 0.1
+
+
+@dataclass
+class Sample:
+    """Result of one stats read"""
+
+    timestamp: float
+    value: Any = None
+    error: Optional[BaseException] = None
+
+
+class PeriodicSampler:
+    """Read stats from several controllers at fixed intervals
+
+    Sample instants are scheduled from a monotonic start time so HCI round
+    trips never accumulate into drift. All readers run concurrently on a
+    thread pool so every controller is sampled at the same instant.
+    """
+
+    def __init__(self, period: float, readers: Dict[str, Callable[[], Any]]) -> None:
+        """Create a sampler
+
+        Parameters
+        ----------
+        period : float
+            Sample period in seconds
+        readers : Dict[str, Callable[[], Any]]
+            Named stats read functions, e.g. ``BleHci.get_conn_stats``
+        """
+        self.period = max(period, MIN_SAMPLE_PERIOD)
+        self.readers = readers
+        self._pool = ThreadPoolExecutor(
+            max_workers=len(readers), thread_name_prefix="sampler"
+        )
+        self._mono_start = time.monotonic()
+        self._wall_start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """Stop the reader threads"""
+        self._pool.shutdown(wait=True)
+
+    def timestamp(self) -> float:
+        """Current epoch time derived from the monotonic clock"""
+        return self._wall_start + (time.monotonic() - self._mono_start)
+
+    def _read(self, reader: Callable[[], Any]) -> Sample:
+        start = time.monotonic()
+        try:
+            value, error = reader(), None
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            value, error = None, err
+        stop = time.monotonic()
+
+        # Stats are captured somewhere in the round trip, take the midpoint
+        capture = (start + stop) / 2
+        return Sample(self._wall_start + (capture - self._mono_start), value, error)
+
+    def poll(self) -> Dict[str, Sample]:
+        """Read all controllers concurrently
+
+        Returns
+        -------
+        Dict[str, Sample]
+            Sample of each reader. Exceptions raised by a reader are
+            returned in ``Sample.error``
+        """
+        futures = {
+            name: self._pool.submit(self._read, reader)
+            for name, reader in self.readers.items()
+        }
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def ticks(
+        self, start: int, stop: Union[int, Callable[[], int]]
+    ) -> Iterator[int]:
+        """Yield sample indices at their scheduled instants
+
+        Indices late by more than a period are yielded immediately rather
+        than skipped so every index is sampled.
+
+        Parameters
+        ----------
+        start : int
+            First index, sampled straight away
+        stop : Union[int, Callable[[], int]]
+            Index to stop before. A function is called before every index
+            so the run can be cut short or extended while sampling
+        """
+        origin = time.monotonic()
+        index = start
+        while index < (stop() if callable(stop) else stop):
+            delay = origin + (index - start) * self.period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            yield index
+            index += 1
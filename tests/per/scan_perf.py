@@ -57,12 +57,12 @@ Description: Simple example showing creation of a connection and getting packet
 """
 
 import argparse
+import os
 import time
 from datetime import datetime
 from glob import glob
-from typing import List
+from typing import List, Optional
 
-import matplotlib.pyplot as plt
 import resource_manager
 
 # pylint: disable=import-error,wrong-import-position
@@ -77,26 +77,193 @@ from packaging import version
 from resource_manager import ResourceManager
 from rich import print
 
+from anomaly import (
+    DEFAULT_EXTEND_TIME,
+    Anomaly,
+    AnomalyMonitor,
+    AnomalyPolicy,
+    add_anomaly_args,
+    anomaly_table,
+)
+from charts import ChartSpec, Line, render_charts
+from interval_metrics import (
+    DEFAULT_WINDOW,
+    SCAN_PKT_INTERVALS,
+    IntervalSeries,
+    RollingMetrics,
+    window_samples,
+)
+from metrics_exporter import MetricsExporter, record_metrics
+from report_stage import (
+    add_report_args,
+    load_report_meta,
+    run_report_stage,
+    save_report_meta,
+)
+from sample_store import (
+    SCAN_PKT_FIELDS,
+    SCAN_PKT_METRICS,
+    SampleStore,
+    load_checkpoint,
+    save_checkpoint,
+)
+from sampler import MIN_SAMPLE_PERIOD, PeriodicSampler
 from utils import create_directory, make_version_table
 
 # pylint: enable=import-error,wrong-import-position
 
+SCAN_CHARTS = [
+    ChartSpec(
+        "rx_advertisiments.png",
+        "Advertisements Vs. Time",
+        "Time (sec)",
+        "Advertisments",
+        [
+            Line("rx_adv", "RX Adv", decimation="lttb"),
+            Line("rx_adv_crc", "RX ADV CRC", decimation="lttb"),
+            Line("rx_adv_timeout", "RX ADV TIMEOUT", decimation="lttb"),
+        ],
+    ),
+    ChartSpec(
+        "per.png", "PER Vs. Time", "Time (sec)", "PER (%)", [Line("per")], ylim=(0, 100)
+    ),
+    ChartSpec(
+        "scan_req_resp.png",
+        "Scan Requests and Responses",
+        "Time (sec)",
+        "Packet Count",
+        [
+            Line("tx_req", "Scan Request", decimation="lttb"),
+            Line("rx_rsp", "Scan Response", decimation="lttb"),
+            Line("rx_rsp_crc", "Scan Response CRC", decimation="lttb"),
+            Line("rx_rsp_timeout", "Scan Response Timeout", decimation="lttb"),
+        ],
+    ),
+    ChartSpec(
+        "requets_metrics.png",
+        "Scan Request Metrics Vs. Time",
+        "time (sec)",
+        "Rate (%)",
+        [
+            Line("scan_response_rate", "Scan Response Rate"),
+            Line("scan_response_crc_rate", "Scan Response CRC Rate"),
+            Line("scan_response_timeout_rate", "Scan Response Timeout Rate"),
+        ],
+        ylim=(0, 100),
+    ),
+    ChartSpec(
+        "isr_timing.png",
+        "ISR Timing",
+        "Time (sec)",
+        "ISR Time (usec)",
+        [Line("rx_isr", "RX ISR"), Line("tx_isr", "TX ISR")],
+    ),
+    ChartSpec(
+        "setup_timing.png",
+        "Setup Timing",
+        "Time (sec)",
+        "Setup Time (usec)",
+        [Line("rx_setup", "RX SETUP"), Line("tx_setup", "TX SETUP")],
+    ),
+]
+
+
+def window_charts(window: float) -> List[ChartSpec]:
+    return [
+        ChartSpec(
+            "per_window.png",
+            f"{window:g} s Window PER Vs. Time",
+            "Time (sec)",
+            "PER (%)",
+            [Line("per", source="window")],
+            ylim=(0, 100),
+        ),
+        ChartSpec(
+            "requests_window.png",
+            f"{window:g} s Window Scan Request Metrics Vs. Time",
+            "Time (sec)",
+            "Rate (%)",
+            [
+                Line("scan_response_rate", "Scan Response Rate", source="window"),
+                Line(
+                    "scan_response_crc_rate", "Scan Response CRC Rate", source="window"
+                ),
+                Line(
+                    "scan_response_timeout_rate",
+                    "Scan Response Timeout Rate",
+                    source="window",
+                ),
+            ],
+            ylim=(0, 100),
+        ),
+        ChartSpec(
+            "rx_adv_throughput.png",
+            f"{window:g} s Window Advertisements Received Vs. Time",
+            "Time (sec)",
+            "Advertisements/s",
+            [Line("rx_adv_per_sec", source="window")],
+        ),
+    ]
+
+
+CHECKPOINT_FNAME = "checkpoint.json"
+JOURNAL_FNAME = "scan_samples.journal"
+SAMPLES_FNAME = "scan_samples.npy"
+
 if version.parse(resource_manager.__version__) < version.parse("1.1.1"):
     raise RuntimeError("Resource manager of 1.1.1 or greater is required")
 
 
 class ScanTest:
     def __init__(
-        self, dut_board: str, sample_rate: int, duration: int, directory: str
+        self,
+        dut_board: str,
+        sample_rate: float,
+        duration: int,
+        directory: str,
+        resume: bool = False,
+        window: float = DEFAULT_WINDOW,
+        metrics_port: Optional[int] = None,
+        on_anomaly: str = "ignore",
+        extend_time: float = DEFAULT_EXTEND_TIME,
     ) -> None:
         self.dut_board = dut_board
         self.directory = directory
-
-        self.duration = duration
-        self.sample_rate = (
-            sample_rate if sample_rate >= 1 and sample_rate <= duration else 1
+        self.checkpoint_path = os.path.join(directory, CHECKPOINT_FNAME)
+
+        if resume:
+            self.state = load_checkpoint(self.checkpoint_path)
+            if self.state["dut"] != dut_board:
+                raise ValueError(
+                    f"Journal in {directory} is for {self.state['dut']}, not {dut_board}"
+                )
+        else:
+            create_directory(directory)
+            self.state = {
+                "dut": dut_board,
+                "sample_rate": (
+                    sample_rate
+                    if MIN_SAMPLE_PERIOD <= sample_rate <= duration
+                    else 1
+                ),
+                "duration": duration,
+                "window": window,
+                "start_time": datetime.now().isoformat(),
+                "sample_index": 0,
+                "num_samples": 0,
+            }
+            save_checkpoint(self.checkpoint_path, self.state)
+
+        self.duration = self.state["duration"]
+        self.sample_rate = self.state["sample_rate"]
+        # Cut short or extended by the anomaly policy
+        self.iterations = self.state.get(
+            "iterations", int(int(self.duration) / float(self.sample_rate))
         )
-        self.iterations = int(int(self.duration) / float(self.sample_rate))
+        self.window = self.state.get("window", DEFAULT_WINDOW)
+        self.metrics_port = metrics_port
+        self.on_anomaly = on_anomaly
+        self.extend_time = extend_time
 
         rmanager = ResourceManager()
         self.target = rmanager.get_item_value(f"{self.dut_board}.target")
@@ -104,8 +271,18 @@ class ScanTest:
         dut_hci_port = rmanager.get_item_value(f"{dut_board}.hci_port")
         self.dut = BleHci(dut_hci_port)
 
-        self.results: List[ScanPktStats] = []
-        self.start_time = datetime.now()
+        # One sample per iteration plus the final read
+        self.results = SampleStore(
+            SCAN_PKT_FIELDS,
+            self.iterations + 1,
+            metrics=SCAN_PKT_METRICS,
+            journal=os.path.join(directory, JOURNAL_FNAME),
+            resume=resume,
+        )
+        # Drop a sample journaled after the last checkpoint
+        self.results.truncate(self.state["num_samples"])
+
+        self.start_time = datetime.fromisoformat(self.state["start_time"])
         self.stop_time = None
 
     def run(self):
@@ -113,221 +290,229 @@ class ScanTest:
         self.dut.set_scan_params(scan_params=ScanParams(scan_interval=0x10))
         self.dut.enable_scanning(True)
 
-        with alive_bar(self.iterations) as bar:
-            for _ in range(self.iterations):
-                try:
-                    stats, err = self.dut.get_scan_stats()
-                    if err == StatusCode.SUCCESS:
-                        self.results.append(stats)
-                except:
-                    self.results.append(ScanPktStats())
+        start_index = self.state["sample_index"]
+        if start_index:
+            print(f"[cyan]Resuming at sample {start_index} of {self.iterations}[/cyan]")
 
-                bar()
+        sampler = PeriodicSampler(self.sample_rate, {"dut": self.dut.get_scan_stats})
+        rolling = RollingMetrics(
+            SCAN_PKT_INTERVALS, window_samples(self.window, self.sample_rate)
+        )
+        rolling.extend(self.results.records())
+        exporter = MetricsExporter(
+            self.metrics_port, "ble_scan_stability", labels={"dut": self.dut_board}
+        )
+
+        monitor = AnomalyMonitor(SCAN_PKT_INTERVALS, ["dut"], self.sample_rate)
+        monitor.anomalies = [
+            Anomaly(**anomaly) for anomaly in self.state.get("anomalies", [])
+        ]
+        policy = AnomalyPolicy(
+            self.on_anomaly,
+            self.extend_time,
+            self.sample_rate,
+            self.iterations,
+            stop_reason=self.state.get("stop_reason"),
+        )
 
-                time.sleep(self.sample_rate)
+        with sampler, exporter, alive_bar(self.iterations - start_index) as bar:
+            for index in sampler.ticks(start_index, lambda: policy.iterations):
+                sample = sampler.poll()["dut"]
+                num_samples = len(self.results)
+                if sample.error is not None:
+                    self.results.append(ScanPktStats(), sample.timestamp)
+                elif sample.value[1] == StatusCode.SUCCESS:
+                    self.results.append(sample.value[0], sample.timestamp)
+
+                if len(self.results) > num_samples:
+                    rolling.update(self.results.last())
+                    metrics = record_metrics(self.results.last())
+                    for key, value in rolling.snapshot().items():
+                        metrics[f"window_{key}"] = value
+                    exporter.publish(metrics)
+                    bar.text = rolling.summary()
+
+                anomalies = monitor.update(
+                    index,
+                    sample.timestamp,
+                    {
+                        "dut": (
+                            self.results.last()
+                            if len(self.results) > num_samples
+                            else None
+                        )
+                    },
+                    {"dut": sample.error is not None},
+                )
+                for anomaly in anomalies:
+                    print(f"[yellow]Anomaly: {anomaly.detail}[/yellow]")
+                self.iterations = policy.apply(index, anomalies)
+                exporter.publish(
+                    {"sample_index": index + 1, "anomalies": len(monitor.anomalies)}
+                )
+
+                self.state["sample_index"] = index + 1
+                self.state["num_samples"] = len(self.results)
+                self.state["iterations"] = self.iterations
+                self.state["anomalies"] = monitor.to_list()
+                if policy.stop_reason is not None:
+                    self.state["stop_reason"] = policy.stop_reason
+                save_checkpoint(self.checkpoint_path, self.state)
+
+                bar()
 
         try:
             stats, err = self.dut.get_scan_stats()
             self.dut.reset()
-            if err == StatusCode.SUCCESS:
-                self.results.append(stats)
+            # Skip when resuming a run that already took its final read
+            if err == StatusCode.SUCCESS and not self.state.get("final_read"):
+                self.results.append(stats, time.time())
+                self.state["final_read"] = True
+                self.state["num_samples"] = len(self.results)
+                save_checkpoint(self.checkpoint_path, self.state)
         except:
             pass
 
         self.stop_time = datetime.now()
-        self._compile_results()
-
-    def _compile_results(self):
-        create_directory(self.directory)
-        self._add_plots()
-        self._add_pdf()
-
-    def _add_pdf(self):
-        now = datetime.now()
-        filepath_date = now.strftime("%m_%d_%y")
-        gen = ReportGenerator(
-            f"{self.directory}/scanning_stability_report_{filepath_date}.pdf"
+        self._save_report_data()
+
+    def _save_report_data(self):
+        self.results.close()
+        self.results.save(f"{self.directory}/{SAMPLES_FNAME}")
+        save_report_meta(
+            self.directory,
+            {
+                "dut": self.dut_board,
+                "target": self.target,
+                "package": self.package,
+                "sample_rate": self.sample_rate,
+                "window": self.window,
+                "start_time": self.start_time.isoformat(),
+                "stop_time": self.stop_time.isoformat(),
+                "anomalies": self.state.get("anomalies", []),
+                "stop_reason": self.state.get("stop_reason"),
+            },
         )
-        charts = glob(f"{self.directory}/*.png")
-
-        inch = gen.rlib.units.inch
-        for chart in charts:
-            gen.add_image(chart, img_dims=(8 * inch, 6 * inch))
-
-        gen.new_page()
-
-        last_data = self.results[-1]
-        cummulative_table = [
-            ["Metric", "Value", "Unit"],
-            ["RX Advertisments", last_data.rx_adv, "Count"],
-            ["Scan Requests", last_data.tx_req, "Count"],
-            ["Scan Responses", last_data.rx_rsp, "Count"],
-            ["Scan Response CRCs", last_data.rx_rsp_crc, "Count"],
-            ["Scan Response Timeouts", last_data.rx_rsp_timeout, "Count"],
-            ["Scanning Errors", last_data.err_scan, "Count"],
-            ["RX Setup", last_data.rx_setup, "usec"],
-            ["TX Setup", last_data.tx_setup, "usec"],
-            ["RX ISR", last_data.rx_isr, "usec"],
-            ["TX ISR", last_data.tx_isr, "usec"],
-            ["Scan Response Rate", round(last_data.scan_response_rate(), 2), "%"],
-            [
-                "Scan Response CRC Rate",
-                round(last_data.scan_response_crc_rate(), 2),
-                "%",
-            ],
-            [
-                "Scan Response Timeout Rate",
-                round(last_data.scan_response_timeout_rate(), 2),
-                "%",
-            ],
-            [
-                "PER",
-                round(last_data.per(), 2),
-                "%",
-            ],
-        ]
 
+
+def add_pdf(
+    results: SampleStore, window: IntervalSeries, meta: dict, directory: str
+):
+    now = datetime.now()
+    filepath_date = now.strftime("%m_%d_%y")
+    gen = ReportGenerator(f"{directory}/scanning_stability_report_{filepath_date}.pdf")
+    charts = glob(f"{directory}/*.png")
+
+    inch = gen.rlib.units.inch
+    for chart in charts:
+        gen.add_image(chart, img_dims=(8 * inch, 6 * inch))
+
+    gen.new_page()
+
+    last_data = results.last()
+    cummulative_table = [
+        ["Metric", "Value", "Unit"],
+        ["RX Advertisments", last_data["rx_adv"], "Count"],
+        ["Scan Requests", last_data["tx_req"], "Count"],
+        ["Scan Responses", last_data["rx_rsp"], "Count"],
+        ["Scan Response CRCs", last_data["rx_rsp_crc"], "Count"],
+        ["Scan Response Timeouts", last_data["rx_rsp_timeout"], "Count"],
+        ["Scanning Errors", last_data["err_scan"], "Count"],
+        ["RX Setup", last_data["rx_setup"], "usec"],
+        ["TX Setup", last_data["tx_setup"], "usec"],
+        ["RX ISR", last_data["rx_isr"], "usec"],
+        ["TX ISR", last_data["tx_isr"], "usec"],
+        [
+            "Scan Response Rate",
+            round(float(last_data["scan_response_rate"]), 2),
+            "%",
+        ],
+        [
+            "Scan Response CRC Rate",
+            round(float(last_data["scan_response_crc_rate"]), 2),
+            "%",
+        ],
+        [
+            "Scan Response Timeout Rate",
+            round(float(last_data["scan_response_timeout_rate"]), 2),
+            "%",
+        ],
+        [
+            "PER",
+            round(float(last_data["per"]), 2),
+            "%",
+        ],
+    ]
+
+    gen.add_table(
+        cummulative_table,
+        col_widths=(gen.page_width - inch) / 4,
+        caption="Cummulative Advertising Metrics",
+    )
+    gen.add_table(
+        window.table(),
+        col_widths=(gen.page_width - inch) / 4,
+        caption="Window Metrics",
+    )
+
+    start_time = datetime.fromisoformat(meta["start_time"])
+    stop_time = datetime.fromisoformat(meta["stop_time"])
+    misc_info_table = [
+        ["Title", "Value"],
+        ["DUT", meta["dut"]],
+        ["Target", meta["target"]],
+        ["Package", meta["package"]],
+        ["Date", now.strftime("%m/%d/%y")],
+        ["Stop Time", start_time.strftime("%H:%M:%S")],
+        ["Stop Time", stop_time.strftime("%H:%M:%S")],
+        [
+            "Total Time",
+            f"{int((stop_time - start_time).total_seconds())} s",
+        ],
+        ["Anomalies", len(meta.get("anomalies", []))],
+    ]
+    if meta.get("stop_reason"):
+        misc_info_table.append(["Stop Reason", meta["stop_reason"]])
+    gen.add_table(
+        misc_info_table,
+        col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 8,
+        caption="Misc Info",
+    )
+    if meta.get("anomalies"):
         gen.add_table(
-            cummulative_table,
+            anomaly_table(meta["anomalies"]),
             col_widths=(gen.page_width - inch) / 4,
-            caption="Cummulative Advertising Metrics",
+            caption="Anomalies",
         )
 
-        misc_info_table = [
-            ["Title", "Value"],
-            ["DUT", self.dut_board],
-            ["Target", self.target],
-            ["Package", self.package],
-            ["Date", now.strftime("%m/%d/%y")],
-            ["Stop Time", self.start_time.strftime("%H:%M:%S")],
-            ["Stop Time", self.stop_time.strftime("%H:%M:%S")],
-            [
-                "Total Time",
-                f"{int((self.stop_time - self.start_time).total_seconds())} s",
-            ],
-        ]
-        gen.add_table(
-            misc_info_table,
-            col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 8,
-            caption="Misc Info",
-        )
+    gen.add_table(
+        make_version_table(),
+        col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 7,
+        caption="Version Info",
+    )
+
+    date = now.strftime("%m/%d/%y")
+    gen.build(doc_title=f"BLE Scannning Stability Report {date}")
 
-        gen.add_table(
-            make_version_table(),
-            col_widths=(gen.page_width - gen.rlib.units.inch) * 3 / 7,
-            caption="Version Info",
-        )
 
-        date = now.strftime("%m/%d/%y")
-        gen.build(doc_title=f"BLE Scannning Stability Report {date}")
-
-    def _add_plots(self):
-        rx_adv = []
-        rx_adv_crc = []
-        rx_adv_timeout = []
-
-        scan_responses = []
-        scan_response_crc = []
-        scan_response_timeout = []
-
-        scan_requests = []
-
-        rx_isr = []
-        tx_isr = []
-
-        rx_setup = []
-        tx_setup = []
-
-        resp_rate = []
-        crc_rate = []
-        timeout_rate = []
-        per = []
-
-        stat: ScanPktStats
-        for stat in self.results:
-            rx_adv.append(stat.rx_adv)
-            rx_adv_crc.append(stat.rx_adv_crc)
-            rx_adv_timeout.append(stat.rx_adv_timeout)
-
-            scan_requests.append(stat.tx_req)
-            scan_responses.append(stat.rx_rsp)
-            scan_response_crc.append(stat.rx_rsp_crc)
-            scan_response_timeout.append(stat.rx_rsp_timeout)
-
-            rx_isr.append(stat.rx_isr)
-            tx_isr.append(stat.tx_isr)
-            tx_setup.append(stat.tx_setup)
-            rx_setup.append(stat.rx_setup)
-
-            crc_rate.append(stat.scan_response_crc_rate())
-            resp_rate.append(stat.scan_response_rate())
-            timeout_rate.append(stat.scan_response_timeout_rate())
-
-            per.append(stat.per())
-
-        time_data = [x * self.sample_rate for x in range(len(self.results))]
-
-        plt.plot(time_data, rx_adv, label="RX Adv")
-        plt.plot(time_data, rx_adv_crc, label="RX ADV CRC")
-        plt.plot(time_data, rx_adv_timeout, label="RX ADV TIMEOUT")
-
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Advertisments")
-        plt.title("Advertisements Vs. Time")
-        plt.legend()
-        plt.savefig(f"{self.directory}/rx_advertisiments.png")
-        plt.close()
-
-        plt.plot(time_data, per)
-        plt.ylim([0, 100])
-        plt.xlabel("Time (sec)")
-        plt.ylabel("PER (%)")
-        plt.title("PER Vs. Time")
-        plt.savefig(f"{self.directory}/per.png")
-        plt.close()
-
-        plt.plot(time_data, scan_requests, label="Scan Request")
-        plt.plot(time_data, scan_responses, label="Scan Response")
-        plt.plot(time_data, scan_response_crc, label="Scan Response CRC")
-        plt.plot(time_data, scan_response_timeout, label="Scan Response Timeout")
-
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Packet Count")
-        plt.title("Scan Requests and Responses")
-        plt.legend()
-        plt.savefig(f"{self.directory}/scan_req_resp.png")
-        plt.close()
-
-        plt.plot(time_data, resp_rate, label="Scan Response Rate")
-        plt.plot(time_data, crc_rate, label="Scan Response CRC Rate")
-        plt.plot(time_data, timeout_rate, label="Scan Response Timeout Rate")
-        plt.ylim([0, 100])
-        plt.xlabel("time (sec)")
-        plt.ylabel("Rate (%)")
-        plt.title("Scan Request Metrics Vs. Time")
-        plt.legend()
-        plt.savefig(f"{self.directory}/requets_metrics.png")
-        plt.close()
-
-        # ISR Timing
-        plt.plot(time_data, rx_isr, label="RX ISR")
-        plt.plot(time_data, tx_isr, label="TX ISR")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("ISR Time (usec)")
-        plt.title("ISR Timing")
-        plt.legend()
-        plt.savefig(f"{self.directory}/isr_timing.png")
-        plt.close()
-
-        # Setup Timing
-        plt.plot(time_data, rx_setup, label="RX SETUP")
-        plt.plot(time_data, tx_setup, label="TX SETUP")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Setup Time (usec)")
-        plt.title("Setup Timing")
-        plt.legend()
-        plt.savefig(f"{self.directory}/setup_timing.png")
-        plt.close()
+def compile_report(directory: str):
+    """Build the plots and PDF from the data saved in a result directory"""
+    meta = load_report_meta(directory)
+    results = SampleStore.from_file(f"{directory}/{SAMPLES_FNAME}", SCAN_PKT_METRICS)
+
+    sample_rate = meta["sample_rate"]
+    window = meta.get("window", DEFAULT_WINDOW)
+    series = IntervalSeries(
+        results, SCAN_PKT_INTERVALS, window_samples(window, sample_rate), sample_rate
+    )
+
+    render_charts(
+        SCAN_CHARTS + window_charts(window),
+        {None: results, "window": series},
+        sample_rate,
+        directory,
+    )
+    add_pdf(results, series, meta, directory)
 
 
 def config_cli():
@@ -345,9 +530,29 @@ def config_cli():
         "-s",
         "--sample-rate",
         default=1,
-        help="Sample rate in seconds. Minimum of 1 second",
+        help=f"Sample period in seconds. Minimum of {MIN_SAMPLE_PERIOD} seconds",
     )
 
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the journal in the result directory",
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        default=DEFAULT_WINDOW,
+        type=float,
+        help="Rolling window in seconds for the interval metrics",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve live stats in Prometheus format on this local port",
+    )
+    add_anomaly_args(parser)
+    add_report_args(parser)
+
     return parser.parse_args()
 
 
@@ -356,13 +561,23 @@ def main():
 
     args = config_cli()
 
+    if args.report_only:
+        compile_report(args.directory)
+        return
+
     test = ScanTest(
         dut_board=args.dut,
-        sample_rate=int(args.sample_rate),
+        sample_rate=float(args.sample_rate),
         duration=int(args.time),
         directory=args.directory,
+        resume=args.resume,
+        window=args.window,
+        metrics_port=args.metrics_port,
+        on_anomaly=args.on_anomaly,
+        extend_time=args.extend_time,
     )
     test.run()
+    run_report_stage(args, compile_report, args.directory)
 
 
 if __name__ == "__main__":
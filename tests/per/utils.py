@@ -1,6 +1,8 @@
+import math
 import os
 import shutil
 import subprocess
+from typing import Tuple
 from resource_manager import ResourceManager
 from ble_test_suite.equipment import mc_rf_sw
 
@@ -76,6 +78,38 @@ def config_switches(resource_manager: ResourceManager, slave: str, master: str):
         sw_master.set_sw_state(master_sw_port)
 
 
+def wilson_bounds(per: float, num_packets: int, z: float = 1.96) -> Tuple[float, float]:
+    """Wilson score confidence interval of a packet error rate
+
+    Parameters
+    ----------
+    per : float
+        Measured packet error rate in percent
+    num_packets : int
+        Number of packets the PER was measured over
+    z : float, optional
+        Normal quantile of the confidence level, 1.96 for 95%
+
+    Returns
+    -------
+    Tuple[float, float]
+        Lower and upper PER bound in percent
+    """
+    if num_packets <= 0:
+        return 0.0, 100.0
+
+    p_hat = per / 100
+    denom = 1 + z**2 / num_packets
+    center = (p_hat + z**2 / (2 * num_packets)) / denom
+    spread = (
+        z
+        * math.sqrt(p_hat * (1 - p_hat) / num_packets + z**2 / (4 * num_packets**2))
+        / denom
+    )
+
+    return 100 * max(0.0, center - spread), 100 * min(1.0, center + spread)
+
+
 def is_ci() -> bool:
     import socket
 